@@ -1,6 +1,10 @@
 
 import numpy
 import configparser
+import warnings
+import os
+import hashlib
+import zipfile
 from math import sqrt, log
 
 
@@ -10,23 +14,291 @@ def stripLeadingDigits( word ):
             return word[i:]
 
 
+# Input not handled by _readLines, read with configparser then:
+class _ReaderError( Exception ):
+    pass
+
+# Read the input file into { section: { key: value } } in one pass with
+# the rules of configparser: keys are lower case, the first ":" or "="
+# separates key and value, lines indented more than their key line 
+# continue the value, empty lines inside values are kept, lines 
+# starting with "#" or ";" are comments.  Input _readLines does not 
+# handle, e.g. duplicate or missing sections or keys, is passed to 
+# configparser, results and exceptions are the same as with 
+# readSectionsConfigparser:
+def readSections( filename ):
+    try:
+        with open( filename ) as inputfile:
+            sections= _readLines( inputfile )
+    except ( OSError, _ReaderError ):
+        return readSectionsConfigparser( filename )
+    return { name: { key: "\n".join( values ).rstrip()
+                     for key, values in section.items() }
+             for name, section in sections.items() }
+def _readLines( lines ):
+    sectionre= configparser.ConfigParser.SECTCRE
+    optionre= configparser.ConfigParser.OPTCRE
+    sections= {}
+    section= None
+    key= None
+    indent= 0
+    for line in lines:
+        stripped= line.strip()
+        if stripped == "":
+            if key is not None:
+                section[key].append( "" )
+            continue
+        if stripped[0] in "#;":
+            continue
+        lineindent= len( line ) - len( line.lstrip() )
+        if key is not None and lineindent > indent:
+            section[key].append( stripped )
+            continue
+        indent= lineindent
+        match= sectionre.match( stripped )
+        if match:
+            name= match.group( "header" )
+            if name in sections or name == "DEFAULT":
+                raise _ReaderError( line )
+            section= {}
+            sections[name]= section
+            key= None
+            continue
+        match= optionre.match( stripped )
+        if section is None or not match or not match.group( "option" ):
+            raise _ReaderError( line )
+        key= match.group( "option" ).rstrip().lower()
+        if key in section:
+            raise _ReaderError( line )
+        section[key]= [ match.group( "value" ).strip() ]
+    return sections
+
+# Same with configparser:
+def readSectionsConfigparser( filename ):
+    parser= configparser.ConfigParser( interpolation=None )
+    parser.read( filename )
+    return { name: dict( parser.items( name ) ) 
+             for name in parser.sections() }
+
+
+# Sections and values from readSections, missing ones raise the 
+# exceptions of configparser:
+def _getSection( sections, name ):
+    if not name in sections:
+        raise configparser.NoSectionError( name )
+    return sections[name]
+def _getValue( sections, name, key ):
+    section= _getSection( sections, name )
+    if not key in section:
+        raise configparser.NoOptionError( key, name )
+    return section[key]
+
+
+# Numbers in a string converted in bulk with numpy, float reports 
+# input numpy does not read to the end:
+def toFloatArray( text ):
+    with warnings.catch_warnings():
+        warnings.simplefilter( "error", DeprecationWarning )
+        try:
+            return numpy.fromstring( text, sep=" " )
+        except ( DeprecationWarning, ValueError ):
+            return numpy.array( [ float( s ) for s in text.split() ] )
+
+
 class AverageDataParser:
 
-    # C-tor, read inputs and calculate covariances:
-    def __init__( self, filename, llogNormal=False ):
+    # Inputs from python objects instead of an input file: names and 
+    # values of the measurements, errors and covariance options for 
+    # each error source key as in the [Data] section, correlation 
+    # matrices for "c" and option matrices for "m" error source keys, 
+    # group labels, r-values for error source keys with "R" and global 
+    # options like "correlationfactor":
+    @classmethod
+    def fromData( cls, names, values, errors, covoptions, correlations=None,
+                  groups=None, rvalues=None, globalvalues=None, 
+                  llogNormal=False ):
+        dataparser= cls.__new__( cls )
+        dataparser.__correlations= None
+        dataparser.__filename= None
+        dataparser.__dependencies= []
+        herrors= { key: numpy.array( errors[key], dtype=float ).tolist()
+                   for key in errors.keys() }
+        hcovopt= { key: str( covoptions[key] ) for key in errors.keys() }
+        grouplist= None if groups is None else [ str( group ) for group in groups ]
+        dataparser.__setData( [ str( name ) for name in names ],
+                              numpy.array( values, dtype=float ).tolist(),
+                              herrors, hcovopt, grouplist )
+        dataparser.__setRvalues( {} if rvalues is None else rvalues )
+        dataparser.__setGlobals( {} if globalvalues is None else globalvalues )
+        if correlations is not None:
+            hcovlists= {}
+            for key, matrix in correlations.items():
+                if "c" in hcovopt[key]:
+                    hcovlists[key]= numpy.array( matrix, dtype=float ).reshape( -1 )
+                elif "m" in hcovopt[key]:
+                    hcovlists[key]= numpy.asarray( matrix, dtype=str ).reshape( -1 ).tolist()
+            dataparser.__correlations= hcovlists
+        if llogNormal:
+            dataparser.__transformLogNormal()
+        dataparser.__makeCovariances()
+        return dataparser
+
+    # C-tor, read inputs and calculate covariances.  With lCache the
+    # results are kept in a sidecar file next to the input file and
+    # read from there while input file and options are unchanged:
+    def __init__( self, filename, llogNormal=False, lCache=False ):
         self.__correlations= None
         self.__filename= filename
+        self.__dependencies= []
+        if lCache:
+            cachename, cachekey= self.__getCacheNameAndKey( filename, 
+                                                            llogNormal )
+            if self.__loadCache( cachename, cachekey ):
+                return
         self.__readInput( filename, llogNormal )
+        if lCache:
+            self.__saveCache( cachename, cachekey )
         return
 
-    # Read inputs using ConfigParser:
+    # Sidecar cache in numpy .npz format without pickled objects, the 
+    # key is a hash of the input file and the options.  Files referenced
+    # from the input are checked by size and modification time:
+    __cacheversion= "2"
+    def __getCacheNameAndKey( self, filename, llogNormal ):
+        cachename= filename + ( ".lognormal" if llogNormal else "" ) + ".npz"
+        digest= hashlib.sha256()
+        digest.update( ( self.__cacheversion + str( llogNormal ) ).encode() )
+        with open( filename, "rb" ) as inputfile:
+            digest.update( inputfile.read() )
+        return cachename, digest.hexdigest()
+    def __getDependencyStats( self, paths ):
+        stats= []
+        for path in paths:
+            stat= os.stat( path )
+            stats.append( [ stat.st_size, stat.st_mtime_ns ] )
+        return numpy.array( stats, dtype=numpy.int64 ).reshape( len( paths ), 2 )
+    def __saveCache( self, cachename, cachekey ):
+        arrays= { "key": numpy.array( cachekey ),
+                  "names": numpy.array( self.__names ),
+                  "values": numpy.array( self.__inputs, dtype=float ),
+                  "groups": numpy.array( self.__groups ),
+                  "groupmatrix": numpy.array( self.__groupmatrix, dtype=int ),
+                  "dependencies": numpy.array( self.__dependencies, dtype=str ),
+                  "dependencystats": self.__getDependencyStats( self.__dependencies ),
+                  "cov": numpy.asarray( self.__cov ) }
+        # Reduced covariance matrices are stored when they differ:
+        if not numpy.array_equal( self.__redcov, self.__cov ):
+            arrays["redcov"]= numpy.asarray( self.__redcov )
+        for errorkey, errors in self.__errors.items():
+            arrays["errors/"+errorkey]= numpy.array( errors, dtype=float )
+            arrays["covopts/"+errorkey]= numpy.array( self.__covopts[errorkey] )
+        if self.__hrvalues is not None:
+            for key, rvalue in self.__hrvalues.items():
+                arrays["rvalues/"+key]= numpy.array( rvalue )
+        for key, value in self.__hglobals.items():
+            arrays["globals/"+key]= numpy.array( value )
+        if self.__correlations is not None:
+            for errorkey, correlations in self.__correlations.items():
+                if isinstance( correlations, numpy.memmap ):
+                    arrays["correlationfiles/"+errorkey]= numpy.array( correlations.filename )
+                else:
+                    arrays["correlations/"+errorkey]= numpy.array( correlations )
+        for errorkey in self.__hcov.keys():
+            arrays["hcov/"+errorkey]= numpy.asarray( self.__hcov[errorkey] )
+            if not numpy.array_equal( self.__hredcov[errorkey], 
+                                      self.__hcov[errorkey] ):
+                arrays["hredcov/"+errorkey]= numpy.asarray( self.__hredcov[errorkey] )
+        for errorkey, lowrank in self.__hlowrank.items():
+            arrays["hlowrank/"+errorkey]= numpy.array( lowrank )
+        for nerr, systerrors in self.__systerrormatrix.items():
+            arrays["systerrormatrix/"+str( nerr )]= numpy.array( systerrors, 
+                                                                 dtype=float )
+        if self.__lowrankcov is not None:
+            arrays["lowrankcov/diagonal"]= self.__lowrankcov[0]
+            arrays["lowrankcov/vectors"]= self.__lowrankcov[1]
+        arrays["members"]= numpy.array( sorted( arrays.keys() ), dtype=str )
+        try:
+            temporaryname= cachename + "." + str( os.getpid() ) + ".npz"
+            numpy.savez( temporaryname, **arrays )
+            os.replace( temporaryname, cachename )
+        except OSError:
+            pass
+        return
+    # A cache which can not be read, e.g. truncated or with missing
+    # entries, is ignored and written again:
+    def __loadCache( self, cachename, cachekey ):
+        try:
+            return self.__readCache( cachename, cachekey )
+        except ( OSError, ValueError, EOFError, KeyError, 
+                 zipfile.BadZipFile ):
+            self.__correlations= None
+            self.__dependencies= []
+            return False
+    def __readCache( self, cachename, cachekey ):
+        with numpy.load( cachename, allow_pickle=False ) as cache:
+            if str( cache["key"] ) != cachekey:
+                return False
+            if( sorted( cache.files ) != 
+                sorted( cache["members"].tolist() + [ "members" ] ) ):
+                return False
+            dependencies= cache["dependencies"].tolist()
+            stats= self.__getDependencyStats( dependencies )
+            if not numpy.array_equal( stats, cache["dependencystats"] ):
+                return False
+            entries= {}
+            for name in cache.files:
+                groupname, separator, key= name.partition( "/" )
+                entries.setdefault( groupname, {} )[key]= cache[name]
+        def group( name ):
+            return entries.get( name, {} )
+        self.__names= entries["names"][""].tolist()
+        self.__inputs= entries["values"][""].tolist()
+        self.__groups= entries["groups"][""].tolist()
+        self.__groupmatrix= entries["groupmatrix"][""].tolist()
+        self.__dependencies= dependencies
+        self.__errors= { key: errors.tolist() 
+                         for key, errors in group( "errors" ).items() }
+        self.__covopts= { key: str( covopt ) 
+                          for key, covopt in group( "covopts" ).items() }
+        if "rvalues" in entries:
+            self.__hrvalues= { key: float( rvalue ) 
+                               for key, rvalue in group( "rvalues" ).items() }
+        else:
+            self.__hrvalues= None
+        self.__hglobals= { key: float( value ) 
+                           for key, value in group( "globals" ).items() }
+        if "correlations" in entries or "correlationfiles" in entries:
+            self.__correlations= { key: correlations.tolist() 
+                                   for key, correlations in group( "correlations" ).items() }
+            for key, path in group( "correlationfiles" ).items():
+                self.__correlations[key]= numpy.load( str( path ), 
+                                                      mmap_mode="r" )
+        self.__hcov= { key: numpy.matrix( cov ) 
+                       for key, cov in group( "hcov" ).items() }
+        self.__hredcov= { key: numpy.matrix( group( "hredcov" ).get( key, cov ).copy() )
+                          for key, cov in group( "hcov" ).items() }
+        self.__hlowrank= { key: tuple( lowrank ) 
+                           for key, lowrank in group( "hlowrank" ).items() }
+        self.__cov= numpy.matrix( entries["cov"][""] )
+        self.__redcov= numpy.matrix( group( "redcov" ).get( "", entries["cov"][""] ).copy() )
+        self.__systerrormatrix= { int( nerr ): systerrors.tolist() 
+                                  for nerr, systerrors in group( "systerrormatrix" ).items() }
+        if "lowrankcov" in entries:
+            self.__lowrankcov= ( entries["lowrankcov"]["diagonal"],
+                                 entries["lowrankcov"]["vectors"] )
+        else:
+            self.__lowrankcov= None
+        self.__freeze()
+        return True
+
+    # Read inputs, each value is split once, numbers are converted in
+    # bulk with numpy:
     def __readInput( self, filename, llogNormal ):
-        parser= configparser.ConfigParser( interpolation=None )
-        parser.read( filename )
-        self.__readData( parser )
-        self.__readRvalues( parser )
-        self.__readGlobals( parser )
-        self.__readCovariances( parser )
+        sections= readSections( filename )
+        self.__readData( sections )
+        self.__readRvalues( sections )
+        self.__readGlobals( sections )
+        self.__readCovariances( sections )
         if llogNormal:
             self.__transformLogNormal()
         self.__makeCovariances()
@@ -42,24 +314,24 @@ class AverageDataParser:
         return
 
     # Read "Data" section:
-    def __readData( self, parser ):
-        tuplelist= parser.items( "Data" )
+    def __readData( self, sections ):
         herrors= {}
         hcovopt= {}
         grouplist= None
-        for item in tuplelist:
-            key= item[0]
-            value= item[1]
+        for key, value in _getSection( sections, "Data" ).items():
             listvalue= value.split()
             if key == "names":
                 names= listvalue
             elif key == "values":
-                ldata= [ float(s) for s in listvalue ]
+                ldata= numpy.array( listvalue, dtype=float ).tolist()
             elif key == "groups":
                 grouplist= listvalue
             else:
                 hcovopt[key]= listvalue.pop()
-                herrors[key]= [ float(s) for s in listvalue ]
+                herrors[key]= numpy.array( listvalue, dtype=float ).tolist()
+        self.__setData( names, ldata, herrors, hcovopt, grouplist )
+        return
+    def __setData( self, names, ldata, herrors, hcovopt, grouplist ):
         for key in herrors.keys():
             if "%" in hcovopt[key]:
                 for ierr in range( len(herrors[key]) ):
@@ -83,13 +355,18 @@ class AverageDataParser:
         self.__groupmatrix= groupmatrix
         return
     
-    def __readRvalues( self, parser ):
+    def __readRvalues( self, sections ):
+        rvalues= { key: _getValue( sections, "Rvalues", key )
+                   for key, covopt in self.__covopts.items() if "R" in covopt }
+        self.__setRvalues( rvalues )
+        return
+    def __setRvalues( self, rvalues ):
         hcovopt= self.__covopts
         if sum( [ "R" in v for v in hcovopt.values() ] ):
             hrvalues= {}
             for key in hcovopt.keys():
                 if "R" in hcovopt[key]:
-                    rvalue= parser.get( "Rvalues", key )
+                    rvalue= rvalues[key]
                     strippedKey= stripLeadingDigits( key )
                     hrvalues[strippedKey]= float( rvalue )
             self.__hrvalues= hrvalues
@@ -102,33 +379,37 @@ class AverageDataParser:
         else:
             return dict( self.__hrvalues )
     
-    def __readGlobals( self, parser ):
+    def __readGlobals( self, sections ):
+        self.__setGlobals( sections.get( "Globals", {} ) )
+        return
+    def __setGlobals( self, globalvalues ):
         hglobals= {}
-        try:
-            tuplelist= parser.items( "Globals" )
-        except configparser.NoSectionError:
-            pass
-        else:
-            for item in tuplelist:
-                key= item[0]
-                value= item[1]
-                if key == "correlationfactor":
-                    hglobals[key]= float( value )
+        for key, value in globalvalues.items():
+            if key == "correlationfactor":
+                hglobals[key]= float( value )
         self.__hglobals= hglobals
         return
 
-    # Read "Covariances" section if it exists:
-    def __readCovariances( self, parser ):
+    # Read "Covariances" section if it exists, the correlation matrix
+    # of a "c" source can be given as the name of a .npy file relative 
+    # to the input file, it is memory mapped read-only and kept in the
+    # shape and memory order of the file:
+    def __readCovariances( self, sections ):
         hcovopt= self.__covopts
         if sum( [ "c" in v or "m" in v for v in hcovopt.values() ] ):
             hcovlists= {}
             for key in hcovopt.keys():
                 if "c" in hcovopt[key] or "m" in hcovopt[key]:
-                    covvalues= parser.get( "Covariances", key ).split()
-                    if "c" in hcovopt[key]:
-                        hcovlists[key]= [ float(s) for s in covvalues ]
+                    covvalues= _getValue( sections, "Covariances", key )
+                    if "c" in hcovopt[key] and covvalues.endswith( ".npy" ):
+                        path= os.path.join( os.path.dirname( self.__filename ),
+                                            covvalues )
+                        self.__dependencies.append( path )
+                        hcovlists[key]= numpy.load( path, mmap_mode="r" )
+                    elif "c" in hcovopt[key]:
+                        hcovlists[key]= toFloatArray( covvalues ).tolist()
                     elif "m" in hcovopt[key]:
-                        hcovlists[key]= covvalues
+                        hcovlists[key]= covvalues.split()
             self.__correlations= hcovlists
         return
 
@@ -136,28 +417,44 @@ class AverageDataParser:
     def __makeZeroMatrix( self ):
         ndim= len( self.__inputs )
         return numpy.matrix( numpy.zeros( shape=(ndim,ndim) ) )
-    def __makeMatrixFromList( self, lelements ):
-        m= numpy.matrix( lelements )
-        ndim= len( self.__inputs )
-        m.shape= ( ndim, ndim )
-        return m
-    def __calcCovariance( self, covoption, errors, iderr1, iderr2 ):
-        err1= errors[iderr1]
-        err2= errors[iderr2]
-        if "f" in covoption:
-            cov= err1*err2
-        elif "a" in covoption:
-            if iderr1 == iderr2:
-                cov= err1**2
-            else:
-                cov= -err1*err2
-        elif "p" in covoption:
-            cov= min( err1, err2 )**2
-        elif "u" in covoption:
-            if iderr1 == iderr2:
-                cov= err1**2
-            else:
-                cov= 0.0
+    def __optionMask( self, covoptions, option ):
+        return numpy.char.find( covoptions, option ) >= 0
+    def __calcCovariances( self, covoptions, errors ):
+        # Covariances for options "f", "a", "p" or "u" with numpy
+        # broadcasting, covoptions is a single option or an array of
+        # options with one entry per matrix element, the option masks
+        # are found for the distinct options only:
+        err= numpy.array( errors, dtype=float )
+        ndim= len( err )
+        options, inverse= numpy.unique( numpy.array( covoptions, dtype=str ),
+                                        return_inverse=True )
+        diagonal= numpy.eye( ndim, dtype=bool )
+        err1err2= numpy.outer( err, err )
+        minerrsq= numpy.minimum.outer( err, err )**2
+        def optionMask( option ):
+            mask= self.__optionMask( options, option )[inverse]
+            return numpy.broadcast_to( mask.reshape( numpy.shape( covoptions ) ),
+                                       ( ndim, ndim ) )
+        fmask= optionMask( "f" )
+        amask= optionMask( "a" )
+        pmask= optionMask( "p" )
+        umask= optionMask( "u" )
+        if not numpy.all( fmask | amask | pmask | umask ):
+            raise RuntimeError( "Option", covoptions, "not recognised" )
+        cov= numpy.select( [ fmask, amask, pmask, umask ],
+                           [ err1err2,
+                             numpy.where( diagonal, err1err2, -err1err2 ),
+                             minerrsq,
+                             numpy.where( diagonal, err1err2, 0.0 ) ] )
+        return cov
+    # Fully correlated and globally partially correlated error sources
+    # are kept as ( diagonal, vector, reduced diagonal ), the covariance
+    # matrix is the outer product of vector with itself and diagonal
+    # as diagonal elements, the reduced covariance matrix is diagonal:
+    def __expandLowRank( self, lowrank ):
+        diagonal, vector, reddiagonal= lowrank
+        cov= numpy.outer( vector, vector )
+        cov[numpy.diag_indices_from( cov )]= diagonal
         return cov
     def __makeCovariances( self ):
         # The covariance matrices for each error source
@@ -165,114 +462,101 @@ class AverageDataParser:
         # The covariance matrices without fully correlated error components
         # for each error source
         hredcov= {}
+        # Low rank form of covariance matrices for each error source
+        # where possible, these have no entries in hcov and hredcov
+        hlowrank= {}
         systerrormatrix= {}
         errorkeys= sorted( self.__errors.keys() )
-        covoptions= self.__covopts
+        inputs= numpy.array( self.__inputs, dtype=float )
+        ndim= len( inputs )
+        diagonal= numpy.eye( ndim, dtype=bool )
         for errorkey in errorkeys:
             nerr= errorkeys.index( errorkey )
-            lcov= []
-            lredcov= []
             errors= self.__errors[errorkey] 
-            nerrors= len( errors )
+            err= numpy.array( errors, dtype=float )
             covoption= self.__covopts[errorkey]
+            lowrank= None
             # Global options, all covariances according to
             # same rule gpr, gp, p, f, a or u:
             if "gpr" in covoption:
-                minrelerr= min( [ err/value for err, value in 
-                                  zip( errors, self.__inputs ) if err > 0.0 ] )
-                systerrlist= []
-                for iderr1 in range( nerrors ):
-                    for iderr2 in range( nerrors ):
-                        if iderr1 == iderr2:
-                            covelement= errors[iderr1]**2
-                            redcovelement= errors[iderr1]**2 - (minrelerr*self.__inputs[iderr1])**2
-                            redcovelement= max( redcovelement, 0.0 )
-                        else:
-                            covelement= minrelerr**2*self.__inputs[iderr1]*self.__inputs[iderr2]
-                            redcovelement= 0.0
-                        lcov.append( covelement )
-                        lredcov.append( redcovelement )
-                    systerrlist.append( minrelerr*self.__inputs[iderr1] )
-                systerrormatrix[nerr]= systerrlist
+                minrelerr= min( [ error/value for error, value in 
+                                  zip( errors, self.__inputs ) if error > 0.0 ] )
+                systerrs= minrelerr*inputs
+                lowrank= ( err**2, systerrs,
+                           numpy.maximum( err**2 - systerrs**2, 0.0 ) )
+                systerrormatrix[nerr]= systerrs.tolist()
             elif( "gp" in covoption ):
                 minerr= min( [ error for error in errors if error > 0.0 ] )
-                systerrlist= []
-                for iderr1 in range( nerrors ):
-                    for iderr2 in range( nerrors ):
-                        if iderr1 == iderr2:
-                            covelement= errors[iderr1]**2
-                            redcovelement= errors[iderr1]**2 - minerr**2
-                        else:
-                            covelement= minerr**2
-                            redcovelement= 0.0
-                        lcov.append( covelement )
-                        lredcov.append( redcovelement )
-                    systerrlist.append( minerr )
-                systerrormatrix[nerr]= systerrlist
+                systerrs= numpy.full( ndim, minerr )
+                lowrank= ( err**2, systerrs, err**2 - systerrs**2 )
+                systerrormatrix[nerr]= ndim*[ minerr ]
             # Direct calculation from "f", "p", "u" or "a":
-            elif( "f" in covoption or "p" in covoption or
-                  "u" in covoption or "a" in covoption ):
-                lcov= [ self.__calcCovariance( covoption, errors, iderr1, iderr2 )
-                        for iderr1 in range( nerrors ) 
-                        for iderr2 in range( nerrors ) ]
-                if( "f" in covoption ):
-                    systerrormatrix[nerr]= errors
-                    lredcov= len(errors)**2*[0.0]
-                else:
-                    lredcov= lcov
+            elif( "f" in covoption ):
+                lowrank= ( err**2, err, numpy.zeros( ndim ) )
+                systerrormatrix[nerr]= errors
+            elif( "p" in covoption or "u" in covoption or 
+                  "a" in covoption ):
+                cov= self.__calcCovariances( covoption, errors )
+                redcov= cov
             # Covariances from correlations and errors:
             elif "c" in covoption:
-                corrlist= self.__correlations[errorkey]
-                err1err2= [ err1*err2 for err1 in errors for err2 in errors ]
-                lcov= [ corr*errprod 
-                        for corr, errprod in zip( corrlist, err1err2 ) ]
+                corr= numpy.asarray( self.__correlations[errorkey], 
+                                     dtype=float ).reshape( ndim, ndim )
+                cov= numpy.multiply( corr, err[:,numpy.newaxis] )
+                cov*= err
                 # "Onionisation":
                 if "o" in covoption:
-                    for iderr1 in range( nerrors ):
-                        for iderr2 in range( nerrors ):
-                            if errors[iderr1] > 0.0 and errors[iderr2] > 0.0:
-                                ierr= iderr1*nerrors+iderr2
-                                lcov[ierr]= min( lcov[ierr],
-                                                 min( errors[iderr1], errors[iderr2] )**2 )
-                lredcov= lcov
+                    positive= err > 0.0
+                    onion= numpy.logical_and.outer( positive, positive )
+                    minerrsq= numpy.minimum.outer( err, err )**2
+                    cov= numpy.where( onion, numpy.minimum( cov, minerrsq ), cov )
+                redcov= cov
             # Covariances from options:
             elif "m" in covoption:
                 mcovopts= self.__correlations[errorkey]
-                iderr1err2= [ ( iderr1, iderr2 ) for iderr1 in range( nerrors )
-                                for iderr2 in range( nerrors ) ]
-                lcov= [ self.__calcCovariance( mcovopt, errors, iderr[0], iderr[1] )
-                        for mcovopt, iderr in zip( mcovopts, iderr1err2 ) ]
+                covoptmatrix= numpy.array( mcovopts, dtype=str )
+                covoptmatrix.shape= ( ndim, ndim )
+                cov= self.__calcCovariances( covoptmatrix, errors )
                 if( "f" in mcovopts and not "p" in mcovopts ):
                     systerrormatrix[nerr]= errors
-                    lredcov= len(errors)**2*[0.0]
+                    redcov= numpy.zeros( ( ndim, ndim ) )
                 else:
-                    lredcov= lcov
+                    redcov= cov
             # Error in option:
             else:
                 raise RuntimeError( "Option", covoption, "not recognised" )
 
-            # Final covariance matrix
-            m= self.__makeMatrixFromList( lcov )
+            # Keep low rank form unless a correlation factor is present
+            if lowrank is not None:
+                if "correlationfactor" in self.__hglobals:
+                    cov= self.__expandLowRank( lowrank )
+                    redcov= numpy.diag( lowrank[2] )
+                else:
+                    hlowrank[errorkey]= lowrank
+                    continue
 
             # Apply correlation factor to final cov.matrix if present
             if "correlationfactor" in self.__hglobals:
                 corrfac= self.__hglobals["correlationfactor"]
-                for i in range( m.shape[0] ):
-                    for j in range( m.shape[1] ):
-                        if i != j and m[i,i]*m[j,j] != 0.0:
-                            m[i,j]*= m[i,j]/(sqrt(m[i,i]*m[j,j]))*corrfac
+                variances= numpy.diag( cov )
+                varprod= numpy.outer( variances, variances )
+                scale= numpy.logical_and( ~diagonal, varprod != 0.0 )
+                sqrtvarprod= numpy.sqrt( numpy.where( scale, varprod, 1.0 ) )
+                cov= numpy.where( scale, cov*( cov/sqrtvarprod*corrfac ), cov )
 
             # Store final and reduced cov.matrices
-            redm= self.__makeMatrixFromList( lredcov )
-            hcov[errorkey]= m
-            hredcov[errorkey]= redm
+            hcov[errorkey]= numpy.matrix( cov )
+            hredcov[errorkey]= numpy.matrix( redcov )
 
         # Build total full and reduced covariance matrices, reduced means
         # all errors except fully correlated (see above)
         totalcov= self.__makeZeroMatrix()
         redcov= self.__makeZeroMatrix()
         for errorkey in errorkeys:
-            redcov+= hredcov[errorkey]
+            if errorkey in hlowrank:
+                redcov+= numpy.diag( hlowrank[errorkey][2] )
+            else:
+                redcov+= hredcov[errorkey]
         for errorkey in errorkeys:
             covoption= self.__covopts[errorkey]
             if "fq" in covoption:
@@ -292,28 +576,76 @@ class AverageDataParser:
                 errors.shape= ( len( self.__inputs ), 1 )
                 relerrs= errors/values
                 avgerrs= numpy.multiply( gm*avg, relerrs )
-                cov= avgerrs*avgerrs.T
                 # Replace covariance matrix and systerrormatrix for this errorkey
-                hcov[errorkey]= cov
+                if errorkey in hlowrank:
+                    avgerrs= numpy.asarray( avgerrs ).ravel()
+                    hlowrank[errorkey]= ( avgerrs**2, avgerrs, 
+                                          hlowrank[errorkey][2] )
+                else:
+                    hcov[errorkey]= avgerrs*avgerrs.T
                 nerr= errorkeys.index( errorkey )
                 lerrors= [ avgerr.item() for avgerr in avgerrs ]
                 systerrormatrix[nerr]= lerrors
-            totalcov+= hcov[errorkey]
+            if errorkey in hlowrank:
+                totalcov+= self.__expandLowRank( hlowrank[errorkey] )
+            else:
+                totalcov+= hcov[errorkey]
             
         # Keep results as members:
         self.__hcov= hcov
         self.__hredcov= hredcov
+        self.__hlowrank= hlowrank
         self.__cov= totalcov
         self.__redcov= redcov
         self.__systerrormatrix= systerrormatrix
+        self.__lowrankcov= self.__makeTotalLowRankCovariance()
+        self.__freeze()
 
         return
 
+    # Arrays of the parser are read-only, such that one parser can be
+    # shared by several averages without copying the matrices:
+    def __freeze( self ):
+        arrays= [ self.__cov, self.__redcov ]
+        arrays+= list( self.__hcov.values() ) + list( self.__hredcov.values() )
+        for lowrank in self.__hlowrank.values():
+            arrays+= list( lowrank )
+        if self.__lowrankcov is not None:
+            arrays+= list( self.__lowrankcov )
+        if self.__correlations is not None:
+            arrays+= [ correlations for correlations in self.__correlations.values()
+                       if isinstance( correlations, numpy.ndarray ) ]
+        for array in arrays:
+            array.flags.writeable= False
+        return
+
+    # Total covariance matrix as diagonal plus low rank part when all
+    # error sources not kept in low rank form have diagonal covariance
+    # matrices, otherwise None:
+    def __makeTotalLowRankCovariance( self ):
+        if not self.__hlowrank:
+            return None
+        diagonal= numpy.zeros( len( self.__inputs ) )
+        for cov in self.__hcov.values():
+            variances= numpy.diag( cov )
+            if numpy.count_nonzero( cov - numpy.diag( variances ) ):
+                return None
+            diagonal+= variances
+        vectors= []
+        for errorkey in sorted( self.__hlowrank.keys() ):
+            lowrankdiagonal, vector, reddiagonal= self.__hlowrank[errorkey]
+            diagonal+= lowrankdiagonal - vector**2
+            vectors.append( vector )
+        return diagonal, numpy.column_stack( vectors )
+
     # Print inputs:
     def printInputs( self, keys=None ):
         if keys is None:
             keys= sorted( self.__errors.keys() )
-        print( "\n AverageDataParser: input from", self.__filename )
+        if self.__filename is None:
+            print( "\n AverageDataParser: input from data" )
+        else:
+            print( "\n AverageDataParser: input from", self.__filename )
         print( "\n Variables:", end= " " )
         for name in self.__names:
             print( "{0:>10s}".format( name ), end=" " )
@@ -351,16 +683,15 @@ class AverageDataParser:
             for key in keys:
                 print( "\n{0:s}:".format( stripLeadingDigits( key ) ) )
                 covopt= self.__covopts[key]
-                correlations= self.__correlations[key]
-                n= int( sqrt( len(correlations) ) )
+                n= len( self.__inputs )
+                correlations= numpy.reshape( self.__correlations[key], ( n, n ) )
                 for i in range(n):
                     for j in range(n):
-                        ii= i*n+j
                         if "c" in covopt:
-                            print( "{0:6.3f}".format( correlations[ii] ),
+                            print( "{0:6.3f}".format( correlations[i,j] ),
                                    end=" " )
                         else:
-                            print( correlations[ii], end=" " )
+                            print( correlations[i,j], end=" " )
                     print()
         return
 
@@ -372,7 +703,7 @@ class AverageDataParser:
     def getValues( self ):
         return list( self.__inputs )
     def getErrors( self ):
-        return dict( self.__errors )
+        return { key: list( errors ) for key, errors in self.__errors.items() }
     def getTotalErrors( self ):
         totalerrors= len( self.__inputs )*[0]
         for errors in self.__errors.values():
@@ -381,6 +712,8 @@ class AverageDataParser:
         for ierr in range( len( totalerrors ) ):
             totalerrors[ierr]= sqrt( totalerrors[ierr] )      
         return totalerrors
+    def getGlobals( self ):
+        return dict( self.__hglobals )
     def getCovoption( self ):
         return dict( self.__covopts )
     def getCorrelations( self ):
@@ -389,17 +722,37 @@ class AverageDataParser:
         else:
             return dict( self.__correlations )
     def getCovariances( self ):
+        hcov= dict( self.__hcov )
+        for errorkey, lowrank in self.__hlowrank.items():
+            hcov[errorkey]= numpy.matrix( self.__expandLowRank( lowrank ) )
+        return hcov
+    def getDenseCovariances( self ):
         return dict( self.__hcov )
+    def getLowRankCovariances( self ):
+        hlowrank= {}
+        for errorkey, lowrank in self.__hlowrank.items():
+            diagonal, vector, reddiagonal= lowrank
+            hlowrank[errorkey]= ( diagonal - vector**2, vector.copy() )
+        return hlowrank
+    def getTotalLowRankCovariance( self ):
+        if self.__lowrankcov is None:
+            return None
+        diagonal, vectors= self.__lowrankcov
+        return diagonal.copy(), vectors.copy()
     def getTotalCovariance( self ):
         return self.__cov.copy()
     def getGroups( self ):
         return list( self.__groups )
     def getGroupMatrix( self ):
-        return list( self.__groupmatrix )
+        return [ list( row ) for row in self.__groupmatrix ]
     def getSysterrorMatrix( self ):
-        return dict( self.__systerrormatrix )
+        return { nerr: list( systerrors ) 
+                 for nerr, systerrors in self.__systerrormatrix.items() }
     def getReducedCovariances( self ):
-        return dict( self.__hredcov )
+        hredcov= dict( self.__hredcov )
+        for errorkey, lowrank in self.__hlowrank.items():
+            hredcov[errorkey]= numpy.matrix( numpy.diag( lowrank[2] ) )
+        return hredcov
     def getTotalReducedCovariance( self ):
         return self.__redcov.copy()
     def getTotalReducedCovarianceAslist( self ):
@@ -8,8 +8,17 @@ import numpy
 from AverageTools import AverageDataParser
 from AverageTools.AverageDataParser import stripLeadingDigits
 from AverageTools.clsqAverage import Average
+from AverageTools.covarianceSolver import denseCovarianceSolver
+from AverageTools.covarianceSolver import lowRankCovarianceSolver
+from AverageTools.covarianceSolver import inverseCovarianceSolver
+from AverageTools.covarianceSolver import CovarianceError
+from AverageTools.covarianceSolver import solveLowerTriangular
 from math import sqrt
-from ROOT import TMath
+try:
+    from ROOT import TMath
+    chisqProb= TMath.Prob
+except ImportError:
+    from AverageTools.lmSolver import chisqProb
 
 
 class Blue( Average ):
@@ -22,41 +31,225 @@ class Blue( Average ):
         self.names= self.dataparser.getNames()
         self.covopts= self.dataparser.getCovoption()
         self.correlations= self.dataparser.getCorrelations()
-        self.hcov= self.dataparser.getCovariances()
-        self.cov= self.dataparser.getTotalCovariance()
-        self.inv= self.cov.getI()
+        self.hcov= None
+        self.hdensecov= self.dataparser.getDenseCovariances()
+        self.hlowrank= self.dataparser.getLowRankCovariances()
+        self.cov= None
+        self.__lowrankcov= self.dataparser.getTotalLowRankCovariance()
         self.groupmatrix= numpy.matrix( self.dataparser.getGroupMatrix() )
         self.data= self._columnVector( self.dataparser.getValues() )
         self.totalerrors= self._columnVector( self.dataparser.getTotalErrors() )
         return
 
+    # Covariance matrices of all error sources, low rank sources are
+    # expanded when first needed:
+    @property
+    def hcov( self ):
+        if self.__hcov is None:
+            self.__hcov= self.dataparser.getCovariances()
+        return self.__hcov
+    @hcov.setter
+    def hcov( self, hcov ):
+        self.__hcov= hcov
+        return
+
+    # Total covariance matrix, taken from the parser when first needed,
+    # a new matrix discards the solver, inverse and results of the 
+    # previous one:
+    @property
+    def cov( self ):
+        if self.__cov is None:
+            self.__cov= self.dataparser.getTotalCovariance()
+        return self.__cov
+    @cov.setter
+    def cov( self, cov ):
+        self.__cov= cov
+        if cov is not None:
+            self.__lowrankcov= None
+        self.__covsolver= None
+        self.__inv= None
+        self.__clearResults()
+        return
+
+    # Input values and group matrix, new ones discard the results.
+    # Assign new matrices instead of modifying them in place, in-place
+    # changes are not noticed:
+    @property
+    def data( self ):
+        return self.__data
+    @data.setter
+    def data( self, data ):
+        self.__data= data
+        self.__clearResults()
+        return
+    @property
+    def groupmatrix( self ):
+        return self.__groupmatrix
+    @groupmatrix.setter
+    def groupmatrix( self, groupmatrix ):
+        self.__groupmatrix= groupmatrix
+        self.__clearResults()
+        return
+
+    # Results are calculated once and kept until cov, data or 
+    # groupmatrix change:
+    def __clearResults( self ):
+        self.__results= {}
+        return
+    def __getResult( self, key, calculate ):
+        if not key in self.__results:
+            self.__results[key]= calculate()
+        return self.__results[key]
+
+    # Inverse of total covariance matrix, calculated when needed.  An
+    # assigned inverse is used for weights and chi^2 until a new 
+    # covariance matrix is assigned:
+    @property
+    def inv( self ):
+        if self.__inv is None:
+            self.__inv= numpy.matrix( self.__getCovSolver().getInverse() )
+        return self.__inv
+    @inv.setter
+    def inv( self, inv ):
+        self.__inv= inv
+        self.__covsolver= inverseCovarianceSolver( inv )
+        self.__clearResults()
+        return
+
+    # Solve cov*x = rhs with the Cholesky factor of the total covariance 
+    # matrix, or with the Woodbury identity when it is diagonal plus a 
+    # few fully correlated sources:
+    def __getCovSolver( self ):
+        if self.__covsolver is None:
+            lowrankcov= self.__lowrankcov
+            if( lowrankcov is not None and 
+                lowrankcov[1].shape[1] < lowrankcov[1].shape[0] and
+                numpy.all( lowrankcov[0] > 0.0 ) ):
+                self.__covsolver= lowRankCovarianceSolver( *lowrankcov )
+            else:
+                self.__covsolver= denseCovarianceSolver( self.cov )
+        return self.__covsolver
+    def _solveCov( self, rhs ):
+        solution= self.__getCovSolver().solve( rhs )
+        return numpy.matrix( solution )
+
+    # Covariance matrices of error sources are kept as given by the 
+    # parser, dense in hdensecov or as diagonal and vector in hlowrank, and
+    # are expanded only where a full matrix is needed:
+    def __getCovariance( self, key ):
+        if key in self.hlowrank:
+            diagonal, vector= self.hlowrank[key]
+            return numpy.diag( diagonal ) + numpy.outer( vector, vector )
+        return numpy.asarray( self.hdensecov[key] )
+    def __getVariances( self, key ):
+        if key in self.hlowrank:
+            diagonal, vector= self.hlowrank[key]
+            return diagonal + vector**2
+        return numpy.diag( self.hdensecov[key] )
+
+    # Covariance matrix W V W^T of the averages, from the low rank form
+    # of the total covariance matrix when available:
+    def __calcAverageCovariance( self, wm ):
+        if self.__lowrankcov is not None:
+            diagonal, vectors= self.__lowrankcov
+            wv= numpy.dot( wm, vectors )
+            return numpy.dot( wm*diagonal, wm.T ) + numpy.dot( wv, wv.T )
+        return numpy.dot( numpy.dot( wm, numpy.asarray( self.cov ) ), wm.T )
+
     # Calculate weights from inverse covariance matrix:
-    def calcWeightsMatrix( self ):
+    def __calcWeightsMatrix( self ):
         gm= self.groupmatrix
-        inv= self.inv
-        utvinvu= gm.getT()*inv*gm
-        utvinvuinv= utvinvu.getI()
-        wm= utvinvuinv*gm.getT()*inv
+        vinvu= self._solveCov( gm )
+        utvinvu= gm.getT()*vinvu
+        wm= numpy.matrix( numpy.linalg.solve( utvinvu, vinvu.getT() ) )
         return wm
+    def calcWeightsMatrix( self ):
+        wm= self.__getResult( "weights", self.__calcWeightsMatrix )
+        return wm.copy()
 
     # Calculate average from weights and input values:
-    def calcAverage( self ):
-        wm= self.calcWeightsMatrix()
+    def __calcAverage( self ):
+        wm= self.__getResult( "weights", self.__calcWeightsMatrix )
         v= self.data
         avg= wm*v
         return avg
+    def calcAverage( self ):
+        avg= self.__getResult( "average", self.__calcAverage )
+        return avg.copy()
     def _getAverage( self ):
         return self.calcAverage()
 
-    # Calculate chi^2:
-    def calcChisq( self ):
-        avg= self.calcAverage()
+    # Averages, errors and chi^2 for many sets of input values with 
+    # the same layout in one go, values has shape (nsets,nvalues) and
+    # covs, if given, has shape (nsets,nvalues,nvalues).  Without covs
+    # the total covariance matrix and its factorisation are shared by 
+    # all sets.  Returns arrays with averages and errors with shape 
+    # (nsets,naverages) and chi^2 with shape (nsets,):
+    def calcAverages( self, values, covs=None ):
+        values= numpy.atleast_2d( numpy.asarray( values, dtype=float ) )
+        gm= numpy.asarray( self.groupmatrix, dtype=float )
+        if covs is None:
+            wm= numpy.asarray( self.__getResult( "weights", 
+                                                 self.__calcWeightsMatrix ) )
+            averages= numpy.dot( values, wm.T )
+            avgcov= self.__calcAverageCovariance( wm )
+            errors= numpy.tile( numpy.sqrt( numpy.diag( avgcov ) ), 
+                                ( len( values ), 1 ) )
+            deltas= values - numpy.dot( averages, gm.T )
+            chisqs= self.__getCovSolver().calcChisqs( deltas.T )
+        else:
+            averages, errors, chisqs= self.__calcAveragesStacked( values, covs )
+        return averages, errors, chisqs
+
+    # Stacked covariance matrices, whiten group matrix and values with 
+    # the Cholesky factors L of all covariance matrices:
+    def __calcAveragesStacked( self, values, covs ):
+        covs= numpy.asarray( covs, dtype=float )
+        nsets, nvalues= values.shape
+        gm= numpy.asarray( self.groupmatrix, dtype=float )
+        navg= gm.shape[1]
+        try:
+            factors= numpy.linalg.cholesky( covs )
+        except numpy.linalg.LinAlgError:
+            raise CovarianceError( "Covariance matrix is not positive definite, check correlations and errors" )
+        rhs= numpy.empty( ( nsets, nvalues, navg+1 ) )
+        rhs[:,:,:navg]= gm
+        rhs[:,:,navg]= values
+        whitened= solveLowerTriangular( factors, rhs )
+        whitenedgm= whitened[:,:,:navg]
+        whitenedvalues= whitened[:,:,navg:]
+        utvinvu= numpy.matmul( whitenedgm.transpose( 0, 2, 1 ), whitenedgm )
+        utvinvv= numpy.matmul( whitenedgm.transpose( 0, 2, 1 ), whitenedvalues )
+        averages= numpy.linalg.solve( utvinvu, utvinvv )
+        avgcovs= numpy.linalg.inv( utvinvu )
+        errors= numpy.sqrt( numpy.diagonal( avgcovs, axis1=1, axis2=2 ) )
+        whitenedresiduals= whitenedvalues - numpy.matmul( whitenedgm, averages )
+        chisqs= numpy.sum( whitenedresiduals[:,:,0]**2, axis=1 )
+        return averages[:,:,0], errors, chisqs
+
+    # Calculate residuals and chi^2:
+    def __calcResiduals( self ):
+        avg= self.__getResult( "average", self.__calcAverage )
         v= self.data
         gm= self.groupmatrix
-        inv= self.inv
         delta= v - gm*avg
-        chisq= delta.getT()*inv*delta
-        return float( chisq )
+        return delta
+    def calcResiduals( self ):
+        delta= self.__getResult( "residuals", self.__calcResiduals )
+        return delta.copy()
+    def __calcChisq( self ):
+        delta= self.__getResult( "residuals", self.__calcResiduals )
+        chisq= self.__getCovSolver().calcChisq( delta )
+        return chisq
+    def calcChisq( self ):
+        return self.__getResult( "chisq", self.__calcChisq )
+
+    # Error composition from base class, calculated once:
+    def calcErrorComposition( self, wm=None ):
+        if wm is not None:
+            return Average.calcErrorComposition( self, wm )
+        return self.__getResult( "errors", 
+                                 lambda: Average.calcErrorComposition( self ) )
 
     # Print the input data:
     def __printMatrix( self, m, fmt="8.4f" ):
@@ -69,9 +262,9 @@ class Blue( Average ):
         self.dataparser.printInputs()
         if printcovopt:
             print( "\n Covariance matrices:" )
-            for key in sorted( self.hcov.keys() ):
+            for key in sorted( self.errors.keys() ):
                 print( "{0:>10s}:".format( stripLeadingDigits( key ) ) )
-                self.__printMatrix( self.hcov[key] )
+                self.__printMatrix( self.__getCovariance( key ) )
             print( "Total covariance:" )
             self.__printMatrix( self.cov )
             corr= numpy.matrix( self.cov )
@@ -93,7 +286,7 @@ class Blue( Average ):
         nvar= wm.shape[1]
         ndof= nvar - navg
         chisqdof= chisq/float(ndof)
-        pvalue= TMath.Prob( chisq, ndof )
+        pvalue= chisqProb( chisq, ndof )
         print( "\n Chi^2= {0:.2f} for {1:d} d.o.f, chi^2/d.o.f= {2:.2f}, P(chi^2)= {3:.4f}".format( chisq, ndof, chisqdof, pvalue ) )
         avg= self.calcAverage()
         print( "\n   Average:", end=" " )
@@ -104,56 +297,186 @@ class Blue( Average ):
         return
   
 
-    # Scan correlations between p and f:
-    def scanCorr( self, step ):
+    # Covariance matrices for correlation scans between "p" and "f":
+    # cov( factor ) = fixed + factor*delta for each error source, the
+    # fixed part is the "p" covariance for scanned elements and the 
+    # covariance from the input for all others, delta is "f" - "p" for
+    # scanned elements.  Scanned are sources with options "p" or "f"
+    # and "p" or "f" elements of sources with option "m":
+    def __makeScanCovariances( self ):
+        fixedcovs= {}
+        deltacovs= {}
+        for key in sorted( self.errors.keys() ):
+            err= numpy.array( self.errors[key], dtype=float )
+            ndim= len( err )
+            covoption= self.covopts[key]
+            if covoption in [ "p", "f" ]:
+                scan= ~numpy.eye( ndim, dtype=bool )
+            elif covoption == "m":
+                mcovopts= numpy.array( self.correlations[key], dtype=str )
+                mcovopts.shape= ( ndim, ndim )
+                scan= ( ( mcovopts == "p" ) | ( mcovopts == "f" ) ) & \
+                      ~numpy.eye( ndim, dtype=bool )
+            else:
+                scan= numpy.zeros( ( ndim, ndim ), dtype=bool )
+            if not numpy.any( scan ):
+                continue
+            pcov= numpy.minimum.outer( err, err )**2
+            fcov= numpy.outer( err, err )
+            fixedcovs[key]= numpy.where( scan, pcov, 
+                                         self.__getCovariance( key ) )
+            deltacovs[key]= numpy.where( scan, fcov - pcov, 0.0 )
+        return fixedcovs, deltacovs
 
-        herrors= self.dataparser.getErrors()
-        hcovopts= self.dataparser.getCovoption()
-        keys= herrors.keys()
-        self.cov= self.__makeZeroMatrix()
+    # Scan correlations between "p" (factor 0) and "f" (factor 1) for
+    # all grid points in one go, the Blue object is not modified.  
+    # factors has shape (npoints,) with the same factor for all scanned
+    # error sources, or (npoints,len(keys)) with one factor per source 
+    # in keys.  Sources not in keys keep their input covariances.  
+    # Returns averages and errors with shape (npoints,naverages), 
+    # weights with shape (npoints,naverages,nvalues) and chi^2 with 
+    # shape (npoints,):
+    def scanCorrelations( self, factors, keys=None ):
+        fixedcovs, deltacovs= self.__makeScanCovariances()
+        if keys is None:
+            keys= sorted( deltacovs.keys() )
         for key in keys:
-            covoption= hcovopts[key]
-            errors= herrors[key] 
-            lcov= []
-            iderr1= 0
-            for err1 in errors:
-                iderr1+= 1
-                iderr2= 0
-                for err2 in errors:
-                    iderr2+= 1
-                    if covoption == "f" or covoption == "p":
-                        if iderr1 == iderr2:
-                            lcov.append( err1**2 )
-                        else:
-                            errminsq= min( err1, err2 )**2
-                            lcov.append( errminsq+(err1*err2-errminsq)*step )
-                    elif covoption == "u":
-                        if iderr1 == iderr2:
-                            lcov.append( err1**2 )
-                        else:
-                            lcov.append( 0.0 )
-                    elif covoption == "m":
-                        idx= len( lcov )
-                        mcovopts= self.dataparser.correlations[key]
-                        mcovopt= mcovopts[idx]
-                        if mcovopt == "f" or mcovopt == "p":
-                            if iderr1 == iderr2:
-                                lcov.append( err1**2 )
-                            else:
-                                errminsq= min( err1, err2 )**2
-                                lcov.append( errminsq+(err1*err2-errminsq)*step )
-                        elif mcovopt == "u":
-                            if iderr1 == iderr2:
-                                lcov.append( err1**2 )
-                            else:
-                                lcov.append( 0.0 )
-            m= self.__makeMatrixFromList( lcov )
-            self.cov+= m
-            self.hcov[key]= m
-        # Inverse and weights:
-        self.inv= self.cov.getI()
-        weights= self.calcWeights()
-        print( "Weights:", weights )
-        return 
+            if not key in deltacovs:
+                raise RuntimeError( "Error source", key, "can not be scanned" )
+        factors= numpy.asarray( factors, dtype=float )
+        if factors.ndim == 1:
+            factors= numpy.repeat( factors[:,numpy.newaxis], len( keys ), 
+                                   axis=1 )
+        fixedcov= numpy.asarray( self.cov, dtype=float ).copy()
+        for key in keys:
+            fixedcov+= fixedcovs[key] - self.__getCovariance( key )
+        deltacov= numpy.array( [ deltacovs[key] for key in keys ] )
+        covs= fixedcov + numpy.einsum( "pk,kij->pij", factors, deltacov )
+        return self.__calcScanResults( covs )
+
+    # Weights, averages, errors and chi^2 for stacked covariance matrices:
+    def __calcScanResults( self, covs ):
+        gm= numpy.asarray( self.groupmatrix, dtype=float )
+        values= numpy.asarray( self.data, dtype=float )[:,0]
+        try:
+            factors= numpy.linalg.cholesky( covs )
+        except numpy.linalg.LinAlgError:
+            raise CovarianceError( "Covariance matrix is not positive definite, check correlations and errors" )
+        whitenedgm= solveLowerTriangular( factors, gm )
+        vinvu= solveLowerTriangular( factors, whitenedgm, ltrans=True )
+        utvinvu= numpy.matmul( gm.T, vinvu )
+        weights= numpy.linalg.solve( utvinvu, vinvu.transpose( 0, 2, 1 ) )
+        averages= numpy.matmul( weights, values )
+        errors= numpy.sqrt( numpy.diagonal( numpy.linalg.inv( utvinvu ), 
+                                            axis1=1, axis2=2 ) )
+        residuals= values - numpy.matmul( averages, gm.T )
+        whitenedresiduals= solveLowerTriangular( factors, 
+                                                 residuals[:,:,numpy.newaxis] )
+        chisqs= numpy.sum( whitenedresiduals[:,:,0]**2, axis=1 )
+        return averages, errors, weights, chisqs
 
+    # Weights, V^-1 r and errors of averages for derivatives:
+    def __calcDerivativeInputs( self ):
+        wm= numpy.asarray( self.__getResult( "weights", 
+                                             self.__calcWeightsMatrix ) )
+        residuals= self.__getResult( "residuals", self.__calcResiduals )
+        vinvr= numpy.asarray( self._solveCov( residuals ) )[:,0]
+        errors= numpy.sqrt( numpy.diag( self.__calcAverageCovariance( wm ) ) )
+        return wm, vinvr, errors
+
+    # Derivatives of averages and errors w.r.t. covariance matrix
+    # changes dcovs with shape (nchanges,nvalues,nvalues), from 
+    # W = (U^T V^-1 U)^-1 U^T V^-1 follows d avg = -W dV V^-1 r with
+    # residuals r and d C = W dV W^T for the covariance C of the 
+    # averages, the errors change by diag( d C )/( 2 error ):
+    def __calcCovDerivatives( self, dcovs ):
+        wm, vinvr, errors= self.__calcDerivativeInputs()
+        davg= -numpy.einsum( "ai,kij,j->ka", wm, dcovs, vinvr )
+        derr= numpy.einsum( "ai,kij,aj->ka", wm, dcovs, wm )/( 2.0*errors )
+        return davg, derr
+
+    # Derivatives of averages and errors w.r.t. the correlation 
+    # coefficients rho_ij = V_ij/( e_i e_j ) of each error source.
+    # Returns a dict with the error source keys and tuples with the
+    # derivatives w.r.t. rho_ij as arrays (naverages,nvalues,nvalues):
+    def calcCorrelationDerivatives( self ):
+        wm, vinvr, errors= self.__calcDerivativeInputs()
+        keys= sorted( self.errors.keys() )
+        ndim= wm.shape[1]
+        offdiagonal= ~numpy.eye( ndim, dtype=bool )
+        sourceerrors= numpy.sqrt( numpy.array( [ self.__getVariances( key ) 
+                                                 for key in keys ] ) )
+        errprods= numpy.einsum( "ki,kj->kij", sourceerrors, 
+                                sourceerrors )*offdiagonal
+        wvinvr= numpy.einsum( "ai,j->aij", wm, vinvr )
+        wmwm= numpy.einsum( "ai,aj->aij", wm, wm )
+        davgs= -( wvinvr + wvinvr.transpose( 0, 2, 1 ) )*errprods[:,numpy.newaxis]
+        derrs= wmwm*errprods[:,numpy.newaxis]/errors[:,numpy.newaxis,numpy.newaxis]
+        hderivatives= {}
+        for ikey, key in enumerate( keys ):
+            hderivatives[key]= ( davgs[ikey], derrs[ikey] )
+        return hderivatives
+
+    # Same for changes dV = v v^T - diag( v^2 ) of the off-diagonal 
+    # elements of low rank covariance matrices with vectors v with 
+    # shape (nchanges,nvalues), without dense matrices:
+    def __calcLowRankDerivatives( self, vectors ):
+        wm, vinvr, errors= self.__calcDerivativeInputs()
+        wv= numpy.dot( vectors, wm.T )
+        davg= -( wv*numpy.dot( vectors, vinvr )[:,numpy.newaxis] - 
+                 numpy.dot( vectors**2*vinvr, wm.T ) )
+        derr= ( wv**2 - numpy.dot( vectors**2, ( wm**2 ).T ) )/( 2.0*errors )
+        return davg, derr
+
+    # Derivatives of averages and errors w.r.t. a common scale factor
+    # of all correlations of each error source.  Returns a dict with
+    # the error source keys and tuples with arrays (naverages,):
+    def calcCorrelationScaleDerivatives( self ):
+        hderivatives= {}
+        keys= sorted( self.hdensecov.keys() )
+        if len( keys ) > 0:
+            ndim= len( self.data )
+            offdiagonal= ~numpy.eye( ndim, dtype=bool )
+            dcovs= numpy.array( [ numpy.asarray( self.hdensecov[key] )*
+                                  offdiagonal for key in keys ] )
+            davgs, derrs= self.__calcCovDerivatives( dcovs )
+            for ikey, key in enumerate( keys ):
+                hderivatives[key]= ( davgs[ikey], derrs[ikey] )
+        keys= sorted( self.hlowrank.keys() )
+        if len( keys ) > 0:
+            vectors= numpy.array( [ self.hlowrank[key][1] for key in keys ] )
+            davgs, derrs= self.__calcLowRankDerivatives( vectors )
+            for ikey, key in enumerate( keys ):
+                hderivatives[key]= ( davgs[ikey], derrs[ikey] )
+        return hderivatives
+
+    # Derivatives of averages and errors w.r.t. correlationfactor from
+    # [Globals], the off-diagonal elements of the covariance matrices 
+    # are proportional to it.  Covariance matrices of "fq" sources are
+    # calculated from the reduced covariance matrix and do not depend
+    # on it.  Without correlationfactor w.r.t. a common scale factor of 
+    # all correlations.  Returns arrays (naverages,):
+    def calcCorrelationFactorDerivatives( self ):
+        ndim= len( self.data )
+        offdiagonal= ~numpy.eye( ndim, dtype=bool )
+        hglobals= self.dataparser.getGlobals()
+        if "correlationfactor" in hglobals:
+            corrfac= hglobals["correlationfactor"]
+            if corrfac == 0.0:
+                raise RuntimeError( "Derivative w.r.t. correlationfactor 0 not available" )
+            dcov= numpy.zeros( ( ndim, ndim ) )
+            for key in sorted( self.errors.keys() ):
+                if not "fq" in self.covopts[key]:
+                    dcov+= self.__getCovariance( key )
+            dcov= dcov*offdiagonal/corrfac
+        else:
+            dcov= numpy.asarray( self.cov )*offdiagonal
+        davgs, derrs= self.__calcCovDerivatives( dcov[numpy.newaxis] )
+        return davgs[0], derrs[0]
+
+    # Print weights for one step of a correlation scan:
+    def scanCorr( self, step ):
+        averages, errors, weights, chisqs= self.scanCorrelations( [ step ] )
+        print( "Weights:", weights[0] )
+        return
 
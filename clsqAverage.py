@@ -2,18 +2,44 @@
 from AverageTools.AverageDataParser import AverageDataParser
 from AverageTools.AverageDataParser import stripLeadingDigits
 from AverageTools.minuitSolver import minuitSolver
+from AverageTools.lmSolver import lmSolver
+from AverageTools.covarianceSolver import denseCovarianceSolver
 from ConstrainedFit import clsq
 from math import sqrt, exp
-from numpy import matrix, zeros
+from numpy import matrix, zeros, array, atleast_2d
+from numpy import dot, outer, matmul, diagonal
+import numpy
+import functools
+import warnings
+from concurrent.futures import ProcessPoolExecutor
 
 
 class Average:
 
-    # C-tor, setup parser, covariances and weights:
+    # C-tor, setup parser, covariances and weights, filename can also be 
+    # an AverageDataParser, e.g. from AverageDataParser.fromData.  The
+    # parser is read-only and can be shared by several averages, inputs
+    # and covariances are then read and calculated once, llogNormal is 
+    # taken from the parser:
     def __init__( self, filename, llogNormal=False ):
-        self.__dataparser= AverageDataParser( filename, llogNormal )
+        if isinstance( filename, AverageDataParser ):
+            self.__dataparser= filename
+        else:
+            self.__dataparser= AverageDataParser( filename, llogNormal )
         return
 
+    # Average from python objects instead of an input file, see 
+    # AverageDataParser.fromData, kwargs are passed to the c-tor:
+    @classmethod
+    def fromData( cls, names, values, errors, covoptions, correlations=None,
+                  groups=None, rvalues=None, globalvalues=None, 
+                  llogNormal=False, **kwargs ):
+        dataparser= AverageDataParser.fromData( names, values, errors, 
+                                                covoptions, correlations,
+                                                groups, rvalues, globalvalues,
+                                                llogNormal )
+        return cls( dataparser, **kwargs )
+
     def printInputs( self ):
         self.__dataparser.printInputs()
         return
@@ -29,61 +55,109 @@ class Average:
 
     def __makeZeroMatrix( self, ndim ):
         return matrix( zeros(shape=(ndim,ndim)) )
+
+    # Error composition W C_k W^T for all error sources k in one go, 
+    # dense covariance matrices are stacked, low rank ones contribute 
+    # W D W^T + ( W v )( W v )^T:
+    def calcErrorComposition( self, wm=None ):
+        if wm is None:
+            wm= self.calcWeightsMatrix()
+        wm= array( wm, dtype=float )
+        hdensecov= self.__dataparser.getDenseCovariances()
+        hlowrank= self.__dataparser.getLowRankCovariances()
+        keys= sorted( list( hdensecov.keys() ) + list( hlowrank.keys() ) )
+        navg= wm.shape[0]
+        covariances= zeros( shape=(len(keys),navg,navg) )
+        densekeys= sorted( hdensecov.keys() )
+        if len( densekeys ) > 0:
+            densecovs= array( [ hdensecov[key] for key in densekeys ], 
+                              dtype=float )
+            densecovariances= matmul( matmul( wm, densecovs ), wm.T )
+            for key, covariance in zip( densekeys, densecovariances ):
+                covariances[keys.index( key )]= covariance
+        for key in sorted( hlowrank.keys() ):
+            lowrankdiagonal, vector= hlowrank[key]
+            wmvector= dot( wm, vector )
+            covariances[keys.index( key )]= ( dot( wm*lowrankdiagonal, wm.T ) + 
+                                              outer( wmvector, wmvector ) )
+        return ErrorComposition( keys, covariances, wm )
+
+    # Error composition as dict of matrices with keys for error sources, 
+    # "syst", "total", "totalcov" and "systcov":
     def errorAnalysis( self ):
-        hcov= self.__dataparser.getCovariances()
-        totcov= self.__dataparser.getTotalCovariance()
-        weightsmatrix= self.calcWeightsMatrix()
-        navg= weightsmatrix.shape[0]
-        nvar= weightsmatrix.shape[1]
-        systerr= self.__makeZeroMatrix( navg )
-        toterr= self.__makeZeroMatrix( navg )
-        systcov= self.__makeZeroMatrix( nvar )
+        composition= self.calcErrorComposition()
         errors= {}
-        for errorkey in sorted( hcov.keys() ):
-            cov= hcov[errorkey]
-            error= weightsmatrix*cov*weightsmatrix.getT()
-            errors[errorkey]= error
-            toterr+= error
-            if not "stat" in errorkey:
-                systerr+= error
-                systcov+= cov
-        errors["totalcov"]= toterr
-        errors["syst"]= systerr
-        toterr= weightsmatrix*totcov*weightsmatrix.getT()
-        errors["total"]= toterr
-        systerr= weightsmatrix*systcov*weightsmatrix.getT()
-        errors["systcov"]= systerr
-        return errors, weightsmatrix
-
+        for key, covariance in zip( composition.keys, 
+                                    composition.covariances ):
+            errors[key]= matrix( covariance )
+        errors["syst"]= matrix( composition.systcov )
+        errors["systcov"]= matrix( composition.systcov )
+        errors["total"]= matrix( composition.totalcov )
+        errors["totalcov"]= matrix( composition.totalcov )
+        return errors, matrix( composition.weights )
+
+    # Information I_a = 1/sigma_a^2 of the averages a and the sums over
+    # i < j of its derivatives -2 I_a w_ai w_aj C_k,ij w.r.t. the 
+    # correlations of values i and j for each error source k.  The sums
+    # are -I_a ( w_a^T C_k w_a - sum_i w_ai^2 C_k,ii ) with w_a^T C_k w_a
+    # from the error composition, infosums has shape (nkeys,navg):
+    def calcInformation( self, wm=None ):
+        if wm is None:
+            wm= self.calcWeightsMatrix()
+        composition= self.calcErrorComposition( wm )
+        wm= composition.weights
+        information= 1.0/diagonal( composition.totalcov )
+        hdensecov= self.__dataparser.getDenseCovariances()
+        hlowrank= self.__dataparser.getLowRankCovariances()
+        variances= zeros( shape=(len(composition.keys),wm.shape[1]) )
+        for ikey, key in enumerate( composition.keys ):
+            if key in hlowrank:
+                lowrankdiagonal, vector= hlowrank[key]
+                variances[ikey]= lowrankdiagonal + vector**2
+            else:
+                variances[ikey]= diagonal( array( hdensecov[key], 
+                                                  dtype=float ) )
+        wmcovwm= diagonal( composition.covariances, axis1=1, axis2=2 )
+        infosums= -information*( wmcovwm - dot( variances, ( wm**2 ).T ) )
+        return composition.keys, information, infosums
+
+    # Information derivatives per error source and "total" and sums of
+    # offdiagonal derivatives per error source, for a single average 
+    # as matrices and floats, for several averages as arrays with the
+    # averages as first index.  Low rank covariance matrices are 
+    # expanded for one error source at a time:
     def informationAnalysis( self, wm=None ):
         if wm is None:
             wm= self.calcWeightsMatrix()
-        nvar= wm.shape[1]
-        wml= [ w for w in wm.flat ]
-        wmtranspose= wm.getT()
-        hcov= self.__dataparser.getCovariances()
-        summ= self.__makeZeroMatrix( nvar )
-        for key in hcov.keys():
-            summ+= hcov[key]
-        Information= wm*summ*wmtranspose
-        Information= 1.0/Information
+        keys, information, infosums= self.calcInformation( wm )
+        wm= array( wm, dtype=float )
+        hdensecov= self.__dataparser.getDenseCovariances()
+        hlowrank= self.__dataparser.getLowRankCovariances()
+        navg, nvar= wm.shape
+        newaxis= numpy.newaxis
+        infoweights= -2.0*( information[:,newaxis,newaxis]*
+                            wm[:,:,newaxis]*wm[:,newaxis,:] )
         hinfos= {}
         hinfosums= {}
-        totalinfom= self.__makeZeroMatrix( nvar )
-        for key in hcov.keys():
-            infom= self.__makeZeroMatrix( nvar )
-            covv= hcov[key]
-            infosum= 0.0
-            for i in range( nvar ):
-                for j in range( nvar ):
-                    info= -2.0*Information*wml[i]*wml[j]*covv[i,j]
-                    infom[i,j]= info
-                    if j > i:
-                        infosum+= info
+        totalinfom= zeros( shape=(navg,nvar,nvar) )
+        for key, infosum in zip( keys, infosums ):
+            if key in hlowrank:
+                lowrankdiagonal, vector= hlowrank[key]
+                cov= numpy.diag( lowrankdiagonal ) + outer( vector, vector )
+            else:
+                cov= array( hdensecov[key], dtype=float )
+            infom= infoweights*cov
             totalinfom+= infom
-            hinfos[key]= infom
-            hinfosums[key]= float( infosum )
-        hinfos["total"]= totalinfom
+            if navg == 1:
+                hinfos[key]= matrix( infom[0] )
+                hinfosums[key]= float( infosum[0] )
+            else:
+                hinfos[key]= infom
+                hinfosums[key]= infosum
+        if navg == 1:
+            hinfos["total"]= matrix( totalinfom[0] )
+        else:
+            hinfos["total"]= totalinfom
         return hinfos, hinfosums
 
     def printErrorsAndWeights( self, optinfo=False ):
@@ -91,7 +165,7 @@ class Average:
         navg= weightsmatrix.shape[0]
         nval= weightsmatrix.shape[1]
         print( "Error composition:" )
-        if optinfo and navg == 1:
+        if optinfo:
             print( "            +/- errors   dI/df/I offd. sums" )
             hinfos, hinfosums= self.informationAnalysis( weightsmatrix )
         errorkeys= sorted( errors.keys() )
@@ -104,10 +178,14 @@ class Average:
                 error= errors[errorkey]
                 print( "{0:10.4f}".format( sqrt(error[iavg,iavg]) ),
                        end=" " )
-                if navg == 1 and optinfo and not ( "syst" in errorkey or
-                                                   "total" in errorkey ):
-                    print( "{0:9.3f}".format( hinfosums[errorkey] ),
-                           end=" " )
+                if optinfo and not ( "syst" in errorkey or
+                                     "total" in errorkey ):
+                    infosum= hinfosums[errorkey]
+                    if navg > 1:
+                        infosum= infosum[iavg]
+                    print( "{0:9.3f}".format( infosum ), end=" " )
+                elif optinfo and navg > 1 and iavg < navg-1:
+                    print( "         ", end=" " )
             print()
         names= self.__dataparser.getNames()
         print( "\n Variables:", end=" " )
@@ -188,46 +266,235 @@ class Average:
         return pulls
 
 
+# Error composition of averages, covariances W C_k W^T of the averages 
+# for each error source k with shape (nkeys,navg,navg), their sums for 
+# statistical ("stat" in the key), systematic and all error sources 
+# and the weights:
+class ErrorComposition:
+
+    def __init__( self, keys, covariances, weights ):
+        self.keys= list( keys )
+        self.covariances= covariances
+        self.weights= weights
+        stat= array( [ "stat" in key for key in self.keys ], dtype=bool )
+        self.statcov= covariances[stat].sum( axis=0 )
+        self.systcov= covariances[~stat].sum( axis=0 )
+        self.totalcov= covariances.sum( axis=0 )
+        return
+
+    # Errors of averages for each error source with shape (nkeys,navg):
+    def getErrors( self ):
+        return numpy.sqrt( diagonal( self.covariances, axis1=1, axis2=2 ) )
+    def getStatErrors( self ):
+        return numpy.sqrt( diagonal( self.statcov ) )
+    def getSystErrors( self ):
+        return numpy.sqrt( diagonal( self.systcov ) )
+    def getTotalErrors( self ):
+        return numpy.sqrt( diagonal( self.totalcov ) )
+
+
+# Each worker process for numerical weights keeps its own copy of the
+# average and its solver, TMinuit is not re-entrant.  With the fork 
+# start method the workers inherit the average and its solver from 
+# the parent, with spawn or forkserver the average is unpickled once 
+# per worker and creates its solver then.  Either way each worker 
+# keeps one solver and resets it for each fit:
+_workerfitaverage= None
+def _initWeightsWorker( fitaverage ):
+    global _workerfitaverage
+    _workerfitaverage= fitaverage
+    return
+def _calcWorkerWeightsRow( args ):
+    return _workerfitaverage._calcWeightsRow( *args )
+
+
 class FitAverage( Average ):
 
-    def __init__( self, filename, llognormal=False ):
+    # Keep constructor arguments, the solvers can not be pickled and
+    # are recreated from these in other processes.  Settings made after
+    # construction, analytic weights and the input values of the
+    # solver, are passed as state:
+    def __new__( cls, *args, **kwargs ):
+        fitaverage= super().__new__( cls )
+        fitaverage.__ctorargs= ( args, kwargs )
+        return fitaverage
+    def __reduce__( self ):
+        args, kwargs= self.__ctorargs
+        state= { "lAnalyticWeights": self.__lAnalyticWeights,
+                 "solverdata": array( self._getSolverData(), 
+                                      dtype=float ).ravel().tolist() }
+        return ( functools.partial( self.__class__, **kwargs ), args, state )
+    def __setstate__( self, state ):
+        self.setAnalyticWeights( state["lAnalyticWeights"] )
+        solverdata= self._getSolverData()
+        for ival, value in enumerate( state["solverdata"] ):
+            solverdata[ival]= value
+        return
+
+    # With lMergeNuisances pseudo-parameters with the same pattern of
+    # systematic errors are merged into one:
+    def __init__( self, filename, llognormal=False, lMergeNuisances=False ):
         Average.__init__( self, filename, llognormal )
+        self.__lMergeNuisances= lMergeNuisances
         self.__data= self._getDataparser().getValues()
+        self.__lAnalyticWeights= False
+        self.__solutionkey= None
+        self.__lSolved= False
+        self.__lStartValues= False
+        self.__weightscache= None
         self.__solver= self.__setupSolver()
         return
 
     def runSolver( self ):
-        self.__solver.solve()
+        self._getAverage()
         return
 
     def _getSolverData( self ):
         return self.__solver.getDatav()
 
-    def _getAverage( self ):
+    # Run the solver, subclasses may pass options:
+    def _solve( self ):
         self.__solver.solve()
+        return
+
+    # The solution is kept until the solver data change, a new fit
+    # starts from the previous minimum unless start values were set:
+    def __getSolutionKey( self ):
+        return array( self._getSolverData(), dtype=float ).tobytes()
+    def _getAverage( self ):
+        solutionkey= self.__getSolutionKey()
+        if solutionkey != self.__solutionkey:
+            if( self.__lSolved and not self.__lStartValues and
+                isinstance( self.__solver, ( minuitSolver, lmSolver ) ) ):
+                self.__solver.setStartValues( self.__solver.getPars() )
+            self._solve()
+            self.__solutionkey= solutionkey
+            self.__lSolved= True
+            self.__lStartValues= False
         return self.__solver.getUparv()
-    
-    def calcWeightsMatrix( self, scf=10.0 ):
-        dataparser= self._getDataparser()
-        totalerrors= dataparser.getTotalErrors()
-        data= self.__data
-        weights= []
+
+    # Averages, errors and chi^2 for many sets of input values, one
+    # fit per set, same interface as Blue.calcAverages:
+    def calcAverages( self, values ):
+        values= atleast_2d( array( values, dtype=float ) )
+        navg= len( self._getDataparser().getGroupMatrix()[0] )
         solverdata= self._getSolverData()
+        data= self.__data
+        averages= []
+        errors= []
+        chisqs= []
+        for setvalues in values:
+            for ival in range( len( data ) ):
+                solverdata[ival]= setvalues[ival]
+            averages.append( [ item for item in self._getAverage().flat ] )
+            errors.append( self.__solver.getParErrors()[:navg] )
+            chisqs.append( self.__solver.getChisq() )
         for ival in range( len( data ) ):
-            solverdata[ival]= data[ival] + 0.5*totalerrors[ival]/scf
-            avhi= self._getAverage()
-            solverdata[ival]= data[ival] - 0.5*totalerrors[ival]/scf
-            avlo= self._getAverage()
-            delta= (avhi-avlo)/totalerrors[ival]*scf
-            weightsrow= [ item for item in delta.flat ]
-            weights.append( weightsrow )
             solverdata[ival]= data[ival]
+        return array( averages ), array( errors ), array( chisqs )
+    
+    # Weights from derivatives of the averages w.r.t. the input values,
+    # analytic for linear models when enabled with setAnalyticWeights,
+    # else numerical with 2 n fits:
+    def setAnalyticWeights( self, lAnalytic=True ):
+        self.__lAnalyticWeights= lAnalytic
+        return
+    def calcWeightsMatrix( self, scf=10.0, nprocs=1 ):
+        weightskey= ( self.__getSolutionKey(), scf, self.__lAnalyticWeights )
+        if self.__weightscache is None or self.__weightscache[0] != weightskey:
+            if self.__lAnalyticWeights and self._isLinearModel():
+                wm= self.__calcAnalyticWeightsMatrix()
+            else:
+                wm= self.__calcNumericalWeightsMatrix( scf, nprocs )
+            self.__weightscache= ( weightskey, wm )
+        return self.__weightscache[1].copy()
+
+    # Models are linear in the fit parameters unless relative errors 
+    # ("r" options) enter the constraints of correlated systematics:
+    def _isLinearModel( self ):
+        hcovopt= self._getDataparser().getCovoption()
+        for ierr in self.__parindexmaps.keys():
+            if "r" in hcovopt[self.__errorkeys[ierr]]:
+                return False
+        return True
+
+    # For linear models the input values are described by M p with 
+    # parameters p, the averages and the pseudo-parameters for 
+    # correlated systematics, and M = ( U | S ).  With the reduced 
+    # covariance matrix V_r of the input values and the unit constraints
+    # of the pseudo-parameters P = diag( 0, 1 ) the chi^2 minimum is 
+    # at p = ( M^T V_r^-1 M + P )^-1 M^T V_r^-1 v, the weights are the 
+    # rows for the averages of this matrix.  No fit is needed:
+    def __calcAnalyticWeightsMatrix( self ):
+        dataparser= self._getDataparser()
+        gm= array( dataparser.getGroupMatrix(), dtype=float )
+        ndata, navg= gm.shape
+        nextrapar= self.__nextrapar
+        systmatrix= zeros( shape=(ndata,nextrapar) )
+        for ierr, indxmap in self.__parindexmaps.items():
+            for ival, iextrapar in indxmap.items():
+                systmatrix[ival,iextrapar]-= self.__systerrormatrix[ierr][ival]
+        design= numpy.hstack( [ gm, systmatrix ] )
+        redcov= dataparser.getTotalReducedCovariance()
+        vinvm= denseCovarianceSolver( redcov ).solve( design )
+        normal= dot( design.T, vinvm )
+        normal[navg:,navg:]+= numpy.eye( nextrapar )
+        weights= numpy.linalg.solve( normal, vinvm.T )[:navg]
+        return matrix( weights )
+
+    # Numerical weights, all perturbed fits start from the central 
+    # solution.  With nprocs > 1 the fits for each input value run in a 
+    # pool of processes with their own copies of the average and its 
+    # solver, the results are the same as without:
+    def __calcNumericalWeightsMatrix( self, scf, nprocs ):
+        ndata= len( self.__data )
+        self._getAverage()
+        startvalues= self.__solver.getPars()
+        rowargs= [ ( ival, scf, startvalues ) for ival in range( ndata ) ]
+        if nprocs > 1:
+            with ProcessPoolExecutor( max_workers=nprocs,
+                                      initializer=_initWeightsWorker,
+                                      initargs=( self, ) ) as pool:
+                weights= list( pool.map( _calcWorkerWeightsRow, rowargs ) )
+        else:
+            weights= [ self._calcWeightsRow( *args ) for args in rowargs ]
+        # The solver has the last perturbed solution, the central one
+        # is found again when needed:
         wm= matrix( weights )
         wm= wm.getT()
         return wm
+    def _calcWeightsRow( self, ival, scf, startvalues ):
+        dataparser= self._getDataparser()
+        totalerrors= dataparser.getTotalErrors()
+        data= self.__data
+        averages= []
+        for sign in [ 1.0, -1.0 ]:
+            self._setStartValues( startvalues )
+            solverdata= self._getSolverData()
+            solverdata[ival]= data[ival] + sign*0.5*totalerrors[ival]/scf
+            averages.append( self._getAverage() )
+            solverdata[ival]= data[ival]
+        avhi, avlo= averages
+        delta= (avhi-avlo)/totalerrors[ival]*scf
+        weightsrow= [ item for item in delta.flat ]
+        return weightsrow
+
+    # Start values for the next fit, the minuit and lm solvers take them 
+    # for all parameters, clsq solvers are reset to start at the given 
+    # averages:
+    def _setStartValues( self, pars ):
+        if isinstance( self.__solver, ( minuitSolver, lmSolver ) ):
+            self.__solver.setStartValues( pars )
+        else:
+            navg= len( self._getDataparser().getGroupMatrix()[0] )
+            self.__solver.setStartValues( pars[:navg] )
+        self.__solutionkey= None
+        self.__lStartValues= True
+        return
 
     def printResults( self, ffmt=".4f", cov=False, corr=False ):
-        if isinstance( self.__solver, minuitSolver ):
+        self._getAverage()
+        if isinstance( self.__solver, ( minuitSolver, lmSolver ) ):
             self.__solver.printResults( ffmt=ffmt, cov=cov, corr=corr )
         elif isinstance( self.__solver, clsq.clsqSolver ):
             ca= clsq.clsqAnalysis( self.__solver )
@@ -236,6 +503,7 @@ class FitAverage( Average ):
         return
 
     def getAveragesAndErrors( self ):
+        self._getAverage()
         return self.__solver.getPars(), self.__solver.getParErrors()
 
     def getSolver( self ):
@@ -307,6 +575,74 @@ class FitAverage( Average ):
 
         return extrapars, extraparerrors, extraparnames, parindxmaps, errorkeys
 
+    # Pseudo-parameters of additive error sources with proportional
+    # systematic errors s_i = c_i v over the measurements act as one, 
+    # the sum of the terms has a gaussian constraint with width 
+    # sqrt( sum c_i^2 ).  Each group is replaced by its first member 
+    # with systematic errors scaled accordingly.  Additive terms are 
+    # divided by relative terms of later error sources, only sources 
+    # not separated by relative ones are merged:
+    def _isMergeable( self, errorkey ):
+        return not "r" in self._getDataparser().getCovoption()[errorkey]
+    def __mergeExtraPars( self, extrapars, extraparerrors, extraparnames, 
+                          parindexmaps, errorkeys, systerrormatrix ):
+        ndata= len( self.__data )
+        nextrapar= len( extrapars )
+        patterns= numpy.zeros( shape=(nextrapar,ndata) )
+        for ierr, indxmap in parindexmaps.items():
+            for ival, iextrapar in indxmap.items():
+                patterns[iextrapar,ival]= systerrormatrix[ierr][ival]
+        mergeable= numpy.zeros( nextrapar, dtype=bool )
+        segments= numpy.zeros( nextrapar, dtype=int )
+        nrelative= 0
+        for ierr, errorkey in enumerate( errorkeys ):
+            if not self._isMergeable( errorkey ):
+                nrelative+= 1
+            if ierr in parindexmaps:
+                for iextrapar in set( parindexmaps[ierr].values() ):
+                    mergeable[iextrapar]= self._isMergeable( errorkey )
+                    segments[iextrapar]= nrelative
+        norms= numpy.sqrt( numpy.sum( patterns**2, axis=1 ) )
+        groups= {}
+        targets= list( range( nextrapar ) )
+        for iextrapar in range( nextrapar ):
+            if not mergeable[iextrapar] or norms[iextrapar] == 0.0:
+                continue
+            unit= patterns[iextrapar]/norms[iextrapar]
+            unit*= numpy.sign( unit[numpy.flatnonzero( unit )[0]] )
+            key= ( segments[iextrapar], tuple( numpy.round( unit, 10 ) ) )
+            if key in groups:
+                targets[iextrapar]= groups[key]
+            else:
+                groups[key]= iextrapar
+        targets= numpy.array( targets, dtype=int )
+        kept= numpy.flatnonzero( targets == numpy.arange( nextrapar ) )
+        newindices= numpy.zeros( nextrapar, dtype=int )
+        newindices[kept]= numpy.arange( len( kept ) )
+        mergednorms= numpy.sqrt( numpy.bincount( targets, weights=norms**2,
+                                                 minlength=nextrapar ) )
+        mergedsysterrormatrix= dict( systerrormatrix )
+        mergedparindexmaps= {}
+        for ierr, indxmap in parindexmaps.items():
+            mergedindxmap= {}
+            for ival, iextrapar in indxmap.items():
+                if targets[iextrapar] == iextrapar:
+                    mergedindxmap[ival]= int( newindices[iextrapar] )
+                    if mergednorms[iextrapar] != norms[iextrapar]:
+                        if mergedsysterrormatrix[ierr] is systerrormatrix[ierr]:
+                            mergedsysterrormatrix[ierr]= list( systerrormatrix[ierr] )
+                        mergedsysterrormatrix[ierr][ival]*= ( mergednorms[iextrapar]/
+                                                              norms[iextrapar] )
+            mergedparindexmaps[ierr]= mergedindxmap
+        mergedextraparnames= [ "+".join( [ extraparnames[jextrapar] 
+                                           for jextrapar in range( nextrapar ) 
+                                           if targets[jextrapar] == iextrapar ] )
+                               for iextrapar in kept ]
+        return ( [ extrapars[iextrapar] for iextrapar in kept ], 
+                 [ extraparerrors[iextrapar] for iextrapar in kept ],
+                 mergedextraparnames, mergedparindexmaps, 
+                 mergedsysterrormatrix )
+
     # Prepare inputs and initialise the solver:
     def __setupSolver( self ):
 
@@ -339,6 +675,17 @@ class FitAverage( Average ):
 
         # Get matrix of systematic errors for constraints function:
         systerrormatrix= dataparser.getSysterrorMatrix()
+        if self.__lMergeNuisances:
+            ( extrapars, extraparerrors, extraparnames, parindexmaps, 
+              systerrormatrix )= self.__mergeExtraPars( extrapars, extraparerrors, 
+                                                        extraparnames, parindexmaps, 
+                                                        errorkeys, systerrormatrix )
+
+        # Keep the parameter mapping for analytic weights:
+        self.__parindexmaps= parindexmaps
+        self.__errorkeys= errorkeys
+        self.__systerrormatrix= systerrormatrix
+        self.__nextrapar= len( extrapars )
 
         # Now make the solver:
         solver= self._createSolver( gm, parindexmaps, errorkeys, 
@@ -350,10 +697,83 @@ class FitAverage( Average ):
         return solver
 
 
+# Constraints with analytic derivatives w.r.t. measured and unmeasured
+# parameters from constrderivs( mpar, upar ) instead of the numerical
+# derivatives of clsq.Constraints, both are calculated in one call.
+# clsq.Constraints is not part of the documented clsq interface, 
+# without it the solver keeps the numerical derivatives:
+_clsqConstraints= getattr( clsq, "Constraints", None )
+class analyticConstraints( _clsqConstraints or object ):
+
+    def __init__( self, constraints, constrderivs ):
+        self.__dict__.update( vars( constraints ) )
+        self.__constrderivs= constrderivs
+        self.__derivativeskey= None
+        self.__derivatives= None
+        return
+
+    def __getDerivatives( self, mpar, upar ):
+        derivativeskey= ( array( mpar, dtype=float ).tobytes(),
+                          array( upar, dtype=float ).tobytes() )
+        if derivativeskey != self.__derivativeskey:
+            self.__derivatives= self.__constrderivs( mpar, upar )
+            self.__derivativeskey= derivativeskey
+        return self.__derivatives
+    def derivativeM( self, mpar, upar ):
+        return self.__getDerivatives( mpar, upar )[0]
+    def derivativeU( self, mpar, upar ):
+        return self.__getDerivatives( mpar, upar )[1]
+
+
+# clsq solver using analytic constraint derivatives, the constraints
+# object of the solver is replaced.  clsq has no public method for
+# this, the solver works like clsq.clsqSolver when there is no 
+# constraints object to replace:
+class clsqAnalyticSolver( clsq.clsqSolver ):
+
+    def __init__( self, data, covm, upar, constrfun, constrderivs, 
+                  **kwargs ):
+        covm= matrix( covm )
+        clsq.clsqSolver.__init__( self, data, covm, upar, constrfun, 
+                                  **kwargs )
+        self.__solverargs= ( covm, constrfun, kwargs )
+        self.__constrderivs= constrderivs
+        self.__setAnalyticConstraints()
+        return
+
+    # Start values of the unmeasured parameters for the next fit, the
+    # solver state is reset to the current data, the constraints and
+    # the covariance matrix are kept:
+    def setStartValues( self, upar ):
+        covm, constrfun, kwargs= self.__solverargs
+        data= array( self.getDatav(), dtype=float ).ravel().tolist()
+        clsq.clsqSolver.__init__( self, data, covm, list( upar ), constrfun, 
+                                  **kwargs )
+        self.__setAnalyticConstraints()
+        return
+
+    def __setAnalyticConstraints( self ):
+        lReplaced= False
+        for name, value in list( vars( self ).items() ):
+            if( _clsqConstraints is not None and 
+                isinstance( value, _clsqConstraints ) ):
+                setattr( self, name, 
+                         analyticConstraints( value, self.__constrderivs ) )
+                lReplaced= True
+        if not lReplaced:
+            warnings.warn( "clsqSolver has no Constraints, numerical derivatives are used" )
+        return
+
+    def hasAnalyticDerivatives( self ):
+        return any( isinstance( value, analyticConstraints ) 
+                    for value in vars( self ).values() )
+
+
 class clsqAverage( FitAverage ):
 
-    def __init__( self, filename, lBlobel=False, llognormal=False ):
-        FitAverage.__init__( self, filename, llognormal )
+    def __init__( self, filename, lBlobel=False, llognormal=False,
+                  lMergeNuisances=False ):
+        FitAverage.__init__( self, filename, llognormal, lMergeNuisances )
         self.__lBlobel= lBlobel
         return
 
@@ -372,40 +792,85 @@ class clsqAverage( FitAverage ):
         originaldata= dataparser.getValues()
         ndata= len( data )
 
-        # Constraints function for average:
+        # Precompile the mapping of pseudo-parameters to measurements,
+        # one row per correlated error source in the order of 
+        # parindxmaps: index of pseudo-parameter, systematic error 
+        # (zero when the source does not act on a measurement) and 
+        # whether the error is relative:
+        gmarray= numpy.array( gm, dtype=float )
+        systkeys= list( parindxmaps.keys() )
+        nsyst= len( systkeys )
+        parindices= zeros( shape=(nsyst,ndata), dtype=int )
+        systerrors= zeros( shape=(nsyst,ndata) )
+        relative= zeros( shape=(nsyst,1), dtype=bool )
+        for isyst, ierr in enumerate( systkeys ):
+            relative[isyst]= "r" in hcovopt[errorkeys[ierr]]
+            for ival, iextrapar in parindxmaps[ierr].items():
+                parindices[isyst,ival]= iextrapar + ndata
+                systerrors[isyst,ival]= systerrormatrix[ierr][ival]
+        originalvalues= array( originaldata, dtype=float )
+
+        # Constraints function for average, applies additive terms and
+        # linearised exponentials a la Blobel for multiplicative rel. 
+        # errors in the order of the error sources, 
+        # ( ( -u + a_1 )/d_2 + a_3 )/d_4 = -u/( d_2 d_4 ) + a_1/( d_2 d_4 ) 
+        # + a_3, i.e. each term is divided by the product of all 
+        # following divisors:
+        def constraintTerms( mpar, upar ):
+            mparv= array( mpar, dtype=float ).ravel()
+            uparv= array( upar, dtype=float ).ravel()
+            umpar= dot( gmarray, uparv )
+            terms= mparv[parindices]*systerrors
+            inversedivisors= numpy.where( relative, 
+                                          1.0/( 1.0 + terms/originalvalues ), 
+                                          1.0 )
+            products= numpy.ones( shape=(nsyst+1,ndata) )
+            products[:nsyst]= numpy.cumprod( inversedivisors[::-1], axis=0 )[::-1]
+            additiveterms= numpy.where( relative, 0.0, terms )
+            return mparv, umpar, terms, inversedivisors, products, additiveterms
         def avgConstrFun( mpar, upar ):
-            umpar= gm*upar
-            constraints= []
-            for ival in range( ndata ):
-                constraint= - umpar[ival]
-                for ierr in parindxmaps.keys():
-                    covopt= hcovopt[errorkeys[ierr]]
-                    indxmap= parindxmaps[ierr]
-                    if ival in indxmap.keys():
-                        parindx= indxmap[ival] + ndata
-                        term= mpar[parindx]*systerrormatrix[ierr][ival]
-                        if "r" in covopt:
-                            # linearised exponential a la Blobel for 
-                            # multiplicative rel. error
-                            # constraint*= ( 1.0 + term/originaldata[ival] )
-                            constraint/= ( 1.0 + term/originaldata[ival] )
-                        else:
-                            # Additive error:
-                            constraint+= term
-                constraint+= mpar[ival]
-                constraints.append( constraint )
-            return constraints
+            mparv, umpar, terms, inversedivisors, products, additiveterms= constraintTerms( mpar, upar )
+            constraints= ( mparv[:ndata] - umpar*products[0] + 
+                           numpy.sum( additiveterms*products[1:], axis=0 ) )
+            return constraints.tolist()
+
+        # Exact derivatives of the constraints w.r.t. measured and 
+        # unmeasured parameters.  A term t_k = p s_k contributes 
+        # F_k = product of following divisors when additive, a divisor 
+        # 1/d_k = 1/( 1 + t_k/v ) contributes 
+        # -( -u P_0 + sum_j<k a_j F_j )/( d_k v ):
+        def avgConstrDerivatives( mpar, upar ):
+            mparv, umpar, terms, inversedivisors, products, additiveterms= constraintTerms( mpar, upar )
+            weightedterms= additiveterms*products[1:]
+            precedingsums= numpy.cumsum( weightedterms, axis=0 ) - weightedterms
+            termderivatives= numpy.where( relative, 
+                                          ( umpar*products[0] - precedingsums )*
+                                          inversedivisors/originalvalues,
+                                          products[1:] )
+            mderivatives= zeros( shape=(ndata,len(mparv)) )
+            mderivatives[:,:ndata]= numpy.eye( ndata )
+            rows= numpy.broadcast_to( numpy.arange( ndata ), (nsyst,ndata) )
+            numpy.add.at( mderivatives, ( rows, parindices ), 
+                          termderivatives*systerrors )
+            uderivatives= -products[0][:,numpy.newaxis]*gmarray
+            return matrix( mderivatives ), matrix( uderivatives )
+        self.__constraintFunctions= ( avgConstrFun, avgConstrDerivatives )
 
         # Create solver and return it:
         upnames= dict( (upnames.index(name),name) for name in upnames )
         names= mpnames + extraparnames
         names= dict( (names.index(name),name) for name in names )
-        solver= clsq.clsqSolver( data+extrapars, covm, upar, avgConstrFun,
-                                 uparnames=upnames, mparnames=names,
-                                 ndof=ndata-len(upar) )
+        solver= clsqAnalyticSolver( data+extrapars, covm, upar, avgConstrFun,
+                                    avgConstrDerivatives, uparnames=upnames, 
+                                    mparnames=names, ndof=ndata-len(upar) )
 
         return solver
 
+    # Constraints function and function for its derivatives w.r.t. 
+    # measured and unmeasured parameters:
+    def getConstraintFunctions( self ):
+        return self.__constraintFunctions
+
     # Add "measured parameter" errors to diagonal of covariance matrix:
     def __addExtraparErrors( self, covm, extraparerrors ):
         ndata= len( covm )
@@ -426,7 +891,7 @@ class clsqAverage( FitAverage ):
         print( solver.getConstraints() )
         return
 
-    def runSolver( self ):
+    def _solve( self ):
         solver= self.getSolver()
         solver.solve( lBlobel=self.__lBlobel )
         return
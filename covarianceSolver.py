@@ -0,0 +1,162 @@
+
+# Solve linear systems V x = b with a covariance matrix V without
+# calculating the inverse of V.  The dense solver uses the Cholesky
+# factorisation V = L L^T, the low rank solver handles covariance
+# matrices V = D + B B^T with diagonal D and few columns in B as
+# produced by fully correlated error sources, see AverageDataParser.
+
+import numpy
+try:
+    from scipy.linalg import solve_triangular
+except ImportError:
+    solve_triangular= None
+
+
+class CovarianceError( Exception ):
+    def __init__( self, value ):
+        self.__value= value
+    def __str__( self ):
+        return repr( self.__value )
+
+
+# Solve L x = rhs for lower triangular L, or L^T x = rhs with 
+# ltrans=True, by substitution if scipy is not available.  Stacks of
+# factors L with shape (nstack,n,n) are solved by substitution for 
+# the whole stack at once, rhs has shape (nstack,n,m) or (n,m) for 
+# the same rhs with all factors:
+def solveLowerTriangular( lower, rhs, ltrans=False ):
+    if lower.ndim == 3:
+        return _solveLowerTriangularStacked( lower, rhs, ltrans )
+    if solve_triangular is not None:
+        return solve_triangular( lower, rhs, lower=True, 
+                                 trans=( 1 if ltrans else 0 ) )
+    ndim= lower.shape[0]
+    solution= numpy.array( rhs, dtype=float )
+    if ltrans:
+        upper= lower.T
+        for i in reversed( range( ndim ) ):
+            solution[i]-= numpy.dot( upper[i,i+1:], solution[i+1:] )
+            solution[i]/= upper[i,i]
+    else:
+        for i in range( ndim ):
+            solution[i]-= numpy.dot( lower[i,:i], solution[:i] )
+            solution[i]/= lower[i,i]
+    return solution
+def _solveLowerTriangularStacked( lower, rhs, ltrans ):
+    ndim= lower.shape[1]
+    rhs= numpy.asarray( rhs, dtype=float )
+    solution= numpy.array( numpy.broadcast_to( rhs, lower.shape[:2]+
+                                               rhs.shape[-1:] ) )
+    if ltrans:
+        for i in reversed( range( ndim ) ):
+            solution[:,i]-= numpy.einsum( "sj,sjm->sm", lower[:,i+1:,i], 
+                                          solution[:,i+1:] )
+            solution[:,i]/= lower[:,i,i,numpy.newaxis]
+    else:
+        for i in range( ndim ):
+            solution[:,i]-= numpy.einsum( "sj,sjm->sm", lower[:,i,:i], 
+                                          solution[:,:i] )
+            solution[:,i]/= lower[:,i,i,numpy.newaxis]
+    return solution
+
+
+# Dense covariance matrix, factorise once as V = L L^T and solve with
+# the triangular factor:
+class denseCovarianceSolver():
+
+    def __init__( self, cov ):
+        try:
+            self.__factor= numpy.linalg.cholesky( numpy.asarray( cov, dtype=float ) )
+        except numpy.linalg.LinAlgError:
+            raise CovarianceError( "Covariance matrix is not positive definite, check correlations and errors" )
+        return
+
+    def getFactor( self ):
+        return self.__factor.copy()
+
+    # L^-1 rhs, chi^2 is the sum of squares of the whitened residuals:
+    def whiten( self, rhs ):
+        return solveLowerTriangular( self.__factor, 
+                                     numpy.asarray( rhs, dtype=float ) )
+
+    def solve( self, rhs ):
+        return solveLowerTriangular( self.__factor, self.whiten( rhs ), 
+                                     ltrans=True )
+
+    def calcChisq( self, delta ):
+        whitened= self.whiten( delta )
+        return float( numpy.sum( whitened**2 ) )
+
+    # chi^2 for each column of deltas:
+    def calcChisqs( self, deltas ):
+        whitened= self.whiten( deltas )
+        return numpy.sum( whitened**2, axis=0 )
+
+    def getInverse( self ):
+        return self.solve( numpy.eye( self.__factor.shape[0] ) )
+
+
+# V = D + B B^T, use the Woodbury identity
+# V^-1 = D^-1 - D^-1 B ( 1 + B^T D^-1 B )^-1 B^T D^-1
+# to solve in O(n k^2) for n measurements and k columns of B:
+class lowRankCovarianceSolver():
+
+    def __init__( self, diagonal, vectors ):
+        diagonal= numpy.asarray( diagonal, dtype=float )
+        if not numpy.all( diagonal > 0.0 ):
+            raise CovarianceError( "Diagonal part of covariance matrix not positive" )
+        ndim= len( diagonal )
+        vectors= numpy.asarray( vectors, dtype=float ).reshape( ndim, -1 )
+        self.__diaginv= 1.0/diagonal
+        self.__vectors= vectors
+        self.__diaginvvectors= vectors*self.__diaginv[:,numpy.newaxis]
+        nvec= vectors.shape[1]
+        capacitance= numpy.eye( nvec ) + numpy.dot( vectors.T, self.__diaginvvectors )
+        self.__capacitanceinv= numpy.linalg.inv( capacitance )
+        return
+
+    def solve( self, rhs ):
+        rhs= numpy.asarray( rhs, dtype=float )
+        diaginv= self.__diaginv
+        if rhs.ndim > 1:
+            diaginv= diaginv[:,numpy.newaxis]
+        solution= diaginv*rhs
+        correction= numpy.dot( self.__capacitanceinv,
+                               numpy.dot( self.__vectors.T, solution ) )
+        return solution - numpy.dot( self.__diaginvvectors, correction )
+
+    def calcChisq( self, delta ):
+        delta= numpy.asarray( delta, dtype=float )
+        return float( numpy.sum( delta*self.solve( delta ) ) )
+
+    # chi^2 for each column of deltas:
+    def calcChisqs( self, deltas ):
+        deltas= numpy.asarray( deltas, dtype=float )
+        return numpy.sum( deltas*self.solve( deltas ), axis=0 )
+
+    def getInverse( self ):
+        return self.solve( numpy.eye( len( self.__diaginv ) ) )
+
+
+
+# Given inverse V^-1 of the covariance matrix, solve by multiplication:
+class inverseCovarianceSolver():
+
+    def __init__( self, inv ):
+        self.__inv= numpy.asarray( inv, dtype=float )
+        return
+
+    def solve( self, rhs ):
+        return numpy.dot( self.__inv, numpy.asarray( rhs, dtype=float ) )
+
+    def calcChisq( self, delta ):
+        delta= numpy.asarray( delta, dtype=float )
+        return float( numpy.sum( delta*self.solve( delta ) ) )
+
+    # chi^2 for each column of deltas:
+    def calcChisqs( self, deltas ):
+        deltas= numpy.asarray( deltas, dtype=float )
+        return numpy.sum( deltas*self.solve( deltas ), axis=0 )
+
+    def getInverse( self ):
+        return self.__inv.copy()
@@ -0,0 +1,176 @@
+
+# Levenberg-Marquardt least squares solver with the interface of
+# minuitSolver, without ROOT.  The residual function returns the
+# whitened residuals and constraint residuals of the pseudo-parameters
+# and their jacobian w.r.t. the parameters, the chi^2 is the sum of
+# squares.  Parameter errors and covariances are from the Gauss-Newton
+# approximation of the Hessian at the minimum, (J^T J)^-1.
+
+import numpy
+from numpy import matrix
+from math import sqrt
+try:
+    from scipy.stats import chi2
+except ImportError:
+    chi2= None
+
+
+class LMError( Exception ):
+    def __init__( self, value ):
+         self.__value= value
+    def __str__( self ):
+         return repr( self.__value )
+
+
+# P-value of chi^2 for ndof degrees of freedom, like TMath.Prob:
+def chisqProb( chisq, ndof ):
+    if chi2 is None:
+        return float( "nan" )
+    return chi2.sf( chisq, ndof )
+
+
+class lmSolver():
+
+    def __init__( self, residuals, pars, parerrors, parnames, ndof,
+                  maxiterations=100, tolerance=1.0e-10 ):
+        self.__residuals= residuals
+        self.__pars= list( pars )
+        self.__parnames= parnames
+        self.__ndof= ndof
+        self.__maxiterations= maxiterations
+        self.__tolerance= tolerance
+        self.__solution= numpy.array( pars, dtype=float )
+        self.__covm= numpy.diag( numpy.array( parerrors, dtype=float )**2 )
+        self.__chisq= None
+        self.__niterations= 0
+        self.__lConverged= False
+        return
+
+    def getStartValues( self ):
+        return list( self.__pars )
+    def setStartValues( self, pars ):
+        if len( pars ) != len( self.__pars ):
+            raise LMError( "Wrong number of start values" )
+        self.__pars= list( pars )
+        return
+
+    # Steps solve ( J^T J + lambda diag( J^T J ) ) dp = -J^T r, lambda
+    # decreases after steps reducing the chi^2 and increases otherwise,
+    # converged when the chi^2 changes by less than the tolerance:
+    def solve( self, lBlobel=True ):
+        pars= numpy.array( self.__pars, dtype=float )
+        residuals, jacobian= self.__residuals( pars )
+        chisq= numpy.dot( residuals, residuals )
+        damping= 1.0e-3
+        self.__lConverged= False
+        for iteration in range( self.__maxiterations ):
+            normal= numpy.dot( jacobian.T, jacobian )
+            gradient= numpy.dot( jacobian.T, residuals )
+            step= numpy.linalg.solve( normal + damping*numpy.diag( numpy.diag( normal ) ),
+                                      -gradient )
+            newpars= pars + step
+            newresiduals, newjacobian= self.__residuals( newpars )
+            newchisq= numpy.dot( newresiduals, newresiduals )
+            if newchisq <= chisq:
+                lConverged= chisq - newchisq < self.__tolerance*max( 1.0, chisq )
+                pars, residuals, jacobian, chisq= ( newpars, newresiduals,
+                                                    newjacobian, newchisq )
+                damping= max( damping/10.0, 1.0e-12 )
+                if lConverged:
+                    self.__lConverged= True
+                    break
+            else:
+                damping*= 10.0
+                if damping > 1.0e12:
+                    break
+        self.__niterations= iteration + 1
+        self.__solution= pars
+        self.__chisq= chisq
+        self.__covm= numpy.linalg.inv( numpy.dot( jacobian.T, jacobian ) )
+        return
+
+    def getChisq( self ):
+        return self.__chisq
+
+    def getNdof( self ):
+        return self.__ndof
+
+    def isConverged( self ):
+        return self.__lConverged
+
+    def __printPars( self, par, parerrors, parnames, ffmt=".4f" ):
+        for ipar in range( len( par ) ):
+            name= parnames[ipar]
+            print( "{0:>15s}:".format( name ), end=" " )
+            fmtstr= "{0:10" + ffmt + "} +/- {1:10" + ffmt + "}"
+            print( fmtstr.format( par[ipar], parerrors[ipar] ) )
+        return
+
+    def printResults( self, ffmt=".4f", cov=False, corr=False ):
+        print( "\nLevenberg-Marquardt least squares" )
+        print( "\nResults after fit" )
+        chisq= self.__chisq
+        ndof= self.__ndof
+        fmtstr= "\nChi^2= {0:"+ffmt+"} for {1:d} d.o.f, Chi^2/d.o.f= {2:"+ffmt+"}, P-value= {3:"+ffmt+"}"
+        print( fmtstr.format( chisq, ndof, chisq/float(ndof),
+                             chisqProb( chisq, ndof ) ) )
+        fmtstr= "Iterations: {0:d}, converged: {1}"
+        print( fmtstr.format( self.__niterations, self.__lConverged ) )
+        print( "\nFitted parameters and errors" )
+        print( "           Name       Value          Error" )
+        pars= self.getPars()
+        parerrors= self.getParErrors()
+        self.__printPars( pars, parerrors, self.__parnames, ffmt=ffmt )
+        if cov:
+            self.printCovariances()
+        if corr:
+            self.printCorrelations()
+        return
+
+    def __printMatrix( self, m, ffmt ):
+        mshape= m.shape
+        print( "{0:>10s}".format( "" ), end=" " )
+        for i in range(mshape[0]):
+            print( "{0:>10s}".format( self.__parnames[i] ), end=" " )
+        print()
+        for i in range(mshape[0]):
+            print( "{0:>10s}".format( self.__parnames[i] ), end=" " )
+            for j in range(mshape[1]):
+                fmtstr= "{0:10"+ffmt+"}"
+                print( fmtstr.format( m[i,j] ), end=" " )
+            print()
+        return
+    def printCovariances( self ):
+        print( "\nCovariance matrix:" )
+        self.__printMatrix( self.getCovariancematrix(), ".3e" )
+        return
+    def printCorrelations( self ):
+        print( "\nCorrelation matrix:" )
+        self.__printMatrix( self.getCorrelationmatrix(), ".3f" )
+        return
+
+    def getPars( self ):
+        return [ par for par in self.__solution ]
+    def getUparv( self ):
+        pars= self.getPars()
+        parv= matrix( pars )
+        parv.shape= (len(pars),1)
+        return parv
+    def getParErrors( self ):
+        return [ sqrt( self.__covm[ipar,ipar] )
+                 for ipar in range( len( self.__solution ) ) ]
+
+    def getCovariancematrix( self ):
+        return self.__covm.copy()
+
+    # Parameters, errors, covariance and correlation matrix as arrays:
+    def getResults( self ):
+        return ( numpy.array( self.__solution ), 
+                 numpy.array( self.getParErrors() ),
+                 self.getCovariancematrix(), self.getCorrelationmatrix() )
+
+    def getCorrelationmatrix( self ):
+        covm= self.getCovariancematrix()
+        errors= numpy.sqrt( numpy.diag( covm ) )
+        return covm/numpy.outer( errors, errors )
+
@@ -6,14 +6,178 @@
 
 
 from AverageTools.clsqAverage import FitAverage
+from AverageTools.AverageDataParser import stripLeadingDigits
 from AverageTools.minuitSolver import minuitSolver
+from AverageTools.lmSolver import lmSolver
+from AverageTools.covarianceSolver import denseCovarianceSolver
+from AverageTools.covarianceSolver import solveLowerTriangular
 from numpy import matrix
 from math import log
+import numpy
+
+
+# Prediction of the measurements from index arrays prepared once.  The
+# averages are projected onto the measurements, then in the order of 
+# the error sources additive terms are subtracted and relative terms 
+# divide, ( ( U u - t_1 )/d_2 - t_3 ), each term is divided by the 
+# product of the following divisors.  predict returns the prediction, 
+# its derivatives w.r.t. the projected averages and w.r.t. the 
+# pseudo-parameters at parindices, jacobian the dense matrix of 
+# derivatives w.r.t. all parameters.  Residuals are whitened with the 
+# Cholesky factor of the reduced covariance matrix.  Pseudo-parameters 
+# acting only additively with unit gaussian constraints enter the
+# chi^2 quadratically, profile sets them to their minimum for given
+# other parameters:
+def _makeModel( gm, parindexmaps, errorkeys, covoptions,
+                systerrormatrix, datav, covm, npar ):
+    gmarray= numpy.array( gm, dtype=float )
+    ndata= gmarray.shape[0]
+    systkeys= list( parindexmaps.keys() )
+    nsyst= len( systkeys )
+    parindices= numpy.zeros( shape=(nsyst,ndata), dtype=int )
+    systerrors= numpy.zeros( shape=(nsyst,ndata) )
+    relative= numpy.zeros( shape=(nsyst,1), dtype=bool )
+    for isyst, ierr in enumerate( systkeys ):
+        relative[isyst]= "r" in covoptions[errorkeys[ierr]]
+        for ival, iextrapar in parindexmaps[ierr].items():
+            parindices[isyst,ival]= iextrapar + npar
+            systerrors[isyst,ival]= systerrormatrix[ierr][ival]
+    rows= numpy.broadcast_to( numpy.arange( ndata ), (nsyst,ndata) )
+    factor= denseCovarianceSolver( covm ).getFactor()
+    whitening= solveLowerTriangular( factor, numpy.eye( ndata ) )
+    def predict( parv ):
+        data= numpy.asarray( datav, dtype=float ).ravel()
+        uparprojection= numpy.dot( gmarray, parv[:npar] )
+        terms= parv[parindices]*systerrors
+        inversedivisors= numpy.where( relative, 1.0/( 1.0 + terms/data ), 
+                                      1.0 )
+        products= numpy.ones( shape=(nsyst+1,ndata) )
+        products[:nsyst]= numpy.cumprod( inversedivisors[::-1], axis=0 )[::-1]
+        additiveterms= numpy.where( relative, 0.0, terms )
+        weightedterms= additiveterms*products[1:]
+        umpar= uparprojection*products[0] - numpy.sum( weightedterms, axis=0 )
+        precedingsums= numpy.cumsum( weightedterms, axis=0 ) - weightedterms
+        termderivatives= numpy.where( relative, 
+                                      -( uparprojection*products[0] - 
+                                         precedingsums )*inversedivisors/data,
+                                      -products[1:] )
+        return data, umpar, products[0], termderivatives*systerrors
+    def jacobian( parv, uparderivatives, termderivatives ):
+        derivatives= numpy.zeros( shape=(ndata,len( parv )) )
+        derivatives[:,:npar]= gmarray*uparderivatives[:,numpy.newaxis]
+        numpy.add.at( derivatives, ( rows, parindices ), termderivatives )
+        return derivatives
+    def profile( parv, profiledindices ):
+        parv[profiledindices]= 0.0
+        data, umpar, uparderivatives, termderivatives= predict( parv )
+        derivatives= jacobian( parv, uparderivatives, termderivatives )
+        whiteneddesign= numpy.dot( whitening, derivatives[:,profiledindices] )
+        whitenedresiduals= numpy.dot( whitening, data - umpar )
+        normal= ( numpy.dot( whiteneddesign.T, whiteneddesign ) + 
+                  numpy.eye( len( profiledindices ) ) )
+        parv[profiledindices]= numpy.linalg.solve( normal, 
+                                                   numpy.dot( whiteneddesign.T, 
+                                                              whitenedresiduals ) )
+        return parv
+    return whitening, predict, jacobian, profile, parindices
+
+# Parameters of the fit, the averages and pseudo-parameters not in 
+# profiled, and the functions from these to all parameters:
+def _makeParameterMap( npar, profiled ):
+    nextrapar= len( profiled )
+    profiledindices= numpy.flatnonzero( profiled ) + npar
+    keptindices= numpy.concatenate( [ numpy.arange( npar ), 
+                                      numpy.flatnonzero( ~profiled ) + npar ] )
+    def allParameters( par, profile ):
+        parv= numpy.zeros( npar+nextrapar )
+        parv[keptindices]= par
+        if len( profiledindices ) > 0:
+            profile( parv, profiledindices )
+        return parv
+    return allParameters, keptindices, profiledindices
+
+# chi^2 with constraint terms for correlated systematics and its 
+# gradient, penalty gives the constraint terms of the pseudo-parameters
+# and their gradient.  Pseudo-parameters flagged in profiled must act 
+# only additively with unit gaussian constraints, they are replaced by
+# their minimum and the gradient w.r.t. the other parameters is the 
+# gradient of the chi^2 at the minimum:
+def _makeChisqFunction( gm, parindexmaps, errorkeys, covoptions,
+                        systerrormatrix, datav, covm, npar, penalty,
+                        profiled ):
+    whitening, predict, jacobian, profile, parindices= _makeModel( gm, parindexmaps, 
+                                                                  errorkeys, covoptions,
+                                                                  systerrormatrix, 
+                                                                  datav, covm, npar )
+    gmarray= numpy.array( gm, dtype=float )
+    allParameters, keptindices, profiledindices= _makeParameterMap( npar, profiled )
+    def chisqFunction( par, grad=None ):
+        parv= allParameters( par, profile )
+        data, umpar, uparderivatives, termderivatives= predict( parv )
+        whitened= numpy.dot( whitening, data - umpar )
+        penaltyvalue, penaltygradient= penalty( parv[npar:] )
+        chisq= numpy.dot( whitened, whitened ) + penaltyvalue
+        if grad is not None:
+            umpargradient= -2.0*numpy.dot( whitening.T, whitened )
+            gradient= numpy.zeros( len( parv ) )
+            gradient[:npar]= numpy.dot( gmarray.T, umpargradient*uparderivatives )
+            numpy.add.at( gradient, parindices, umpargradient*termderivatives )
+            gradient[npar:]+= penaltygradient
+            for ipar, kept in enumerate( keptindices ):
+                grad[ipar]= gradient[kept]
+        return chisq
+    return chisqFunction
+
+# Whitened residuals and constraint residuals of the pseudo-parameters
+# from penaltyresiduals, with their jacobian, the chi^2 is the sum of 
+# squares.  With profiled pseudo-parameters the jacobian is projected 
+# on the complement of their columns, the Gauss-Newton covariance of 
+# the other parameters is then the same as for the fit of all of them:
+def _makeResidualFunction( gm, parindexmaps, errorkeys, covoptions,
+                           systerrormatrix, datav, covm, npar, 
+                           penaltyresiduals, profiled ):
+    whitening, predict, jacobian, profile, parindices= _makeModel( gm, parindexmaps, 
+                                                                  errorkeys, covoptions,
+                                                                  systerrormatrix, 
+                                                                  datav, covm, npar )
+    allParameters, keptindices, profiledindices= _makeParameterMap( npar, profiled )
+    def residualFunction( par ):
+        parv= allParameters( par, profile )
+        data, umpar, uparderivatives, termderivatives= predict( parv )
+        extraresiduals, extraderivatives= penaltyresiduals( parv[npar:] )
+        residuals= numpy.concatenate( [ numpy.dot( whitening, data - umpar ), 
+                                        extraresiduals ] )
+        derivatives= numpy.zeros( shape=(len( residuals ),len( parv )) )
+        derivatives[:len( data )]= -numpy.dot( whitening, 
+                                               jacobian( parv, uparderivatives,
+                                                         termderivatives ) )
+        derivatives[len( data ):,npar:]= numpy.diag( extraderivatives )
+        keptderivatives= derivatives[:,keptindices]
+        if len( profiledindices ) > 0:
+            profiledderivatives= derivatives[:,profiledindices]
+            keptderivatives-= numpy.dot( profiledderivatives, 
+                numpy.linalg.lstsq( profiledderivatives, keptderivatives, 
+                                    rcond=None )[0] )
+        return residuals, keptderivatives
+    return residualFunction
+
+# Unit gaussian constraints of the pseudo-parameters:
+def _gaussianPenalty( extrapars ):
+    return numpy.dot( extrapars, extrapars ), 2.0*extrapars
+def _gaussianResiduals( extrapars ):
+    return extrapars, numpy.ones( len( extrapars ) )
 
 class minuitAverage( FitAverage ):
 
-    def __init__( self, filename, llognormal=False ):
-        FitAverage.__init__( self, filename, llognormal )
+    # With lProfile pseudo-parameters of additive error sources are
+    # profiled in closed form, minuit only fits the averages and the 
+    # pseudo-parameters of relative error sources.  With lLMSolver the
+    # Levenberg-Marquardt solver replaces minuit:
+    def __init__( self, filename, llognormal=False, lProfile=False,
+                  lLMSolver=False, lMergeNuisances=False ):
+        self.__lProfile= lProfile
+        self.__lLMSolver= lLMSolver
+        FitAverage.__init__( self, filename, llognormal, lMergeNuisances )
         return
 
     # Used by base class to create the least squares solver
@@ -26,49 +190,53 @@ class minuitAverage( FitAverage ):
         dataparser= self._getDataparser()
         covoptions= dataparser.getCovoption()
         covm= dataparser.getTotalReducedCovariance()
-        invm= covm.getI()
         ndata= len( data )
         npar= len( upar )
         self.__npar= npar
         nextrapar= len( extrapars )
-        uparv= matrix( npar*[ 0.0 ] )
-        uparv.shape= (npar,1)
         datav= matrix( data )
         datav.shape= (ndata,1)
         self.__data= datav
+        profiled= numpy.zeros( nextrapar, dtype=bool )
+        if self.__lProfile:
+            for ierr, parindexmap in parindexmaps.items():
+                if not "r" in covoptions[errorkeys[ierr]]:
+                    for iextrapar in parindexmap.values():
+                        profiled[iextrapar]= True
+        nfitpar= npar + nextrapar - numpy.count_nonzero( profiled )
+        kept= [ iextrapar for iextrapar in range( nextrapar ) 
+                if not profiled[iextrapar] ]
+        pars= upar + [ extrapars[iextrapar] for iextrapar in kept ]
+        parerrors= upar + [ extraparerrors[iextrapar] for iextrapar in kept ]
+        parnames= upnames + [ extraparnames[iextrapar] for iextrapar in kept ]
+        ndof= ndata - npar
+        if self.__lLMSolver:
+            residualFunction= _makeResidualFunction( gm, parindexmaps, errorkeys, 
+                                                     covoptions, systerrormatrix, 
+                                                     datav, covm, npar, 
+                                                     _gaussianResiduals, profiled )
+            return lmSolver( residualFunction, pars, parerrors, parnames, ndof )
+        chisqFunction= _makeChisqFunction( gm, parindexmaps, errorkeys, 
+                                           covoptions, systerrormatrix, 
+                                           datav, covm, npar, 
+                                           _gaussianPenalty, profiled )
 
         # The minuit fcn with chi^2 with constraint terms
-        # for correlated systematics
-        def fcn( n, grad, fval, par, ipar ):
-            for ipar in range( npar ):
-                uparv[ipar]= par[ipar]
-            umpar= gm*uparv
-            for ival in range( ndata ):
-                for ierr in parindexmaps.keys():
-                    covopt= covoptions[errorkeys[ierr]]
-                    indexmap= parindexmaps[ierr]
-                    if ival in indexmap.keys():
-                        parindex= indexmap[ival] + npar
-                        term= par[parindex]*systerrormatrix[ierr][ival]
-                        if "r" in covopt:
-                            # umpar[ival]*= 1.0+term/self.__data[ival]
-                            umpar[ival]/= ( 1.0 + term/self.__data[ival] )
-                        else:
-                            umpar[ival]-= term
-            delta= self.__data - umpar
-            chisq= delta.getT()*invm*delta
-            for ipar in range( npar, npar+nextrapar ):
-                chisq+= par[ipar]**2
+        # for correlated systematics, gradient for iflag 2
+        def fcn( n, grad, fval, par, iflag ):
+            par= [ par[ipar] for ipar in range( nfitpar ) ]
+            if iflag == 2:
+                chisq= chisqFunction( par, grad )
+            else:
+                chisq= chisqFunction( par )
             # Assign chisq to ctypes variable in new pyroot:
             fval.value= chisq
             return
 
-        # Prepare and create the minuit solver:
-        pars= upar + extrapars
-        parerrors= upar + extraparerrors
-        parnames= upnames + extraparnames
-        ndof= ndata - npar
+        # Create the minuit solver with gradient from fcn, profiled 
+        # pseudo-parameters are not minuit parameters:
         solver= minuitSolver( fcn, pars, parerrors, parnames, ndof )
+        solver.minuitCommand( "SET GRAD 1" )
         return solver
 
     # Needed for calculation of weights by derivatives of
@@ -83,8 +251,11 @@ class minuitAverage( FitAverage ):
 
 class minuitBluecowAverage( FitAverage ):
 
-    def __init__( self, filename ):
-        FitAverage.__init__( self, filename )
+    # With lLMSolver the Levenberg-Marquardt solver replaces minuit:
+    def __init__( self, filename, lLMSolver=False, lMergeNuisances=False ):
+        self.__lLMSolver= lLMSolver
+        FitAverage.__init__( self, filename, 
+                             lMergeNuisances=lMergeNuisances )
         return
 
     # Used by base class to create the least squares solver
@@ -97,13 +268,10 @@ class minuitBluecowAverage( FitAverage ):
         dataparser= self._getDataparser()
         covoptions= dataparser.getCovoption()
         covm= dataparser.getTotalReducedCovariance()
-        invm= covm.getI()
         ndata= len( data )
         npar= len( upar )
         self.__npar= npar
         nextrapar= len( extrapars )
-        uparv= matrix( npar*[ 0.0 ] )
-        uparv.shape= (npar,1)
         datav= matrix( data )
         datav.shape= (ndata,1)
         self.__data= datav
@@ -119,44 +287,74 @@ class minuitBluecowAverage( FitAverage ):
                         continue
         #print extraparnames
         #print rvalues
+        self.__rvalueparnames= [ name for name in extraparnames 
+                                 if name in rvalues ]
 
-        # The minuit fcn with chi^2 with constraint terms
-        # for correlated systematics
-        def fcn( n, grad, fval, par, ipar ):
-            for ipar in range( npar ):
-                uparv[ipar]= par[ipar]
-            umpar= gm*uparv
-            for ival in range( ndata ):
-                for ierr in parindexmaps.keys():
-                    covopt= covoptions[errorkeys[ierr]]
-                    indexmap= parindexmaps[ierr]
-                    if ival in indexmap.keys():
-                        parindex= indexmap[ival] + npar
-                        term= par[parindex]*systerrormatrix[ierr][ival]
-                        if "r" in covopt:
-                            # umpar[ival]*= 1.0+term/self.__data[ival]
-                            umpar[ival]/= ( 1.0 + term/self.__data[ival] )
-                        else:
-                            umpar[ival]-= term
-            delta= self.__data - umpar
-            chisq= delta.getT()*invm*delta
-            for ipar in range( npar, npar+nextrapar ):
-                errorKey= extraparnames[ipar-npar]
-                if errorKey in rvalues:
-                    rvalue= rvalues[errorKey]
-                    tworsq= 2.0*rvalue**2
-                    chisq+= (1.0+1.0/tworsq)*log(1.0+tworsq*par[ipar]**2)
-                else:
-                    chisq+= par[ipar]**2
-            fval[0]= chisq
-            return
+        # Log penalty for pseudo-parameters with r-values, else unit
+        # gaussian constraints:
+        lrvalue= numpy.array( [ name in rvalues for name in extraparnames ],
+                              dtype=bool )
+        tworsq= numpy.array( [ 2.0*rvalues[name]**2 if name in rvalues else 1.0
+                               for name in extraparnames ] )
+        def penalty( extrapars ):
+            logterms= 1.0 + tworsq*extrapars**2
+            values= numpy.where( lrvalue, 
+                                 ( 1.0 + 1.0/tworsq )*numpy.log( logterms ),
+                                 extrapars**2 )
+            gradient= numpy.where( lrvalue, 
+                                   ( 1.0 + 1.0/tworsq )*2.0*tworsq*extrapars/logterms,
+                                   2.0*extrapars )
+            return numpy.sum( values ), gradient
+
+        # Residuals with the log penalty as sum of squares, signed 
+        # square roots of the log terms with the limit of the 
+        # derivative at zero:
+        def penaltyresiduals( extrapars ):
+            logterms= 1.0 + tworsq*extrapars**2
+            scales= numpy.where( lrvalue, 1.0 + 1.0/tworsq, 1.0 )
+            residuals= numpy.where( lrvalue, 
+                                    numpy.sign( extrapars )*
+                                    numpy.sqrt( scales*numpy.log( logterms ) ),
+                                    extrapars )
+            nonzero= residuals != 0.0
+            divisors= numpy.where( nonzero, logterms*residuals, 1.0 )
+            derivatives= numpy.where( lrvalue, 
+                                      numpy.where( nonzero, 
+                                                   scales*tworsq*extrapars/divisors,
+                                                   numpy.sqrt( scales*tworsq ) ),
+                                      1.0 )
+            return residuals, derivatives
 
-        # Prepare and create the minuit solver:
         pars= upar + extrapars
         parerrors= upar + extraparerrors
         parnames= upnames + extraparnames
         ndof= ndata - npar
+        profiled= numpy.zeros( nextrapar, dtype=bool )
+        if self.__lLMSolver:
+            residualFunction= _makeResidualFunction( gm, parindexmaps, errorkeys, 
+                                                     covoptions, systerrormatrix, 
+                                                     datav, covm, npar, 
+                                                     penaltyresiduals, profiled )
+            return lmSolver( residualFunction, pars, parerrors, parnames, ndof )
+        chisqFunction= _makeChisqFunction( gm, parindexmaps, errorkeys, 
+                                           covoptions, systerrormatrix, 
+                                           datav, covm, npar, penalty, 
+                                           profiled )
+
+        # The minuit fcn with chi^2 with constraint terms
+        # for correlated systematics, gradient for iflag 2
+        def fcn( n, grad, fval, par, iflag ):
+            par= [ par[ipar] for ipar in range( npar+nextrapar ) ]
+            if iflag == 2:
+                chisq= chisqFunction( par, grad )
+            else:
+                chisq= chisqFunction( par )
+            fval[0]= chisq
+            return
+
+        # Create the minuit solver with gradient from fcn:
         solver= minuitSolver( fcn, pars, parerrors, parnames, ndof )
+        solver.minuitCommand( "SET GRAD 1" )
         return solver
 
     # Needed for calculation of weights by derivatives of
@@ -167,3 +365,17 @@ class minuitBluecowAverage( FitAverage ):
         uparv= FitAverage._getAverage( self )
         return uparv[:self.__npar]
 
+    # Pseudo-parameters with r-values have log penalty terms and are 
+    # not merged:
+    def _isMergeable( self, errorkey ):
+        rvalues= self._getDataparser().getRvalues()
+        return ( FitAverage._isMergeable( self, errorkey ) and
+                 not any( key in stripLeadingDigits( errorkey ) 
+                          for key in rvalues ) )
+
+    # Log penalty terms for pseudo-parameters with r-values are not
+    # quadratic, no analytic weights then:
+    def _isLinearModel( self ):
+        return ( FitAverage._isLinearModel( self ) and 
+                 len( self.__rvalueparnames ) == 0 )
+
@@ -9,9 +9,11 @@
 
 
 from ctypes import c_double, c_int
-from ROOT import TMinuit, TMath
-from numpy import matrix, array
-from math import sqrt
+try:
+    from ROOT import TMinuit, TMath
+except ImportError:
+    TMinuit= None
+from numpy import matrix, zeros, diagonal, outer, sqrt
 
 
 class MinuitError( Exception ):
@@ -23,10 +25,17 @@ class MinuitError( Exception ):
 
 class minuitSolver():
 
-    def __init__( self, fcn, pars, parerrors, parnames, ndof, maxpars=50 ):
+    # TMinuit is sized for the number of parameters unless maxpars
+    # is given:
+    def __init__( self, fcn, pars, parerrors, parnames, ndof, maxpars=None ):
 
+        if TMinuit is None:
+             raise MinuitError( "ROOT is not available, use lmSolver" )
+        if maxpars is None:
+             maxpars= len( pars )
         if len( pars ) > maxpars:
-             raise MinuitError( "More than 50 parameters, increase maxpars" )
+             raise MinuitError( "More than " + str( maxpars ) + 
+                                " parameters, increase maxpars" )
         self.__minuit= TMinuit( maxpars )
         self.minuitCommand( "SET PRI -1" )
         # Hold on to fcn or python will kill it after passing to TMinuit
@@ -37,6 +46,7 @@ class minuitSolver():
         self.__parnames= parnames
         self.__setParameters()
         self.__ndof= ndof
+        self.__results= None
         return
 
     def __setParameters( self ):
@@ -52,12 +62,21 @@ class minuitSolver():
         return
 
     def minuitCommand( self, command ):
+        self.__results= None
         errorcode= self.__minuit.Command( command )
         if errorcode != 0:
             message= "Minuit command " + command + " failed: " + str( errorcode )
             raise MinuitError( message )
         return
 
+    def getStartValues( self ):
+        return list( self.__pars )
+    def setStartValues( self, pars ):
+        if len( pars ) != len( self.__pars ):
+            raise MinuitError( "Wrong number of start values" )
+        self.__pars= list( pars )
+        return
+
     def solve( self, lBlobel=True ):
         self.__setParameters()
         self.minuitCommand( "MIGRAD" )
@@ -123,46 +142,48 @@ class minuitSolver():
         return
 
     def getPars( self ):
-        pars, parerrors= self.__getPars()
-        return pars
+        pars, parerrors, covm, corrm= self.getResults()
+        return pars.tolist()
     def getUparv( self ):
         pars= self.getPars()
         parv= matrix( pars )
         parv.shape= (len(pars),1)
         return parv
     def getParErrors( self ):
-        pars, parerrors= self.__getPars()
-        return parerrors
-    def __getPars( self ):
-        pars= []
-        parerrors= []
-        for ipar in range( len( self.__pars ) ):
-            par= c_double()
-            pare= c_double()
-            ivarbl= self.__minuit.GetParameter( ipar, par, pare )
-            if ivarbl < 0:
-                message= "Parameter " + str(ipar) + " not defined"
-                raise MinuitError( message )
-            pars.append( par.value )
-            parerrors.append( pare.value )
-        return pars, parerrors
-
+        pars, parerrors, covm, corrm= self.getResults()
+        return parerrors.tolist()
     def getCovariancematrix( self ):
-        npar= len( self.__pars )
-        covm= array( npar**2*[ 0.0 ], dtype="double" )
-        self.__minuit.mnemat( covm, npar )
-        covm.shape= (npar,npar)
+        pars, parerrors, covm, corrm= self.getResults()
         return covm
-
     def getCorrelationmatrix( self ):
-        covm= self.getCovariancematrix()
-        corrm= covm.copy()
-        npar= len( self.__pars )
-        for i in range( npar ):
-            for j in range( npar ):
-                corrm[i,j]= covm[i,j]/sqrt(covm[i,i]*covm[j,j])
+        pars, parerrors, covm, corrm= self.getResults()
         return corrm
 
+    # Parameters, errors, covariance and correlation matrix as arrays, 
+    # read from TMinuit once after each minuit command:
+    def getResults( self ):
+        if self.__results is None:
+            npar= len( self.__pars )
+            pars= zeros( npar )
+            parerrors= zeros( npar )
+            par= c_double()
+            pare= c_double()
+            for ipar in range( npar ):
+                ivarbl= self.__minuit.GetParameter( ipar, par, pare )
+                if ivarbl < 0:
+                    message= "Parameter " + str(ipar) + " not defined"
+                    raise MinuitError( message )
+                pars[ipar]= par.value
+                parerrors[ipar]= pare.value
+            covm= zeros( npar**2 )
+            self.__minuit.mnemat( covm, npar )
+            covm.shape= (npar,npar)
+            diagerrors= sqrt( diagonal( covm ) )
+            corrm= covm/outer( diagerrors, diagerrors )
+            self.__results= ( pars, parerrors, covm, corrm )
+        pars, parerrors, covm, corrm= self.__results
+        return pars.copy(), parerrors.copy(), covm.copy(), corrm.copy()
+
     def __getStat( self ):
         fmin= c_double()
         fedm= c_double()
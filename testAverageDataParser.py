@@ -6,8 +6,142 @@
 import unittest
 
 from AverageDataParser import AverageDataParser, stripLeadingDigits
+from AverageDataParser import readSections, readSectionsConfigparser
+from AverageDataParser import toFloatArray
+import numpy
 from numpy import matrix
-from math import log
+from math import log, sqrt
+import os
+import tempfile
+import configparser
+
+
+# Element by element covariance calculation as reference for
+# the vectorised covariance calculation in AverageDataParser:
+def loopCovariance( covoption, errors, iderr1, iderr2 ):
+    err1= errors[iderr1]
+    err2= errors[iderr2]
+    if "f" in covoption:
+        cov= err1*err2
+    elif "a" in covoption:
+        if iderr1 == iderr2:
+            cov= err1**2
+        else:
+            cov= -err1*err2
+    elif "p" in covoption:
+        cov= min( err1, err2 )**2
+    elif "u" in covoption:
+        if iderr1 == iderr2:
+            cov= err1**2
+        else:
+            cov= 0.0
+    return cov
+
+def loopCovariances( parser ):
+    inputs= parser.getValues()
+    herrors= parser.getErrors()
+    hcovopts= parser.getCovoption()
+    correlations= parser.getCorrelations()
+    errorkeys= sorted( herrors.keys() )
+    hcov= {}
+    hredcov= {}
+    systerrormatrix= {}
+    for errorkey in errorkeys:
+        nerr= errorkeys.index( errorkey )
+        errors= herrors[errorkey]
+        nerrors= len( errors )
+        covoption= hcovopts[errorkey]
+        lcov= []
+        lredcov= []
+        if "gpr" in covoption:
+            minrelerr= min( [ err/value for err, value in
+                              zip( errors, inputs ) if err > 0.0 ] )
+            for iderr1 in range( nerrors ):
+                for iderr2 in range( nerrors ):
+                    if iderr1 == iderr2:
+                        lcov.append( errors[iderr1]**2 )
+                        redcovelement= errors[iderr1]**2 - (minrelerr*inputs[iderr1])**2
+                        lredcov.append( max( redcovelement, 0.0 ) )
+                    else:
+                        lcov.append( minrelerr**2*inputs[iderr1]*inputs[iderr2] )
+                        lredcov.append( 0.0 )
+            systerrormatrix[nerr]= [ minrelerr*value for value in inputs ]
+        elif "gp" in covoption:
+            minerr= min( [ error for error in errors if error > 0.0 ] )
+            for iderr1 in range( nerrors ):
+                for iderr2 in range( nerrors ):
+                    if iderr1 == iderr2:
+                        lcov.append( errors[iderr1]**2 )
+                        lredcov.append( errors[iderr1]**2 - minerr**2 )
+                    else:
+                        lcov.append( minerr**2 )
+                        lredcov.append( 0.0 )
+            systerrormatrix[nerr]= nerrors*[ minerr ]
+        elif( "f" in covoption or "p" in covoption or
+              "u" in covoption or "a" in covoption ):
+            lcov= [ loopCovariance( covoption, errors, iderr1, iderr2 )
+                    for iderr1 in range( nerrors )
+                    for iderr2 in range( nerrors ) ]
+            if "f" in covoption:
+                systerrormatrix[nerr]= errors
+                lredcov= nerrors**2*[ 0.0 ]
+            else:
+                lredcov= lcov
+        elif "c" in covoption:
+            corrlist= correlations[errorkey]
+            err1err2= [ err1*err2 for err1 in errors for err2 in errors ]
+            lcov= [ corr*errprod
+                    for corr, errprod in zip( corrlist, err1err2 ) ]
+            if "o" in covoption:
+                for iderr1 in range( nerrors ):
+                    for iderr2 in range( nerrors ):
+                        if errors[iderr1] > 0.0 and errors[iderr2] > 0.0:
+                            ierr= iderr1*nerrors+iderr2
+                            lcov[ierr]= min( lcov[ierr],
+                                             min( errors[iderr1], errors[iderr2] )**2 )
+            lredcov= lcov
+        elif "m" in covoption:
+            mcovopts= correlations[errorkey]
+            iderr1err2= [ ( iderr1, iderr2 ) for iderr1 in range( nerrors )
+                          for iderr2 in range( nerrors ) ]
+            lcov= [ loopCovariance( mcovopt, errors, iderr[0], iderr[1] )
+                    for mcovopt, iderr in zip( mcovopts, iderr1err2 ) ]
+            if "f" in mcovopts and not "p" in mcovopts:
+                systerrormatrix[nerr]= errors
+                lredcov= nerrors**2*[ 0.0 ]
+            else:
+                lredcov= lcov
+        # Correlation factor for off-diagonal elements:
+        hglobals= parser.getGlobals()
+        if "correlationfactor" in hglobals:
+            corrfac= hglobals["correlationfactor"]
+            lcov= list( lcov )
+            for iderr1 in range( nerrors ):
+                for iderr2 in range( nerrors ):
+                    var1= lcov[iderr1*nerrors+iderr1]
+                    var2= lcov[iderr2*nerrors+iderr2]
+                    if iderr1 != iderr2 and var1*var2 != 0.0:
+                        ierr= iderr1*nerrors+iderr2
+                        lcov[ierr]*= lcov[ierr]/sqrt( var1*var2 )*corrfac
+        hcov[errorkey]= lcov
+        hredcov[errorkey]= lredcov
+    # "fq": fully correlated errors from the average with the reduced
+    # covariance matrix:
+    ndim= len( inputs )
+    redcov= sum( matrix( hredcov[errorkey] ).reshape( ndim, ndim ) 
+                 for errorkey in errorkeys )
+    for errorkey in errorkeys:
+        if "fq" in hcovopts[errorkey]:
+            gm= matrix( parser.getGroupMatrix() )
+            inv= redcov.getI()
+            wm= ( gm.getT()*inv*gm ).getI()*gm.getT()*inv
+            values= matrix( inputs ).getT()
+            avg= wm*values
+            relerrs= matrix( herrors[errorkey] ).getT()/values
+            avgerrs= [ avgerr.item() for avgerr in numpy.multiply( gm*avg, relerrs ) ]
+            hcov[errorkey]= [ err1*err2 for err1 in avgerrs for err2 in avgerrs ]
+            systerrormatrix[errorkeys.index( errorkey )]= avgerrs
+    return hcov, hredcov, systerrormatrix
 
 
 class AverageDataParserLogNormalTest( unittest.TestCase ):
@@ -182,6 +316,11 @@ class AverageDataParserTest( unittest.TestCase ):
                 self.assertAlmostEqual( cov, expectedcov )
         return
 
+    def test_getTotalLowRankCovariance( self ):
+        lowrankcov= self.__parser.getTotalLowRankCovariance()
+        self.assertIsNone( lowrankcov )
+        return
+
     def test_getTotalReducedCovariance( self ):
         totalredcov= self.__parser.getTotalReducedCovariance()
         expectedtotalredcov= matrix( [ [ 7.06, 6.97, 6.97  ],
@@ -318,14 +457,252 @@ class AverageDataParserOptionsTest( unittest.TestCase ):
         expectedRvalue= { "errc": 0.1 }
         self.assertEqual( rvalue, expectedRvalue )
         return
+
+    def test_LowRankCovariances( self ):
+        hlowrank= self.__parser.getLowRankCovariances()
+        covariances= self.__parser.getCovariances()
+        self.assertEqual( sorted( hlowrank.keys() ), 
+                          [ '01erra', '02errb', '03errc' ] )
+        for key in hlowrank.keys():
+            diagonal, vector= hlowrank[key]
+            cov= numpy.diag( diagonal ) + numpy.outer( vector, vector )
+            for element, expectedelement in zip( cov.flat, 
+                                                 covariances[key].flat ):
+                self.assertAlmostEqual( element, expectedelement )
+        return
+
+    def test_TotalLowRankCovariance( self ):
+        diagonal, vectors= self.__parser.getTotalLowRankCovariance()
+        totalcov= numpy.diag( diagonal ) + numpy.dot( vectors, vectors.T )
+        expectedtotalcov= self.__parser.getTotalCovariance()
+        self.assertEqual( vectors.shape, ( 3, 3 ) )
+        for element, expectedelement in zip( totalcov.flat, 
+                                             expectedtotalcov.flat ):
+            self.assertAlmostEqual( element, expectedelement )
+        return
     
 
+class AverageDataParserCovariancesTest( unittest.TestCase ):
+
+    filenames= [ "test.txt", "testOptions.txt", 
+                 "testCorrelationFactor.txt", "testFq.txt",
+                 "valassi1.txt", "valassi2.txt", "valassi3.txt", 
+                 "valassi4.txt", "valassi5.txt", "valassi6.txt",
+                 "valassi7.txt" ]
+
+    def __compare( self, llogNormal ):
+        for filename in self.filenames:
+            parser= AverageDataParser( filename, llogNormal )
+            hcov, hredcov, systerrormatrix= loopCovariances( parser )
+            covariances= parser.getCovariances()
+            redcovariances= parser.getReducedCovariances()
+            self.assertEqual( sorted( covariances.keys() ), sorted( hcov.keys() ) )
+            for key in hcov.keys():
+                self.assertEqual( covariances[key].size, len( hcov[key] ) )
+                for cov, expectedcov in zip( covariances[key].flat, hcov[key] ):
+                    self.assertAlmostEqual( cov, expectedcov, places=10 )
+                for cov, expectedcov in zip( redcovariances[key].flat, 
+                                             hredcov[key] ):
+                    self.assertAlmostEqual( cov, expectedcov, places=10 )
+            systerrmatrix= parser.getSysterrorMatrix()
+            self.assertEqual( sorted( systerrmatrix.keys() ), 
+                              sorted( systerrormatrix.keys() ) )
+            for key in systerrormatrix.keys():
+                for systerr, expectedsysterr in zip( systerrmatrix[key],
+                                                     systerrormatrix[key] ):
+                    self.assertAlmostEqual( systerr, expectedsysterr, places=10 )
+        return
+
+    def test_loopCovariances( self ):
+        self.__compare( False )
+        return
+
+    def test_loopCovariancesLogNormal( self ):
+        self.__compare( True )
+        return
+
+    def test_fromData( self ):
+        for filename in self.filenames:
+            sections= readSections( filename )
+            data= dict( sections["Data"] )
+            names= data.pop( "names" ).split()
+            values= [ float( value ) for value in data.pop( "values" ).split() ]
+            groups= data.pop( "groups" ).split() if "groups" in data else None
+            errors= {}
+            covoptions= {}
+            for key, value in data.items():
+                errors[key]= [ float( error ) for error in value.split()[:-1] ]
+                covoptions[key]= value.split()[-1]
+            correlations= {}
+            for key, value in sections.get( "Covariances", {} ).items():
+                if "c" in covoptions[key]:
+                    correlations[key]= numpy.array( value.split(), dtype=float )
+                else:
+                    correlations[key]= numpy.array( value.split() ).reshape( 
+                        len( values ), len( values ) )
+            for llogNormal in [ False, True ]:
+                parser= AverageDataParser( filename, llogNormal )
+                dataparser= AverageDataParser.fromData( names, values, errors, 
+                                                        covoptions, correlations,
+                                                        groups, 
+                                                        sections.get( "Rvalues" ),
+                                                        sections.get( "Globals" ),
+                                                        llogNormal )
+                self.assertEqual( dataparser.getNames(), parser.getNames() )
+                self.assertEqual( dataparser.getValues(), parser.getValues() )
+                self.assertEqual( dataparser.getErrors(), parser.getErrors() )
+                self.assertEqual( dataparser.getGroupMatrix(), 
+                                  parser.getGroupMatrix() )
+                self.assertEqual( dataparser.getRvalues(), parser.getRvalues() )
+                self.assertEqual( dataparser.getSysterrorMatrix(), 
+                                  parser.getSysterrorMatrix() )
+                self.assertTrue( numpy.array_equal( dataparser.getTotalCovariance(),
+                                                    parser.getTotalCovariance() ) )
+                self.assertTrue( numpy.array_equal( dataparser.getTotalReducedCovariance(),
+                                                    parser.getTotalReducedCovariance() ) )
+        return
+
+    def test_readSections( self ):
+        for filename in self.filenames:
+            self.assertEqual( readSections( filename ), 
+                              readSectionsConfigparser( filename ) )
+        inputs= [ "[Data]\nA:\n  1 2\n\n  3\n\n# comment\n[C]\n  B = x\n   y\n  c: z\n",
+                  "[Data]\nA: 1\n\tB: 2\n; comment\n [C] x\n  d= [e]\n",
+                  "[Data]\nA: 1\n  # comment\n  2\n[DEFAULT]\nx: 1\n" ]
+        malformed= [ ( "A: 1\n[Data]\n", configparser.MissingSectionHeaderError ),
+                     ( "[Data]\nA: 1\n[Data]\n", configparser.DuplicateSectionError ),
+                     ( "[Data]\nA: 1\na= 2\n", configparser.DuplicateOptionError ),
+                     ( "[Data]\nA 1\n", configparser.ParsingError ),
+                     ( "[Data]\n: 1\n", configparser.ParsingError ) ]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename= os.path.join( tmpdir, "input.txt" )
+            for text in inputs:
+                with open( filename, "w" ) as outfile:
+                    outfile.write( text )
+                self.assertEqual( readSections( filename ), 
+                                  readSectionsConfigparser( filename ) )
+            for text, error in malformed:
+                with open( filename, "w" ) as outfile:
+                    outfile.write( text )
+                self.assertRaises( error, readSectionsConfigparser, filename )
+                self.assertRaises( error, readSections, filename )
+        self.assertEqual( toFloatArray( "1.5 2\n  -3e-2" ).tolist(), 
+                          [ 1.5, 2.0, -0.03 ] )
+        self.assertRaises( ValueError, toFloatArray, "1.5 x 2" )
+        return
+
+    def test_missingInput( self ):
+        data= "[Data]\nNames: A B\nValues: 1.0 2.0\n"
+        missing= [ ( "", configparser.NoSectionError ),
+                   ( "A: 1\n[Data]\n", configparser.MissingSectionHeaderError ),
+                   ( data+"00stat: 0.1 0.2 c\n", configparser.NoSectionError ),
+                   ( data+"00stat: 0.1 0.2 c\n[Covariances]\n01err: 1 0 0 1\n", 
+                     configparser.NoOptionError ),
+                   ( data+"00stat: 0.1 0.2 gpR\n", configparser.NoSectionError ),
+                   ( data+"00stat: 0.1 0.2 gpR\n[Rvalues]\n01err: 0.1\n", 
+                     configparser.NoOptionError ) ]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename= os.path.join( tmpdir, "input.txt" )
+            self.assertRaises( configparser.NoSectionError, AverageDataParser,
+                               os.path.join( tmpdir, "missing.txt" ) )
+            for text, error in missing:
+                with open( filename, "w" ) as outfile:
+                    outfile.write( text )
+                self.assertRaises( error, AverageDataParser, filename )
+        return
+
+    def test_npyCorrelations( self ):
+        parser= AverageDataParser( "valassi2.txt" )
+        with tempfile.TemporaryDirectory() as tmpdir:
+            correlations= numpy.array( parser.getCorrelations()["01stat"] )
+            for order in [ "C", "F" ]:
+                numpy.save( os.path.join( tmpdir, "corr.npy" ), 
+                            correlations.reshape( 4, 4 ).copy( order=order ) )
+                filename= os.path.join( tmpdir, "valassi2npy.txt" )
+                with open( "valassi2.txt" ) as infile, open( filename, "w" ) as outfile:
+                    for line in infile:
+                        if line.startswith( "[Covariances]" ):
+                            break
+                        outfile.write( line )
+                    outfile.write( "[Covariances]\n01stat: corr.npy\n" )
+                npyparser= AverageDataParser( filename )
+                # Mapped, not copied:
+                npycorrelations= npyparser.getCorrelations()["01stat"]
+                self.assertIsInstance( npycorrelations, numpy.memmap )
+                self.assertIsNotNone( npycorrelations.filename )
+                del npycorrelations
+                self.assertTrue( numpy.array_equal( npyparser.getTotalCovariance(),
+                                                    parser.getTotalCovariance() ) )
+                del npyparser
+        return
+
+    def test_cache( self ):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename= os.path.join( tmpdir, "testOptions.txt" )
+            with open( "testOptions.txt" ) as infile:
+                inputs= infile.read()
+            with open( filename, "w" ) as outfile:
+                outfile.write( inputs )
+            parser= AverageDataParser( filename )
+            cachedparser= AverageDataParser( filename, lCache=True )
+            self.assertTrue( os.path.exists( filename + ".npz" ) )
+            for iparser in range( 2 ):
+                self.assertEqual( cachedparser.getValues(), parser.getValues() )
+                self.assertEqual( cachedparser.getErrors(), parser.getErrors() )
+                self.assertEqual( cachedparser.getCovoption(), 
+                                  parser.getCovoption() )
+                self.assertEqual( cachedparser.getRvalues(), parser.getRvalues() )
+                self.assertEqual( cachedparser.getSysterrorMatrix(), 
+                                  parser.getSysterrorMatrix() )
+                self.assertTrue( numpy.array_equal( cachedparser.getTotalCovariance(),
+                                                    parser.getTotalCovariance() ) )
+                cachedparser= AverageDataParser( filename, lCache=True )
+            with open( filename, "w" ) as outfile:
+                outfile.write( inputs.replace( "171.5", "170.5" ) )
+            cachedparser= AverageDataParser( filename, lCache=True )
+            self.assertEqual( cachedparser.getValues()[0], 170.5 )
+        return
+
+    # Unreadable caches are ignored and written again:
+    def test_corruptCache( self ):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename= os.path.join( tmpdir, "testOptions.txt" )
+            with open( "testOptions.txt" ) as infile, open( filename, "w" ) as outfile:
+                outfile.write( infile.read() )
+            cachename= filename + ".npz"
+            parser= AverageDataParser( filename, lCache=True )
+            with open( cachename, "rb" ) as cachefile:
+                cache= cachefile.read()
+            with numpy.load( cachename ) as npz:
+                arrays= { name: npz[name] for name in npz.files }
+            hcovname= [ name for name in arrays if name.startswith( "hcov/" ) ][0]
+            withouthcov= dict( arrays )
+            del withouthcov[hcovname]
+            withoutnames= dict( arrays )
+            del withoutnames["names"]
+            withoutnames["members"]= numpy.array( sorted( set( withoutnames.keys() ) -
+                                                          set( [ "members" ] ) ) )
+            truncated= lambda: open( cachename, "wb" ).write( cache[:len( cache )//2] )
+            for writeCache in [ truncated,
+                                lambda: numpy.savez( cachename, **withouthcov ),
+                                lambda: numpy.savez( cachename, **withoutnames ) ]:
+                writeCache()
+                cachedparser= AverageDataParser( filename, lCache=True )
+                self.assertEqual( cachedparser.getValues(), parser.getValues() )
+                self.assertTrue( numpy.array_equal( cachedparser.getTotalCovariance(),
+                                                    parser.getTotalCovariance() ) )
+                with open( cachename, "rb" ) as cachefile:
+                    self.assertEqual( cachefile.read(), cache )
+        return
+
+
 if __name__ == '__main__':
     suite1= unittest.TestLoader().loadTestsFromTestCase( AverageDataParserTest )
     suite2= unittest.TestLoader().loadTestsFromTestCase( AverageDataParserLogNormalTest )
     suite3= unittest.TestLoader().loadTestsFromTestCase( AverageDataParserGroupTest )
     suite4= unittest.TestLoader().loadTestsFromTestCase( AverageDataParserOptionsTest )
-    for suite in [ suite1, suite2, suite3, suite4 ]:
+    suite5= unittest.TestLoader().loadTestsFromTestCase( AverageDataParserCovariancesTest )
+    for suite in [ suite1, suite2, suite3, suite4, suite5 ]:
         unittest.TextTestRunner( verbosity=2 ).run( suite )
 
 
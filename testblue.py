@@ -6,6 +6,7 @@
 
 import unittest
 from math import sqrt
+import numpy
 
 from blue import Blue
 
@@ -58,6 +59,96 @@ class blueTest( unittest.TestCase ):
             self.assertAlmostEqual( error, expectedherrors[key] )
         return
 
+    def test_calcAverages( self ):
+        values= [ [ 171.5, 173.1, 174.5 ],
+                  [ 172.5, 174.1, 175.5 ],
+                  [ 171.0, 173.1, 176.5 ] ]
+        averages, errors, chisqs= self.__blue.calcAverages( values )
+        self.assertEqual( averages.shape, ( 3, 1 ) )
+        self.assertAlmostEqual( averages[0,0], 170.70919692 )
+        self.assertAlmostEqual( averages[1,0], 171.70919692 )
+        self.assertAlmostEqual( chisqs[0], 0.770025093468 )
+        self.assertAlmostEqual( chisqs[1], 0.770025093468 )
+        for error in errors.flat:
+            self.assertAlmostEqual( error, 2.9668615983552984 )
+        self.__blue.data= self.__blue._columnVector( values[2] )
+        self.assertAlmostEqual( averages[2,0], float( self.__blue.calcAverage() ) )
+        self.assertAlmostEqual( chisqs[2], self.__blue.calcChisq() )
+        # Stacked covariance matrices, scaled by 1, 2 and 4:
+        cov= self.__blue.cov
+        covs= [ cov, 2.0*cov, 4.0*cov ]
+        stackedaverages, stackederrors, stackedchisqs= self.__blue.calcAverages( values, covs )
+        for i, scale in enumerate( [ 1.0, 2.0, 4.0 ] ):
+            self.assertAlmostEqual( stackedaverages[i,0], averages[i,0] )
+            self.assertAlmostEqual( stackederrors[i,0], sqrt( scale )*errors[i,0] )
+            self.assertAlmostEqual( stackedchisqs[i], chisqs[i]/scale )
+        return
+
+    def test_scanCorrelations( self ):
+        cov= self.__blue.cov.copy()
+        keys= [ "01err1", "02err2", "03err3", "04err4" ]
+        # Factors of the input options "p" and "f" give the input average:
+        factors= [ [ 0.0, 1.0, 0.0, 1.0 ], [ 1.0, 1.0, 1.0, 1.0 ] ]
+        averages, errors, weights, chisqs= self.__blue.scanCorrelations( factors, keys )
+        self.assertEqual( weights.shape, ( 2, 1, 3 ) )
+        self.assertAlmostEqual( averages[0,0], 170.70919692 )
+        self.assertAlmostEqual( errors[0,0], 2.9668615983552984 )
+        self.assertAlmostEqual( chisqs[0], 0.770025093468 )
+        wm= self.__blue.calcWeightsMatrix()
+        for weight, expectedweight in zip( weights[0].flat, wm.flat ):
+            self.assertAlmostEqual( weight, expectedweight )
+        # Blue object not modified:
+        self.assertTrue( numpy.all( self.__blue.cov == cov ) )
+        # Same factor for all sources:
+        scanaverages, scanerrors, scanweights, scanchisqs= self.__blue.scanCorrelations( numpy.linspace( 0.0, 1.0, 11 ) )
+        self.assertEqual( scanaverages.shape, ( 11, 1 ) )
+        self.assertAlmostEqual( scanaverages[10,0], averages[1,0] )
+        self.assertAlmostEqual( scanerrors[10,0], errors[1,0] )
+        # All "p" sources fully correlated:
+        herrors= self.__blue.errors
+        err1= numpy.array( herrors["01err1"] )
+        err3= numpy.array( herrors["03err3"] )
+        self.__blue.cov= ( cov + numpy.outer( err1, err1 ) - self.__blue.hcov["01err1"] 
+                           + numpy.outer( err3, err3 ) - self.__blue.hcov["03err3"] )
+        self.assertAlmostEqual( averages[1,0], float( self.__blue.calcAverage() ) )
+        self.assertAlmostEqual( chisqs[1], self.__blue.calcChisq() )
+        return
+
+    def test_cachedResults( self ):
+        solvecalls= []
+        solveCov= self.__blue._solveCov
+        def countingSolveCov( rhs ):
+            solvecalls.append( rhs )
+            return solveCov( rhs )
+        self.__blue._solveCov= countingSolveCov
+        import io, sys
+        sys.stdout= io.StringIO()
+        self.__blue.printResults()
+        self.__blue.printErrorsAndWeights( True )
+        sys.stdout= sys.__stdout__
+        self.assertEqual( len( solvecalls ), 1 )
+        # New input values discard the results:
+        self.__blue.data= self.__blue.data + 1.0
+        value= float( self.__blue.calcAverage() )
+        self.assertAlmostEqual( value, 171.70919692 )
+        self.assertEqual( len( solvecalls ), 2 )
+        return
+
+    def test_assignInverse( self ):
+        wm= self.__blue.calcWeightsMatrix()
+        chisq= self.__blue.calcChisq()
+        # Inverse of twice the covariance matrix, same weights and half
+        # the chi^2:
+        self.__blue.inv= self.__blue.inv/2.0
+        for weight, expectedweight in zip( self.__blue.calcWeightsMatrix().flat,
+                                           wm.flat ):
+            self.assertAlmostEqual( weight, expectedweight )
+        self.assertAlmostEqual( self.__blue.calcChisq(), chisq/2.0 )
+        # A new covariance matrix replaces the inverse:
+        self.__blue.cov= self.__blue.cov.copy()
+        self.assertAlmostEqual( self.__blue.calcChisq(), chisq )
+        return
+
     def test_printResults( self ):
         import io, sys
         output= io.StringIO()
@@ -180,6 +271,19 @@ Correlations:\n\
         self.assertEqual( printout, expectedprintout )
         return
 
+    def test_fromData( self ):
+        correlations= numpy.eye( 4 )
+        correlations[0,1]= correlations[1,0]= 0.15
+        bluesolver= Blue.fromData( [ "BeA", "BeB", "BtauA", "BtauB" ],
+                                   [ 10.5, 13.5, 9.5, 14.0 ],
+                                   { "01stat": [ 1.0, 3.0, 3.0, 3.0 ] },
+                                   { "01stat": "c" },
+                                   { "01stat": correlations },
+                                   groups=[ "a", "a", "b", "b" ] )
+        expectedprintout= self.__getprintResults( Blue( "valassi2.txt" ) )
+        self.assertEqual( self.__getprintResults( bluesolver ), expectedprintout )
+        return
+
     def test_valassi3( self ):
         bluesolver= Blue( "valassi3.txt" )
         printout= self.__getprintResults( bluesolver )
@@ -282,6 +386,171 @@ Correlations:\n\
         self.assertEqual( printout, expectedprintout )
         return
 
+    def test_lowRankWeights( self ):
+        bluesolver= Blue( "valassi5.txt" )
+        wm= bluesolver.calcWeightsMatrix()
+        chisq= bluesolver.calcChisq()
+        # Assigning the total covariance matrix discards its low 
+        # rank form and the dense solver is used instead:
+        bluesolver.cov= bluesolver.cov.copy()
+        expectedwm= bluesolver.calcWeightsMatrix()
+        expectedchisq= bluesolver.calcChisq()
+        for weight, expectedweight in zip( wm.flat, expectedwm.flat ):
+            self.assertAlmostEqual( weight, expectedweight )
+        self.assertAlmostEqual( chisq, expectedchisq )
+        return
+
+    def __numericalDerivatives( self, bluesolver, dcov, eps=1.0e-5 ):
+        cov= bluesolver.cov.copy()
+        results= []
+        for sign in [ 1.0, -1.0 ]:
+            bluesolver.cov= cov + sign*eps*dcov
+            wm= bluesolver.calcWeightsMatrix()
+            errors= numpy.sqrt( numpy.diag( wm*bluesolver.cov*wm.T ) )
+            results.append( ( numpy.asarray( bluesolver.calcAverage() )[:,0], 
+                              errors ) )
+        bluesolver.cov= cov
+        davg= ( results[0][0] - results[1][0] )/( 2.0*eps )
+        derr= ( results[0][1] - results[1][1] )/( 2.0*eps )
+        return davg, derr
+
+    def test_correlationDerivatives( self ):
+        bluesolver= Blue( "valassi3.txt" )
+        cov= numpy.asarray( bluesolver.cov )
+        hderivatives= bluesolver.calcCorrelationDerivatives()
+        hscalederivatives= bluesolver.calcCorrelationScaleDerivatives()
+        offdiagonal= ~numpy.eye( cov.shape[0], dtype=bool )
+        for key in hderivatives:
+            davgs, derrs= hderivatives[key]
+            self.assertEqual( davgs.shape, ( 2, 4, 4 ) )
+            sourcecov= numpy.asarray( bluesolver.hcov[key] )
+            errors= numpy.sqrt( numpy.diag( sourcecov ) )
+            dcov= numpy.zeros( cov.shape )
+            dcov[0,2]= dcov[2,0]= errors[0]*errors[2]
+            davg, derr= self.__numericalDerivatives( bluesolver, dcov )
+            for iavg in range( 2 ):
+                self.assertAlmostEqual( davgs[iavg,0,2], davg[iavg], places=5 )
+                self.assertAlmostEqual( davgs[iavg,2,0], davg[iavg], places=5 )
+                self.assertAlmostEqual( derrs[iavg,0,2], derr[iavg], places=5 )
+            davg, derr= self.__numericalDerivatives( bluesolver, 
+                                                     sourcecov*offdiagonal )
+            for iavg in range( 2 ):
+                self.assertAlmostEqual( hscalederivatives[key][0][iavg], 
+                                        davg[iavg], places=5 )
+                self.assertAlmostEqual( hscalederivatives[key][1][iavg], 
+                                        derr[iavg], places=5 )
+        davgs, derrs= bluesolver.calcCorrelationFactorDerivatives()
+        davg, derr= self.__numericalDerivatives( bluesolver, cov*offdiagonal )
+        for iavg in range( 2 ):
+            self.assertAlmostEqual( davgs[iavg], davg[iavg], places=5 )
+            self.assertAlmostEqual( derrs[iavg], derr[iavg], places=5 )
+        return
+
+    def test_lowRankSources( self ):
+        bluesolver= Blue( "test.txt" )
+        self.assertEqual( sorted( bluesolver.hlowrank.keys() ), [ "04err4" ] )
+        self.assertNotIn( "04err4", bluesolver.hdensecov )
+        self.assertEqual( sorted( bluesolver.hcov.keys() ), 
+                          sorted( bluesolver.errors.keys() ) )
+        hscalederivatives= bluesolver.calcCorrelationScaleDerivatives()
+        self.assertEqual( sorted( hscalederivatives.keys() ), 
+                          sorted( bluesolver.errors.keys() ) )
+        diagonal, vector= bluesolver.hlowrank["04err4"]
+        self.assertTrue( numpy.allclose( bluesolver.hcov["04err4"],
+                                         numpy.diag( diagonal ) + 
+                                         numpy.outer( vector, vector ) ) )
+        dcov= numpy.outer( vector, vector ) - numpy.diag( vector**2 )
+        davg, derr= self.__numericalDerivatives( bluesolver, dcov )
+        self.assertAlmostEqual( hscalederivatives["04err4"][0][0], davg[0], 
+                                places=5 )
+        self.assertAlmostEqual( hscalederivatives["04err4"][1][0], derr[0], 
+                                places=5 )
+        return
+
+    def test_correlationFactorDerivativesFq( self ):
+        def makeBlue( corrfac ):
+            return Blue.fromData( [ "Val1", "Val2", "Val3" ],
+                                  [ 171.5, 173.1, 174.5 ],
+                                  { "00stat": [ 0.3, 0.33, 0.4 ],
+                                    "01err1": [ 1.1, 1.3, 1.5 ],
+                                    "02err2": [ 2.4, 3.1, 3.5 ] },
+                                  { "00stat": "u", "01err1": "p", 
+                                    "02err2": "fq" },
+                                  globalvalues={ "correlationfactor": corrfac } )
+        davgs, derrs= makeBlue( 0.5 ).calcCorrelationFactorDerivatives()
+        eps= 1.0e-5
+        results= []
+        for corrfac in [ 0.5 + eps, 0.5 - eps ]:
+            results.append( makeBlue( corrfac ).getAveragesAndErrors() )
+        davg= ( results[0][0][0] - results[1][0][0] )/( 2.0*eps )
+        derr= ( results[0][1][0] - results[1][1][0] )/( 2.0*eps )
+        self.assertAlmostEqual( davgs[0], davg, places=5 )
+        self.assertAlmostEqual( derrs[0], derr, places=5 )
+        return
+
+    def test_errorComposition( self ):
+        for filename in [ "valassi3.txt", "valassi5.txt", "test.txt" ]:
+            bluesolver= Blue( filename )
+            composition= bluesolver.calcErrorComposition()
+            wm= bluesolver.calcWeightsMatrix()
+            hcov= bluesolver.dataparser.getCovariances()
+            self.assertEqual( composition.keys, sorted( hcov.keys() ) )
+            errors= composition.getErrors()
+            for key, covariance, error in zip( composition.keys, 
+                                               composition.covariances, 
+                                               errors ):
+                expectedcovariance= wm*hcov[key]*wm.T
+                for element, expectedelement in zip( covariance.flat, 
+                                                     expectedcovariance.flat ):
+                    self.assertAlmostEqual( element, expectedelement )
+                for iavg in range( len( error ) ):
+                    self.assertAlmostEqual( error[iavg], 
+                                            sqrt( expectedcovariance[iavg,iavg] ) )
+            totalerrors= composition.getTotalErrors()
+            expectedtotalcov= wm*bluesolver.cov*wm.T
+            for iavg in range( len( totalerrors ) ):
+                self.assertAlmostEqual( totalerrors[iavg], 
+                                        sqrt( expectedtotalcov[iavg,iavg] ) )
+                self.assertAlmostEqual( composition.getStatErrors()[iavg]**2 + 
+                                        composition.getSystErrors()[iavg]**2, 
+                                        totalerrors[iavg]**2 )
+        return
+
+    def test_informationAnalysis( self ):
+        for filename in [ "test.txt", "testFq.txt", "valassi3.txt", 
+                          "valassi5.txt" ]:
+            bluesolver= Blue( filename )
+            hinfos, hinfosums= bluesolver.informationAnalysis()
+            wm= bluesolver.calcWeightsMatrix()
+            hcov= bluesolver.dataparser.getCovariances()
+            navg, nvar= wm.shape
+            for iavg in range( navg ):
+                information= 1.0/float( wm[iavg]*bluesolver.cov*wm[iavg].T )
+                for key in hcov.keys():
+                    infom= hinfos[key]
+                    infosum= hinfosums[key]
+                    if navg > 1:
+                        infom= infom[iavg]
+                        infosum= infosum[iavg]
+                    expectedinfosum= 0.0
+                    for i in range( nvar ):
+                        for j in range( nvar ):
+                            info= -2.0*information*wm[iavg,i]*wm[iavg,j]*hcov[key][i,j]
+                            self.assertAlmostEqual( infom[i,j], info )
+                            if j > i:
+                                expectedinfosum+= info
+                    self.assertAlmostEqual( infosum, expectedinfosum )
+        return
+
+    def test_notPositiveDefinite( self ):
+        from AverageTools.covarianceSolver import CovarianceError
+        bluesolver= Blue( "valassi3.txt" )
+        cov= bluesolver.cov.copy()
+        cov[1,3]= cov[3,1]= 1.01*cov[1,1]
+        bluesolver.cov= cov
+        self.assertRaises( CovarianceError, bluesolver.calcAverage )
+        return
+
     def test_valassi7( self ):
         bluesolver= Blue( "valassi7.txt" )
         printout= self.__getprintResults( bluesolver )
@@ -4,8 +4,15 @@
 # S. Kluth 01/2012
 
 import unittest
+import numpy
+import importlib.util
+import sys
+import warnings
 
-from clsqAverage import clsqAverage
+from clsqAverage import clsqAverage, clsqAnalyticSolver
+from ConstrainedFit import clsq
+from blue import Blue
+from AverageTools.AverageDataParser import AverageDataParser
 
 
 class clsqAverageTest( unittest.TestCase ):
@@ -59,6 +66,188 @@ class clsqAverageTest( unittest.TestCase ):
             self.assertAlmostEqual( weight, expectedWeight )
         return
 
+    def test_weightsSolverReused( self ):
+        average= clsqAverage( "testOptions.txt" )
+        solver= average.getSolver()
+        val, error= average.getAveragesAndErrors()
+        average.calcWeightsMatrix()
+        self.assertIs( average.getSolver(), solver )
+        weightsval, weightserror= average.getAveragesAndErrors()
+        self.assertAlmostEqual( weightsval[0], val[0] )
+        self.assertAlmostEqual( weightserror[0], error[0] )
+        return
+
+    def test_analyticWeights( self ):
+        for filename in [ "test.txt", "valassi3.txt", "valassi5.txt" ]:
+            average= clsqAverage( filename )
+            expectedWeightsMatrix= average.calcWeightsMatrix()
+            average.setAnalyticWeights()
+            weightsMatrix= average.calcWeightsMatrix()
+            self.assertEqual( weightsMatrix.shape, expectedWeightsMatrix.shape )
+            for weight, expectedWeight in zip( weightsMatrix.flat, 
+                                               expectedWeightsMatrix.flat ):
+                self.assertAlmostEqual( weight, expectedWeight, places=5 )
+        return
+
+
+    def test_poolWeights( self ):
+        expectedWeightsMatrix= clsqAverage( "valassi3.txt" ).calcWeightsMatrix()
+        weightsMatrix= clsqAverage( "valassi3.txt" ).calcWeightsMatrix( nprocs=2 )
+        for weight, expectedWeight in zip( weightsMatrix.flat, 
+                                           expectedWeightsMatrix.flat ):
+            self.assertEqual( weight, expectedWeight )
+        return
+
+    def test_pickleState( self ):
+        import pickle
+        average= clsqAverage( "testOptions.txt" )
+        average.setAnalyticWeights()
+        solverdata= average._getSolverData()
+        solverdata[0]= 172.0
+        copy= pickle.loads( pickle.dumps( average ) )
+        self.assertAlmostEqual( float( copy._getAverage()[0,0] ), 
+                                float( average._getAverage()[0,0] ) )
+        average= clsqAverage( "test.txt" )
+        average.setAnalyticWeights()
+        copy= pickle.loads( pickle.dumps( average ) )
+        self.assertTrue( copy._FitAverage__lAnalyticWeights )
+        return
+
+    def test_relativeErrors( self ):
+        average= clsqAverage( "testOptions.txt" )
+        average.runSolver()
+        solver= average.getSolver()
+        self.assertAlmostEqual( solver.getPars()[0], 171.554013942, places=6 )
+        self.assertAlmostEqual( solver.getChisq(), 1.06053308010, places=6 )
+        for constraint in solver.getConstraints():
+            self.assertAlmostEqual( constraint, 0.0 )
+        return
+
+    def test_constraintDerivatives( self ):
+        for filename in [ "test.txt", "testOptions.txt", "valassi3.txt" ]:
+            average= clsqAverage( filename )
+            constrfun, constrderivs= average.getConstraintFunctions()
+            solver= average.getSolver()
+            mpar= numpy.array( solver.getMpars() ) + 0.1
+            upar= numpy.array( solver.getPars() ) - 0.2
+            mderivs, uderivs= constrderivs( mpar, upar )
+            for pars, derivs in [ ( mpar, mderivs ), ( upar, uderivs ) ]:
+                for ipar in range( len( pars ) ):
+                    parshi= pars.copy()
+                    parslo= pars.copy()
+                    parshi[ipar]+= 1.0e-5
+                    parslo[ipar]-= 1.0e-5
+                    if pars is mpar:
+                        consthi= constrfun( parshi, upar )
+                        constlo= constrfun( parslo, upar )
+                    else:
+                        consthi= constrfun( mpar, parshi )
+                        constlo= constrfun( mpar, parslo )
+                    for iconst in range( len( consthi ) ):
+                        derivative= ( consthi[iconst] - constlo[iconst] )/2.0e-5
+                        self.assertAlmostEqual( derivs[iconst,ipar], 
+                                                derivative, places=6 )
+        return
+
+    def test_analyticDerivatives( self ):
+        self.assertTrue( self.__ca.getSolver().hasAnalyticDerivatives() )
+        ncalls= { "constraints": 0, "derivatives": 0 }
+        def constrFun( mpar, upar ):
+            ncalls["constraints"]+= 1
+            return [ mpar[ival,0] - upar[0,0] for ival in range( 3 ) ]
+        def constrDerivatives( mpar, upar ):
+            ncalls["derivatives"]+= 1
+            return numpy.matrix( numpy.eye( 3 ) ), numpy.matrix( -numpy.ones( ( 3, 1 ) ) )
+        data= [ 171.5, 173.1, 174.5 ]
+        covm= numpy.diag( [ 0.09, 0.1089, 0.16 ] ).tolist()
+        solver= clsqAnalyticSolver( data, covm, [ 172.0 ], constrFun, 
+                                    constrDerivatives, ndof=2 )
+        solver.solve()
+        expectedsolver= clsq.clsqSolver( data, covm, [ 172.0 ], constrFun, 
+                                         ndof=2 )
+        nconstraints= ncalls["constraints"]
+        expectedsolver.solve()
+        self.assertGreater( ncalls["derivatives"], 0 )
+        # Numerical derivatives need 2 evaluations per parameter:
+        self.assertLess( nconstraints, ncalls["constraints"] - nconstraints )
+        self.assertAlmostEqual( solver.getPars()[0], 
+                                expectedsolver.getPars()[0], places=6 )
+        self.assertAlmostEqual( solver.getParErrors()[0], 
+                                expectedsolver.getParErrors()[0], places=6 )
+        return
+
+    def test_analyticDerivativesWithoutConstraints( self ):
+        def constrFun( mpar, upar ):
+            return [ mpar[ival,0] - upar[0,0] for ival in range( 3 ) ]
+        def constrDerivatives( mpar, upar ):
+            return numpy.matrix( numpy.eye( 3 ) ), numpy.matrix( -numpy.ones( ( 3, 1 ) ) )
+        data= [ 171.5, 173.1, 174.5 ]
+        covm= numpy.diag( [ 0.09, 0.1089, 0.16 ] ).tolist()
+        expectedsolver= clsq.clsqSolver( data, covm, [ 172.0 ], constrFun, 
+                                         ndof=2 )
+        expectedsolver.solve()
+        constraints= clsq.Constraints
+        del clsq.Constraints
+        try:
+            filename= sys.modules[clsqAverage.__module__].__file__
+            spec= importlib.util.spec_from_file_location( 
+                "clsqAverageWithoutConstraints", filename )
+            module= importlib.util.module_from_spec( spec )
+            spec.loader.exec_module( module )
+        finally:
+            clsq.Constraints= constraints
+        with warnings.catch_warnings( record=True ) as caught:
+            warnings.simplefilter( "always" )
+            solver= module.clsqAnalyticSolver( data, covm, [ 172.0 ], 
+                                               constrFun, constrDerivatives, 
+                                               ndof=2 )
+        self.assertTrue( any( "numerical derivatives" in str( warning.message )
+                              for warning in caught ) )
+        self.assertFalse( solver.hasAnalyticDerivatives() )
+        solver.solve()
+        self.assertAlmostEqual( solver.getPars()[0], 
+                                expectedsolver.getPars()[0], places=6 )
+        return
+
+    def test_mergeNuisances( self ):
+        average= clsqAverage( "testOptions.txt" )
+        mergedaverage= clsqAverage( "testOptions.txt", lMergeNuisances=True )
+        average.runSolver()
+        mergedaverage.runSolver()
+        solver= average.getSolver()
+        mergedsolver= mergedaverage.getSolver()
+        self.assertEqual( len( mergedsolver.getMpars() ), 
+                          len( solver.getMpars() ) - 1 )
+        self.assertAlmostEqual( mergedsolver.getPars()[0], 
+                                solver.getPars()[0], places=6 )
+        self.assertAlmostEqual( mergedsolver.getParErrors()[0], 
+                                solver.getParErrors()[0], places=6 )
+        self.assertAlmostEqual( mergedsolver.getChisq(), solver.getChisq() )
+        return
+
+    def test_sharedParser( self ):
+        dataparser= AverageDataParser( "testOptions.txt" )
+        expectedcov= dataparser.getTotalCovariance()
+        averages= [ Blue( dataparser ), clsqAverage( dataparser ), 
+                    clsqAverage( dataparser, lMergeNuisances=True ) ]
+        expectedaverages= [ Blue( "testOptions.txt" ), 
+                            clsqAverage( "testOptions.txt" ),
+                            clsqAverage( "testOptions.txt", 
+                                         lMergeNuisances=True ) ]
+        for average, expectedaverage in zip( averages, expectedaverages ):
+            self.assertIs( average._getDataparser(), dataparser )
+            val, error= average.getAveragesAndErrors()
+            expectedval, expectederror= expectedaverage.getAveragesAndErrors()
+            self.assertAlmostEqual( val[0], expectedval[0] )
+            self.assertAlmostEqual( error[0], expectederror[0] )
+        hcov= dataparser.getDenseCovariances()
+        for key in hcov.keys():
+            self.assertIs( hcov[key], averages[0].hcov[key] )
+            with self.assertRaises( ValueError ):
+                hcov[key][0,0]= 0.0
+        self.assertTrue( numpy.array_equal( dataparser.getTotalCovariance(),
+                                            expectedcov ) )
+        return
 
 if __name__ == '__main__':
     suite= unittest.TestLoader().loadTestsFromTestCase( clsqAverageTest )
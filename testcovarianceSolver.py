@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+# unit tests for covariance matrix solvers
+
+import unittest
+import numpy
+
+import covarianceSolver
+from covarianceSolver import ( denseCovarianceSolver, 
+                               lowRankCovarianceSolver,
+                               inverseCovarianceSolver,
+                               solveLowerTriangular,
+                               CovarianceError )
+
+
+class covarianceSolverTest( unittest.TestCase ):
+
+    def setUp( self ):
+        self.__diagonal= numpy.array( [ 0.09, 0.1089, 0.16, 0.25 ] )
+        self.__vectors= numpy.array( [ [ 1.4, 0.9 ],
+                                       [ 2.9, 1.5 ],
+                                       [ 3.3, 1.9 ],
+                                       [ 0.0, 2.1 ] ] )
+        self.__cov= ( numpy.diag( self.__diagonal ) + 
+                      numpy.dot( self.__vectors, self.__vectors.T ) )
+        self.__rhs= numpy.array( [ [ 1.0, 171.5 ],
+                                   [ 1.0, 173.1 ],
+                                   [ 1.0, 174.5 ],
+                                   [ 1.0, 170.0 ] ] )
+        return
+
+    def __assertArraysAlmostEqual( self, values, expectedvalues ):
+        for value, expectedvalue in zip( numpy.ravel( values ), 
+                                         numpy.ravel( expectedvalues ) ):
+            self.assertAlmostEqual( value, expectedvalue, places=8 )
+        return
+
+    def test_denseSolve( self ):
+        solver= denseCovarianceSolver( self.__cov )
+        solution= solver.solve( self.__rhs )
+        expectedsolution= numpy.linalg.solve( self.__cov, self.__rhs )
+        self.__assertArraysAlmostEqual( solution, expectedsolution )
+        return
+
+    def test_denseChisq( self ):
+        solver= denseCovarianceSolver( self.__cov )
+        delta= self.__rhs[:,1] - 172.0
+        chisq= solver.calcChisq( delta )
+        expectedchisq= numpy.dot( delta, numpy.linalg.solve( self.__cov, delta ) )
+        self.assertAlmostEqual( chisq, expectedchisq )
+        return
+
+    def test_denseNotPositiveDefinite( self ):
+        cov= numpy.array( [ [ 1.0, 0.0, 1.5 ],
+                            [ 0.0, 1.0, 0.0 ],
+                            [ 1.5, 0.0, 1.0 ] ] )
+        self.assertRaises( CovarianceError, denseCovarianceSolver, cov )
+        return
+
+    def test_solveLowerTriangular( self ):
+        lower= numpy.linalg.cholesky( self.__cov )
+        expectedsolution= numpy.linalg.solve( lower, self.__rhs )
+        expectedtranssolution= numpy.linalg.solve( lower.T, self.__rhs )
+        solve_triangular= covarianceSolver.solve_triangular
+        try:
+            for solver in [ solve_triangular, None ]:
+                covarianceSolver.solve_triangular= solver
+                self.__assertArraysAlmostEqual( 
+                    solveLowerTriangular( lower, self.__rhs ), 
+                    expectedsolution )
+                self.__assertArraysAlmostEqual( 
+                    solveLowerTriangular( lower, self.__rhs, ltrans=True ),
+                    expectedtranssolution )
+        finally:
+            covarianceSolver.solve_triangular= solve_triangular
+        return
+
+    def test_solveLowerTriangularStacked( self ):
+        lowers= numpy.array( [ numpy.linalg.cholesky( self.__cov*scale ) 
+                               for scale in [ 1.0, 2.0, 0.5 ] ] )
+        rhs= numpy.array( [ self.__rhs, 2.0*self.__rhs, -self.__rhs ] )
+        for lower, rhsi, solution, transsolution, sharedsolution in zip( 
+            lowers, rhs, solveLowerTriangular( lowers, rhs ), 
+            solveLowerTriangular( lowers, rhs, ltrans=True ),
+            solveLowerTriangular( lowers, self.__rhs ) ):
+            self.__assertArraysAlmostEqual( 
+                solution, numpy.linalg.solve( lower, rhsi ) )
+            self.__assertArraysAlmostEqual( 
+                transsolution, numpy.linalg.solve( lower.T, rhsi ) )
+            self.__assertArraysAlmostEqual( 
+                sharedsolution, numpy.linalg.solve( lower, self.__rhs ) )
+        return
+
+    def test_lowRankSolve( self ):
+        solver= lowRankCovarianceSolver( self.__diagonal, self.__vectors )
+        expectedsolution= numpy.linalg.solve( self.__cov, self.__rhs )
+        self.__assertArraysAlmostEqual( solver.solve( self.__rhs ), 
+                                        expectedsolution )
+        self.__assertArraysAlmostEqual( solver.solve( self.__rhs[:,1] ),
+                                        expectedsolution[:,1] )
+        return
+
+    def test_lowRankInverse( self ):
+        solver= lowRankCovarianceSolver( self.__diagonal, self.__vectors )
+        self.__assertArraysAlmostEqual( solver.getInverse(), 
+                                        numpy.linalg.inv( self.__cov ) )
+        return
+
+    def test_inverseSolve( self ):
+        solver= inverseCovarianceSolver( numpy.linalg.inv( self.__cov ) )
+        self.__assertArraysAlmostEqual( solver.solve( self.__rhs ), 
+                                        numpy.linalg.solve( self.__cov, 
+                                                            self.__rhs ) )
+        delta= self.__rhs[:,1]
+        self.assertAlmostEqual( solver.calcChisq( delta ),
+                                denseCovarianceSolver( self.__cov ).calcChisq( delta ),
+                                places=6 )
+        return
+
+    def test_lowRankNotPositive( self ):
+        diagonal= self.__diagonal.copy()
+        diagonal[1]= 0.0
+        self.assertRaises( CovarianceError, lowRankCovarianceSolver,
+                           diagonal, self.__vectors )
+        return
+
+
+if __name__ == '__main__':
+    suite= unittest.TestLoader().loadTestsFromTestCase( covarianceSolverTest )
+    unittest.TextTestRunner( verbosity=2 ).run( suite )
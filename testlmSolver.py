@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+# unit tests for Levenberg-Marquardt least squares solver
+
+import unittest
+import numpy
+
+import lmSolver
+
+
+class lmSolverTest( unittest.TestCase ):
+
+    def setUp( self ):
+
+        mtop= numpy.array( [ 171.5, 173.1, 174.5 ] )
+        stat= numpy.array( [   0.3,   0.33,  0.4 ] )
+        erra= numpy.array( [   1.1,   1.3,   1.5 ] )
+        errb= numpy.array( [   0.9,   1.5,   1.9 ] )
+        errc= numpy.array( [   2.4,   3.1,   3.5 ] )
+
+        def residuals( par ):
+            ave, pa, pb, pc= par
+            terms= ( mtop - ave + erra*pa + errb*pb + errc*pc )/stat
+            jacobian= numpy.zeros( shape=(6,4) )
+            jacobian[:3,0]= -1.0/stat
+            jacobian[:3,1]= erra/stat
+            jacobian[:3,2]= errb/stat
+            jacobian[:3,3]= errc/stat
+            jacobian[3:,1:]= numpy.eye( 3 )
+            return numpy.concatenate( [ terms, par[1:] ] ), jacobian
+
+        pars= [ 172.0, 0.0, 0.0, 0.0 ]
+        parerrors= [ 2.0, 1.0, 1.0, 1.0 ]
+        parnames= [ "average", "pa", "pb", "pc" ]
+        ndof= 2
+        self.__solver= lmSolver.lmSolver( residuals, pars, parerrors,
+                                          parnames, ndof )
+
+        return
+
+    def test_solve( self ):
+        self.__solver.solve()
+        self.assertTrue( self.__solver.isConverged() )
+        return
+
+    def test_getChisq( self ):
+        self.__solver.solve()
+        chisq= self.__solver.getChisq()
+        expectedchisq= 3.58037721
+        self.assertAlmostEqual( chisq, expectedchisq )
+        return
+
+    def test_getNdof( self ):
+        ndof= self.__solver.getNdof()
+        expectedNdof= 2
+        self.assertEqual( ndof, expectedNdof )
+        return
+
+    def test_getPar( self ):
+        self.__solver.solve()
+        pars= self.__solver.getPars()
+        expectedpars= [ 167.1022776, -0.48923998, -1.13417736,
+                        -1.21202615 ]
+        for par, expectedpar in zip( pars, expectedpars ):
+            self.assertAlmostEqual( par, expectedpar, places=6 )
+        return
+
+    def test_getParErrors( self ):
+        self.__solver.solve()
+        parerrors= self.__solver.getParErrors()
+        expectedparerrors= [ 1.4395944, 0.96551507, 0.78581713, 0.72292831 ]
+        for parerror, expectedparerror in zip( parerrors, expectedparerrors ):
+            self.assertAlmostEqual( parerror, expectedparerror, places=6 )
+        return
+
+
+if __name__ == '__main__':
+    suite= unittest.TestLoader().loadTestsFromTestCase( lmSolverTest )
+    unittest.TextTestRunner( verbosity=2 ).run( suite )
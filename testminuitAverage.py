@@ -40,6 +40,115 @@ class minuitAverageTest( unittest.TestCase ):
             self.assertAlmostEqual( weight, expectedWeight )
         return
 
+    def test_analyticWeights( self ):
+        for filename in [ "test.txt", "valassi3.txt", "valassi5.txt" ]:
+            average= minuitAverage( filename )
+            expectedWeightsMatrix= average.calcWeightsMatrix()
+            average.setAnalyticWeights()
+            weightsMatrix= average.calcWeightsMatrix()
+            self.assertEqual( weightsMatrix.shape, expectedWeightsMatrix.shape )
+            for weight, expectedWeight in zip( weightsMatrix.flat, 
+                                               expectedWeightsMatrix.flat ):
+                self.assertAlmostEqual( weight, expectedWeight, places=5 )
+        return
+
+
+    def test_poolWeights( self ):
+        expectedWeightsMatrix= minuitAverage( "valassi3.txt" ).calcWeightsMatrix()
+        weightsMatrix= minuitAverage( "valassi3.txt" ).calcWeightsMatrix( nprocs=2 )
+        for weight, expectedWeight in zip( weightsMatrix.flat, 
+                                           expectedWeightsMatrix.flat ):
+            self.assertEqual( weight, expectedWeight )
+        return
+
+    def test_cachedSolution( self ):
+        average= minuitAverage( "valassi3.txt" )
+        solver= average.getSolver()
+        solves= []
+        solve= solver.solve
+        def countingSolve( *args, **kwargs ):
+            solves.append( args )
+            return solve( *args, **kwargs )
+        solver.solve= countingSolve
+        averages, errors= average.getAveragesAndErrors()
+        average.calcPulls()
+        self.assertEqual( len( solves ), 1 )
+        herrors, wm= average.errorAnalysis()
+        nsolves= len( solves )
+        self.assertEqual( nsolves, 1 + 2*4 )
+        average.errorAnalysis()
+        average.calcPulls()
+        self.assertEqual( len( solves ), nsolves + 1 )
+        for value, expectedvalue in zip( average.getAveragesAndErrors()[0], 
+                                         averages ):
+            self.assertAlmostEqual( value, expectedvalue )
+        self.assertEqual( len( solves ), nsolves + 1 )
+        return
+    def test_profiledNuisances( self ):
+        for filename in [ "test.txt", "testOptions.txt", "valassi3.txt" ]:
+            average= minuitAverage( filename )
+            profiledaverage= minuitAverage( filename, lProfile=True )
+            averages, errors= average.getAveragesAndErrors()
+            profiledaverages, profilederrors= profiledaverage.getAveragesAndErrors()
+            for value, expectedvalue in zip( profiledaverages, averages ):
+                self.assertAlmostEqual( value, expectedvalue, places=5 )
+            for error, expectederror in zip( profilederrors, errors ):
+                self.assertAlmostEqual( error, expectederror, places=4 )
+            self.assertAlmostEqual( profiledaverage.getSolver().getChisq(),
+                                    average.getSolver().getChisq(), places=6 )
+        self.assertEqual( len( profiledaverage.getSolver().getPars() ), 2 )
+        return
+    def test_lmSolver( self ):
+        for filename in [ "test.txt", "testOptions.txt", "valassi5.txt" ]:
+            for lProfile in [ False, True ]:
+                average= minuitAverage( filename, lProfile=lProfile )
+                lmaverage= minuitAverage( filename, lProfile=lProfile,
+                                          lLMSolver=True )
+                averages, errors= average.getAveragesAndErrors()
+                lmaverages, lmerrors= lmaverage.getAveragesAndErrors()
+                for value, expectedvalue in zip( lmaverages, averages ):
+                    self.assertAlmostEqual( value, expectedvalue, places=5 )
+                for error, expectederror in zip( lmerrors, errors ):
+                    self.assertAlmostEqual( error, expectederror, places=5 )
+                self.assertAlmostEqual( lmaverage.getSolver().getChisq(),
+                                        average.getSolver().getChisq() )
+        return
+
+    def test_mergeNuisances( self ):
+        average= minuitAverage( "testOptions.txt" )
+        mergedaverage= minuitAverage( "testOptions.txt", lMergeNuisances=True )
+        average.runSolver()
+        mergedaverage.runSolver()
+        solver= average.getSolver()
+        mergedsolver= mergedaverage.getSolver()
+        self.assertEqual( len( mergedsolver.getPars() ), 
+                          len( solver.getPars() ) - 1 )
+        self.assertAlmostEqual( mergedsolver.getPars()[0], 
+                                solver.getPars()[0], places=6 )
+        self.assertAlmostEqual( mergedsolver.getParErrors()[0], 
+                                solver.getParErrors()[0], places=6 )
+        self.assertAlmostEqual( mergedsolver.getChisq(), solver.getChisq() )
+        return
+
+    def test_fromData( self ):
+        average= minuitAverage.fromData( [ "Val1", "Val2", "Val3" ],
+                                         [ 171.5, 173.1, 174.5 ],
+                                         { "00stat": [ 0.2, 0.22, 0.3 ],
+                                           "01erra": [ 1.1, 1.3, 1.5 ],
+                                           "02errb": [ 0.9, 1.5, 1.9 ],
+                                           "03errc": [ 2.4, 3.1, 3.5 ] },
+                                         { "00stat": "%u", "01erra": "%gp",
+                                           "02errb": "gp", "03errc": "gprR" },
+                                         rvalues={ "03errc": 0.1 },
+                                         lProfile=True )
+        expectedaverage= minuitAverage( "testOptions.txt", lProfile=True )
+        averages, errors= average.getAveragesAndErrors()
+        expectedaverages, expectederrors= expectedaverage.getAveragesAndErrors()
+        for value, expectedvalue in zip( averages, expectedaverages ):
+            self.assertAlmostEqual( value, expectedvalue )
+        for error, expectederror in zip( errors, expectederrors ):
+            self.assertAlmostEqual( error, expectederror )
+        return
 
 if __name__ == '__main__':
     suite= unittest.TestLoader().loadTestsFromTestCase( minuitAverageTest )
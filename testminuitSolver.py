@@ -78,6 +78,25 @@ class minuitSolverTest( unittest.TestCase ):
             self.assertAlmostEqual( parerror, expectedparerror, places=6 )
         return
 
+    def test_getResults( self ):
+        self.__solver.solve()
+        pars, parerrors, covm, corrm= self.__solver.getResults()
+        for par, expectedpar in zip( pars, self.__solver.getPars() ):
+            self.assertEqual( par, expectedpar )
+        for parerror, expectedparerror in zip( parerrors, 
+                                               self.__solver.getParErrors() ):
+            self.assertEqual( parerror, expectedparerror )
+        self.assertEqual( covm.shape, (4,4) )
+        for ipar in range( 4 ):
+            self.assertAlmostEqual( covm[ipar,ipar], parerrors[ipar]**2, 
+                                    places=6 )
+            self.assertAlmostEqual( corrm[ipar,ipar], 1.0 )
+        self.__solver.setStartValues( [ 160.0, 0.0, 0.0, 0.0 ] )
+        self.__solver.solve()
+        self.assertAlmostEqual( self.__solver.getResults()[0][0], pars[0],
+                                places=6 )
+        return
+
 
 if __name__ == '__main__':
     suite= unittest.TestLoader().loadTestsFromTestCase( minuitSolverTest )
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+# unit tests for toy experiments
+
+import unittest
+import numpy
+
+from blue import Blue
+from clsqAverage import clsqAverage
+from toyExperiments import ToyExperiments
+
+
+class toyExperimentsTest( unittest.TestCase ):
+
+    def setUp( self ):
+        self.__blue= Blue( "test.txt" )
+        self.__toys= ToyExperiments( self.__blue )
+        return
+
+    def test_generate( self ):
+        values= self.__toys.generate( 200000, seed=1234 )
+        cov= numpy.cov( values.T )
+        expectedcov= numpy.asarray( self.__blue.cov )
+        for value, expectedvalue in zip( cov.flat, expectedcov.flat ):
+            self.assertAlmostEqual( value/expectedcov[0,0], 
+                                    expectedvalue/expectedcov[0,0], delta=0.03 )
+        return
+
+    def test_run( self ):
+        results= self.__toys.run( 20000, chunksize=3000, seed=1234 )
+        self.assertEqual( results.ntoys, 20000 )
+        self.assertAlmostEqual( results.pullmean[0], 0.0, delta=0.03 )
+        self.assertAlmostEqual( results.pullwidth[0], 1.0, delta=0.02 )
+        self.assertAlmostEqual( results.coverage1[0], 0.6827, delta=0.01 )
+        self.assertAlmostEqual( results.coverage2[0], 0.9545, delta=0.01 )
+        self.assertGreater( numpy.sum( results.pullhistogram ), 19990 )
+        return
+
+    def test_seed( self ):
+        results1= self.__toys.run( 1000, chunksize=300, seed=42 )
+        results2= self.__toys.run( 1000, chunksize=300, seed=42 )
+        self.assertEqual( results1.bias[0], results2.bias[0] )
+        self.assertEqual( results1.pullwidth[0], results2.pullwidth[0] )
+        return
+
+    def test_pool( self ):
+        results1= self.__toys.run( 2000, chunksize=500, seed=7 )
+        results2= self.__toys.run( 2000, chunksize=500, seed=7, nprocs=2 )
+        self.assertAlmostEqual( results1.bias[0], results2.bias[0], places=12 )
+        self.assertAlmostEqual( results1.pullwidth[0], results2.pullwidth[0], 
+                                places=12 )
+        self.assertAlmostEqual( results1.meanchisq, results2.meanchisq, 
+                                places=10 )
+        return
+
+    def test_noToys( self ):
+        self.assertRaises( ValueError, self.__toys.run, 0 )
+        return
+
+    def test_fitAverage( self ):
+        average= clsqAverage( "test.txt" )
+        average.setAnalyticWeights()
+        toys= ToyExperiments( average )
+        results= toys.run( 40, chunksize=10, seed=3 )
+        poolresults= toys.run( 40, chunksize=10, seed=3, nprocs=2 )
+        blueresults= self.__toys.run( 40, chunksize=10, seed=3 )
+        for toyresults in [ poolresults, blueresults ]:
+            self.assertAlmostEqual( results.bias[0], toyresults.bias[0], 
+                                    places=6 )
+            self.assertAlmostEqual( results.pullwidth[0], 
+                                    toyresults.pullwidth[0], places=6 )
+            self.assertAlmostEqual( results.meanchisq, toyresults.meanchisq, 
+                                    places=6 )
+        return
+
+    def test_errorkeys( self ):
+        toys= ToyExperiments( self.__blue, errorkeys=[ "00stat" ] )
+        factor= toys.getFactor()
+        cov= numpy.dot( factor, factor.T )
+        expectedcov= self.__blue._getDataparser().getCovariances()["00stat"]
+        for value, expectedvalue in zip( cov.flat, 
+                                         numpy.asarray( expectedcov ).flat ):
+            self.assertAlmostEqual( value, expectedvalue )
+        return
+
+
+if __name__ == '__main__':
+    suite= unittest.TestLoader().loadTestsFromTestCase( toyExperimentsTest )
+    unittest.TextTestRunner( verbosity=2 ).run( suite )
+
@@ -0,0 +1,161 @@
+
+# Toy Monte Carlo pseudo-experiments for bias and coverage studies of
+# averages.  Pseudo-measurements are drawn around true values with the
+# total covariance matrix, or the sum of covariance matrices of selected
+# error sources, from AverageDataParser.  Each pseudo-experiment is
+# averaged with the averaging object, Blue or one of the FitAverage
+# classes, using their calcAverages method.  Toys are processed in
+# chunks which are summarised immediately such that memory use does not
+# depend on the number of toys, chunks can run in a process pool.
+
+import numpy
+from concurrent.futures import ProcessPoolExecutor
+
+
+# Summary of one chunk of toys, sums over toys for each average:
+def _summariseChunk( averages, errors, chisqs, truevalues, pullbins ):
+    deltas= averages - truevalues
+    pulls= deltas/errors
+    naverages= averages.shape[1]
+    pullhistogram= numpy.array( [ numpy.histogram( pulls[:,iavg],
+                                                   bins=pullbins )[0]
+                                  for iavg in range( naverages ) ] )
+    summary= { "ntoys": len( averages ),
+               "sumdelta": numpy.sum( deltas, axis=0 ),
+               "sumdeltasq": numpy.sum( deltas**2, axis=0 ),
+               "sumerror": numpy.sum( errors, axis=0 ),
+               "sumpull": numpy.sum( pulls, axis=0 ),
+               "sumpullsq": numpy.sum( pulls**2, axis=0 ),
+               "ncovered1": numpy.sum( numpy.abs( pulls ) <= 1.0, axis=0 ),
+               "ncovered2": numpy.sum( numpy.abs( pulls ) <= 2.0, axis=0 ),
+               "sumchisq": numpy.sum( chisqs ),
+               "pullhistogram": pullhistogram }
+    return summary
+
+# Generate and average one chunk of toys:
+def _runChunk( average, meanvalues, factor, truevalues, pullbins,
+               seedsequence, ntoys ):
+    generator= numpy.random.default_rng( seedsequence )
+    normals= generator.standard_normal( ( ntoys, len( meanvalues ) ) )
+    values= meanvalues + numpy.dot( normals, factor.T )
+    averages, errors, chisqs= average.calcAverages( values )
+    return _summariseChunk( averages, errors, chisqs, truevalues, pullbins )
+
+# Each worker process keeps its own copy of the averaging object:
+_workeraverage= None
+def _initWorker( average ):
+    global _workeraverage
+    _workeraverage= average
+    return
+def _runWorkerChunk( args ):
+    return _runChunk( _workeraverage, *args )
+
+
+class ToyResults:
+
+    def __init__( self, summaries, truevalues, pullbins, names ):
+        ntoys= sum( summary["ntoys"] for summary in summaries )
+        def total( key ):
+            return sum( summary[key] for summary in summaries )
+        self.ntoys= ntoys
+        self.names= names
+        self.truevalues= truevalues
+        self.bias= total( "sumdelta" )/ntoys
+        self.spread= numpy.sqrt( total( "sumdeltasq" )/ntoys - self.bias**2 )
+        self.meanerror= total( "sumerror" )/ntoys
+        self.pullmean= total( "sumpull" )/ntoys
+        self.pullwidth= numpy.sqrt( total( "sumpullsq" )/ntoys -
+                                    self.pullmean**2 )
+        self.coverage1= total( "ncovered1" )/float( ntoys )
+        self.coverage2= total( "ncovered2" )/float( ntoys )
+        self.meanchisq= total( "sumchisq" )/ntoys
+        self.pullbins= pullbins
+        self.pullhistogram= total( "pullhistogram" )
+        return
+
+    def printResults( self ):
+        print( "\n Toy experiments:", self.ntoys )
+        print( "\n {0:>10s} {1:>10s} {2:>10s} {3:>10s} {4:>10s} {5:>10s} {6:>10s} {7:>10s} {8:>10s}".format(
+            "", "True", "Bias", "Spread", "Mean err.", "Pull mean",
+            "Pull width", "Cov. 1 s", "Cov. 2 s" ) )
+        for iavg in range( len( self.truevalues ) ):
+            print( " {0:>10s} {1:10.4f} {2:10.4f} {3:10.4f} {4:10.4f} {5:10.4f} {6:10.4f} {7:10.4f} {8:10.4f}".format(
+                self.names[iavg], self.truevalues[iavg], self.bias[iavg],
+                self.spread[iavg], self.meanerror[iavg], self.pullmean[iavg],
+                self.pullwidth[iavg], self.coverage1[iavg],
+                self.coverage2[iavg] ) )
+        print( "\n Mean chi^2: {0:.4f}".format( self.meanchisq ) )
+        return
+
+
+class ToyExperiments:
+
+    # average is a Blue or FitAverage object, truevalues are the true
+    # averages, default is the average of the input values. errorkeys
+    # selects error sources for the pseudo-measurements, default is all:
+    def __init__( self, average, truevalues=None, errorkeys=None ):
+        self.__average= average
+        dataparser= average._getDataparser()
+        groupmatrix= numpy.array( dataparser.getGroupMatrix(), dtype=float )
+        if truevalues is None:
+            truevalues= [ item for item in average._getAverage().flat ]
+        self.__truevalues= numpy.array( truevalues, dtype=float )
+        self.__meanvalues= numpy.dot( groupmatrix, self.__truevalues )
+        if errorkeys is None:
+            cov= dataparser.getTotalCovariance()
+        else:
+            hcov= dataparser.getCovariances()
+            cov= sum( hcov[errorkey] for errorkey in errorkeys )
+        self.__factor= self.__makeFactor( numpy.asarray( cov, dtype=float ) )
+        if groupmatrix.shape[1] > 1:
+            groups= sorted( set( dataparser.getGroups() ) )
+            self.__names= [ "Average " + str( group ) for group in groups ]
+        else:
+            self.__names= [ "Average" ]
+        return
+
+    # Cholesky factor of covariance matrix, covariances of selected
+    # error sources can be singular, use eigenvalues and vectors then:
+    def __makeFactor( self, cov ):
+        try:
+            factor= numpy.linalg.cholesky( cov )
+        except numpy.linalg.LinAlgError:
+            eigenvalues, eigenvectors= numpy.linalg.eigh( cov )
+            factor= eigenvectors*numpy.sqrt( numpy.maximum( eigenvalues, 0.0 ) )
+        return factor
+
+    def getFactor( self ):
+        return self.__factor.copy()
+
+    # Pseudo-measurements, shape (ntoys,nvalues):
+    def generate( self, ntoys, seed=None ):
+        generator= numpy.random.default_rng( seed )
+        normals= generator.standard_normal( ( ntoys, len( self.__meanvalues ) ) )
+        return self.__meanvalues + numpy.dot( normals, self.__factor.T )
+
+    # Run ntoys pseudo-experiments in chunks of chunksize toys, with
+    # nprocs > 1 in a pool of processes.  Each chunk has its own seed
+    # derived from seed, results do not depend on nprocs:
+    def run( self, ntoys, chunksize=10000, nprocs=1, seed=None,
+             pullbins=numpy.linspace( -5.0, 5.0, 51 ) ):
+        if ntoys < 1 or chunksize < 1:
+            raise ValueError( "Number of toys and chunk size must be positive" )
+        nchunks= ( ntoys + chunksize - 1 )//chunksize
+        seedsequences= numpy.random.SeedSequence( seed ).spawn( nchunks )
+        chunksizes= nchunks*[ chunksize ]
+        chunksizes[-1]= ntoys - ( nchunks - 1 )*chunksize
+        chunkargs= [ ( self.__meanvalues, self.__factor, self.__truevalues,
+                       pullbins, seedsequence, nchunktoys )
+                     for seedsequence, nchunktoys in zip( seedsequences,
+                                                          chunksizes ) ]
+        if nprocs > 1:
+            with ProcessPoolExecutor( max_workers=nprocs,
+                                      initializer=_initWorker,
+                                      initargs=( self.__average, ) ) as pool:
+                summaries= list( pool.map( _runWorkerChunk, chunkargs ) )
+        else:
+            summaries= [ _runChunk( self.__average, *args )
+                         for args in chunkargs ]
+        return ToyResults( summaries, self.__truevalues, pullbins,
+                           self.__names )
+